@@ -0,0 +1,271 @@
+"""
+准入控制與降級
+webhook 突發流量時限制同時處理的請求數，並依壓力分段降級：
+
+- 並行上限：所有受控請求共用 max_concurrent 個處理名額，儀表板 API 最多佔用 api_limit 個
+- 優先順序：有 webhook 在排隊時，API 請求不再取得名額（直接回應 503）
+- 排隊時間預算：超過預算仍未取得名額的 API 請求立即回應 503 與 Retry-After，由前端稍後重試；
+  webhook 從不捨棄（LINE 只在頻道啟用重新傳送時才會重送），超過預算時不受上限限制地放行並標記為
+  deferred：寫入日誌後立即回應 200，由日誌的背景執行緒以 PERSIST_ONLY 處理
+- 分段降級（webhook）：壓力升高時先略過確認回覆，名額用盡須排隊時再略過通知，只儲存提及記錄
+
+名額與計數只在同一程序內共用：以 gunicorn -w N 啟動多個同步 worker 時，實際的並行上限為 N 倍。
+"""
+
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK = 'webhook'
+API = 'api'
+
+# 降級等級
+NORMAL = 0
+SKIP_REPLIES = 1
+PERSIST_ONLY = 2
+LEVEL_NAMES = {NORMAL: 'normal', SKIP_REPLIES: 'skip_replies', PERSIST_ONLY: 'persist_only'}
+
+# 不受准入控制的維運端點
+EXEMPT_PATHS = ('/api/admission', '/api/startup', '/api/snapshots', '/api/journal', '/api/chat-commands',
+                '/api/digests', '/api/partitions')
+
+# 非同步排隊時輪詢名額的間隔（秒）
+POLL_INTERVAL = 0.005
+
+
+class Overloaded(Exception):
+    """超過並行上限或排隊時間預算"""
+
+    def __init__(self, kind, retry_after):
+        super().__init__(f'{kind} 請求過多，請稍後重試')
+        self.kind = kind
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """已取得的處理名額"""
+
+    __slots__ = ('kind', 'level', 'waited', 'deferred')
+
+    def __init__(self, kind, level, waited, deferred=False):
+        self.kind = kind
+        self.level = level
+        self.waited = waited
+        # 超過排隊時間預算的 webhook：只寫入日誌，稍後由背景處理
+        self.deferred = deferred
+
+
+class AdmissionController:
+    """分類別的並行上限與排隊時間預算（同一程序內的執行緒共用）"""
+
+    def __init__(self, max_concurrent=16, api_limit=8, webhook_queue_timeout=2.0,
+                 api_queue_timeout=0.1, degrade_at=0.75, retry_after=1):
+        self.max_concurrent = max(1, max_concurrent)
+        self.api_limit = max(1, min(api_limit, self.max_concurrent))
+        self.queue_timeouts = {WEBHOOK: webhook_queue_timeout, API: api_queue_timeout}
+        self.degrade_at = degrade_at
+        self.retry_after = retry_after
+        self._condition = threading.Condition()
+        self._in_flight = {WEBHOOK: 0, API: 0}
+        self._waiting = {WEBHOOK: 0, API: 0}
+        self._counters = {kind: {'admitted': 0, 'queued': 0, 'shed': 0, 'deferred': 0} for kind in (WEBHOOK, API)}
+        self._levels = dict.fromkeys(LEVEL_NAMES.values(), 0)
+        self._max_wait = {WEBHOOK: 0.0, API: 0.0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_concurrent=int(os.getenv('ADMISSION_MAX_CONCURRENT', 16)),
+            api_limit=int(os.getenv('ADMISSION_API_CONCURRENCY', 8)),
+            webhook_queue_timeout=float(os.getenv('ADMISSION_WEBHOOK_QUEUE_MS', 2000)) / 1000,
+            api_queue_timeout=float(os.getenv('ADMISSION_API_QUEUE_MS', 100)) / 1000,
+            degrade_at=float(os.getenv('ADMISSION_DEGRADE_AT', 0.75)),
+            retry_after=int(os.getenv('ADMISSION_RETRY_AFTER', 1)),
+        )
+
+    @staticmethod
+    def classify(path):
+        """依路徑分類：webhook、API 或不受控（None）"""
+        if path == '/webhook' or path.startswith('/webhook/'):
+            return WEBHOOK
+        if path.startswith('/api/') and path not in EXEMPT_PATHS:
+            return API
+        return None
+
+    def _can_admit(self, kind):
+        if sum(self._in_flight.values()) >= self.max_concurrent:
+            return False
+        if kind == API:
+            return self._in_flight[API] < self.api_limit and not self._waiting[WEBHOOK]
+        return True
+
+    def _admit(self, kind, waited):
+        """取得名額並決定降級等級（須持有鎖）"""
+        self._in_flight[kind] += 1
+        counters = self._counters[kind]
+        counters['admitted'] += 1
+        if waited:
+            counters['queued'] += 1
+            self._max_wait[kind] = max(self._max_wait[kind], waited)
+
+        level = NORMAL
+        if kind == WEBHOOK:
+            # 壓力：處理中與排隊中的請求相對於名額上限
+            pressure = (sum(self._in_flight.values()) + self._waiting[WEBHOOK]) / self.max_concurrent
+            if waited or pressure > 1:
+                level = PERSIST_ONLY
+            elif pressure >= self.degrade_at:
+                level = SKIP_REPLIES
+            self._levels[LEVEL_NAMES[level]] += 1
+        return Ticket(kind, level, waited)
+
+    def _shed(self, kind):
+        self._counters[kind]['shed'] += 1
+        return Overloaded(kind, self.retry_after)
+
+    def _defer(self, waited):
+        """超過排隊時間預算的 webhook 不受上限限制地放行，只儲存提及記錄（須持有鎖）"""
+        self._in_flight[WEBHOOK] += 1
+        counters = self._counters[WEBHOOK]
+        counters['admitted'] += 1
+        counters['queued'] += 1
+        counters['deferred'] += 1
+        self._max_wait[WEBHOOK] = max(self._max_wait[WEBHOOK], waited)
+        self._levels[LEVEL_NAMES[PERSIST_ONLY]] += 1
+        return Ticket(WEBHOOK, PERSIST_ONLY, waited, deferred=True)
+
+    def try_acquire(self, kind):
+        """不等待地取得名額，沒有名額時回傳 None（不計入捨棄次數）"""
+        with self._condition:
+            if self._can_admit(kind):
+                return self._admit(kind, 0.0)
+            return None
+
+    def acquire(self, kind):
+        """取得名額，必要時在排隊時間預算內等待
+
+        超過預算時 API 拋出 Overloaded，webhook 回傳 deferred 的名額（不捨棄）。
+        """
+        with self._condition:
+            if self._can_admit(kind):
+                return self._admit(kind, 0.0)
+            if kind == API and self._waiting[WEBHOOK]:
+                # webhook 優先：API 不與排隊中的 webhook 競爭名額
+                raise self._shed(kind)
+
+            started = time.monotonic()
+            deadline = started + self.queue_timeouts[kind]
+            self._waiting[kind] += 1
+            try:
+                while not self._can_admit(kind):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        if kind == WEBHOOK:
+                            return self._defer(time.monotonic() - started)
+                        raise self._shed(kind)
+                    self._condition.wait(remaining)
+                return self._admit(kind, time.monotonic() - started)
+            finally:
+                self._waiting[kind] -= 1
+                # 排隊中的 webhook 離開後，被擋下的 API 可能可以取得名額
+                self._condition.notify_all()
+
+    async def acquire_async(self, kind):
+        """acquire 的非同步版本：以輪詢等待名額，不阻塞事件迴圈"""
+        ticket = self.try_acquire(kind)
+        if ticket is not None:
+            return ticket
+        with self._condition:
+            if kind == API and self._waiting[WEBHOOK]:
+                raise self._shed(kind)
+            self._waiting[kind] += 1
+
+        started = time.monotonic()
+        deadline = started + self.queue_timeouts[kind]
+        try:
+            while True:
+                await asyncio.sleep(POLL_INTERVAL)
+                with self._condition:
+                    if self._can_admit(kind):
+                        return self._admit(kind, time.monotonic() - started)
+                    if time.monotonic() >= deadline:
+                        if kind == WEBHOOK:
+                            return self._defer(time.monotonic() - started)
+                        raise self._shed(kind)
+        finally:
+            with self._condition:
+                self._waiting[kind] -= 1
+                self._condition.notify_all()
+
+    def release(self, ticket):
+        with self._condition:
+            self._in_flight[ticket.kind] -= 1
+            self._condition.notify_all()
+
+    def snapshot(self):
+        """目前的處理中／排隊中請求數與累計計數"""
+        with self._condition:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'api_limit': self.api_limit,
+                'queue_timeout_ms': {kind: round(timeout * 1000) for kind, timeout in self.queue_timeouts.items()},
+                'in_flight': dict(self._in_flight),
+                'waiting': dict(self._waiting),
+                'counters': {kind: dict(counters) for kind, counters in self._counters.items()},
+                'max_wait_ms': {kind: round(wait * 1000, 1) for kind, wait in self._max_wait.items()},
+                'webhook_levels': dict(self._levels),
+            }
+
+
+def overloaded_headers(error):
+    return {'Retry-After': str(max(1, math.ceil(error.retry_after)))}
+
+
+def init_admission(app, controller):
+    """為 Flask app 註冊准入控制；降級等級由 current_level() 取得"""
+    from flask import g, jsonify, request
+
+    @app.before_request
+    def admit_request():
+        kind = controller.classify(request.path)
+        if kind is None:
+            return None
+        try:
+            g.admission_ticket = controller.acquire(kind)
+        except Overloaded as e:
+            logger.warning(f"請求過多，捨棄 {request.path}")
+            return jsonify({'error': 'overloaded'}), 503, overloaded_headers(e)
+        return None
+
+    @app.teardown_request
+    def release_request(exc):
+        ticket = g.pop('admission_ticket', None)
+        if ticket is not None:
+            controller.release(ticket)
+
+    return app
+
+
+def current_level():
+    """目前 Flask 請求的降級等級（不在請求中或未受控時為 NORMAL）"""
+    from flask import g, has_request_context
+
+    if not has_request_context():
+        return NORMAL
+    ticket = g.get('admission_ticket')
+    return ticket.level if ticket is not None else NORMAL
+
+
+def is_deferred():
+    """目前 Flask 請求是否為超過排隊時間預算、應只寫入日誌的 webhook"""
+    from flask import g, has_request_context
+
+    if not has_request_context():
+        return False
+    ticket = g.get('admission_ticket')
+    return ticket is not None and ticket.deferred
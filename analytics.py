@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+離線分析
+將 messages 資料表依主鍵（rowid）或時間範圍切分成多段，由多個程序以唯讀連線平行掃描，
+各段的部分結果以可合併的彙總器（reducer）合併後輸出為 CSV 或 JSON。
+
+內建報表：
+- senders：各群組每週各發言者的提及訊息數與提及次數
+- mentioned：各群組每週各被提及者的被提及次數與相異提及者數
+- heatmap：顯示時區的星期 × 小時提及次數
+- mention-back：回提及延遲——被提及者之後在同一群組第一次提及別人距被提及的時間；
+  資料庫只儲存含提及的訊息，不含提及的一般發言沒有記錄，因此這不是一般的回應時間。
+  被提及者需以名冊對應到 LINE 使用者 ID 才能計算
+
+使用方式:
+    python analytics.py senders --since 2024-01-01 --format csv --out senders.csv
+    python analytics.py mention-back --workers 8 --format json
+    python analytics.py heatmap --db line_data.replica.db
+"""
+
+import argparse
+import csv
+import json
+import math
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+import mention_writer
+import shards
+import timeutil
+
+ROWS_SQL = '''
+    SELECT m.id, m.group_id, m.sender_id, m.created_at, n.user_id, n.user_name
+    FROM messages m JOIN mentions n ON n.message_ref = m.id
+    WHERE {where}
+    ORDER BY {order}
+'''
+
+# 依時間切分掃描範圍的報表
+TIME_RANGE_REPORT = 'mention-back'
+
+# 延遲直方圖的桶寬（相鄰桶上界比值），百分位數的相對誤差不超過此比例
+LATENCY_BUCKET_RATIO = 1.1
+
+
+def week_start(created_at):
+    """顯示時區當週星期一的日期"""
+    day = timeutil.from_ms(created_at).date()
+    return (day - timedelta(days=day.weekday())).isoformat()
+
+
+class CounterReducer:
+    """以鍵分組的計數彙總：每個鍵對應固定數量的計數欄位，合併時相加"""
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.counts = {}
+
+    def add(self, key, *values):
+        entry = self.counts.get(key)
+        if entry is None:
+            self.counts[key] = list(values)
+        else:
+            for index, value in enumerate(values):
+                entry[index] += value
+
+    def merge(self, other):
+        for key, values in other.counts.items():
+            self.add(key, *values)
+        return self
+
+
+class SendersReducer(CounterReducer):
+    key_columns = ('group_id', 'week', 'sender_id')
+
+    def __init__(self):
+        super().__init__(('messages', 'mentions'))
+        self._last_message = None
+
+    def add_row(self, message_ref, group_id, sender_id, created_at, user_id, user_name):
+        # 同一則訊息的資料列相鄰（依訊息主鍵排序）
+        first = message_ref != self._last_message
+        self._last_message = message_ref
+        self.add((group_id, week_start(created_at), sender_id or ''), 1 if first else 0, 1)
+
+    def result(self):
+        return [dict(zip(self.key_columns + self.columns, key + tuple(values)))
+                for key, values in sorted(self.counts.items())]
+
+
+class MentionedReducer:
+    """被提及次數與相異提及者（集合聯集，可合併）"""
+
+    key_columns = ('group_id', 'week', 'user_id')
+
+    def __init__(self):
+        self.entries = {}
+
+    def add_row(self, message_ref, group_id, sender_id, created_at, user_id, user_name):
+        entry = self.entries.setdefault((group_id, week_start(created_at), user_id), [0, set(), user_name])
+        entry[0] += 1
+        if sender_id:
+            entry[1].add(sender_id)
+        entry[2] = user_name
+
+    def merge(self, other):
+        for key, (count, senders, user_name) in other.entries.items():
+            entry = self.entries.setdefault(key, [0, set(), user_name])
+            entry[0] += count
+            entry[1] |= senders
+        return self
+
+    def result(self):
+        return [
+            dict(zip(self.key_columns, key), user_name=user_name, mentions=count, senders=len(senders))
+            for key, (count, senders, user_name) in sorted(self.entries.items())
+        ]
+
+
+class HeatmapReducer(CounterReducer):
+    def __init__(self):
+        super().__init__(('mentions',))
+
+    def add_row(self, message_ref, group_id, sender_id, created_at, user_id, user_name):
+        moment = timeutil.from_ms(created_at)
+        self.add((moment.weekday(), moment.hour), 1)
+
+    def result(self):
+        return [{'weekday': weekday, 'hour': hour, 'mentions': self.counts.get((weekday, hour), [0])[0]}
+                for weekday in range(7) for hour in range(24)]
+
+
+class MentionBackReducer:
+    """各群組的回提及延遲：以對數直方圖記錄（可合併），輸出近似百分位數
+
+    「回提及」為被提及者之後在同一群組送出的第一則含提及的訊息（只有這類訊息有記錄）；
+    window 內沒有回提及的計為 no_mention_back。
+    每一段只計算提及時間落在 [start, end) 的提及；掃描範圍延伸 window 毫秒以找到回提及。
+    """
+
+    def __init__(self, start=None, end=None, window=None):
+        self.start = start
+        self.end = end
+        self.window = window
+        self.groups = {}
+        self._pending = {}
+        self._current = None
+
+    def _stats(self, group_id):
+        # [回提及數, 未回提及數, 延遲總和, 最大延遲, 直方圖]
+        return self.groups.setdefault(group_id, [0, 0, 0, 0, {}])
+
+    def _finish_message(self):
+        if self._current is None:
+            return
+        message_ref, group_id, sender_id, created_at, mentioned = self._current
+        self._current = None
+        if sender_id:
+            for mentioned_at in self._pending.pop((group_id, sender_id), ()):
+                latency = created_at - mentioned_at
+                stats = self._stats(group_id)
+                if latency > self.window:
+                    stats[1] += 1
+                    continue
+                stats[0] += 1
+                stats[2] += latency
+                stats[3] = max(stats[3], latency)
+                bucket = int(math.log(latency / 1000 + 1, LATENCY_BUCKET_RATIO))
+                stats[4][bucket] = stats[4].get(bucket, 0) + 1
+        if self.start <= created_at < self.end:
+            for user_id in mentioned:
+                if user_id != sender_id:
+                    self._pending.setdefault((group_id, user_id), []).append(created_at)
+
+    def add_row(self, message_ref, group_id, sender_id, created_at, user_id, user_name):
+        if self._current is None or self._current[0] != message_ref:
+            self._finish_message()
+            self._current = (message_ref, group_id, sender_id, created_at, [])
+        self._current[4].append(user_id)
+
+    def close(self):
+        self._finish_message()
+        for (group_id, _), mentions in self._pending.items():
+            self._stats(group_id)[1] += len(mentions)
+        self._pending = {}
+
+    def merge(self, other):
+        for group_id, (mention_backs, missing, total, longest, histogram) in other.groups.items():
+            stats = self._stats(group_id)
+            stats[0] += mention_backs
+            stats[1] += missing
+            stats[2] += total
+            stats[3] = max(stats[3], longest)
+            for bucket, count in histogram.items():
+                stats[4][bucket] = stats[4].get(bucket, 0) + count
+        return self
+
+    @staticmethod
+    def _percentile(histogram, total, fraction):
+        seen = 0
+        for bucket in sorted(histogram):
+            seen += histogram[bucket]
+            if seen >= total * fraction:
+                return round(LATENCY_BUCKET_RATIO ** (bucket + 1) - 1, 1)
+        return None
+
+    def result(self):
+        rows = []
+        for group_id, (mention_backs, missing, total, longest, histogram) in sorted(self.groups.items()):
+            rows.append({
+                'group_id': group_id,
+                'mention_backs': mention_backs,
+                'no_mention_back': missing,
+                'mean_seconds': round(total / mention_backs / 1000, 1) if mention_backs else None,
+                'p50_seconds': self._percentile(histogram, mention_backs, 0.5),
+                'p90_seconds': self._percentile(histogram, mention_backs, 0.9),
+                'max_seconds': round(longest / 1000, 1) if mention_backs else None,
+            })
+        return rows
+
+
+REPORTS = {
+    'senders': SendersReducer,
+    'mentioned': MentionedReducer,
+    'heatmap': HeatmapReducer,
+    TIME_RANGE_REPORT: MentionBackReducer,
+}
+
+
+def connect_readonly(db_path):
+    return sqlite3.connect(f'file:{db_path}?mode=ro', uri=True,
+                           timeout=mention_writer.BUSY_TIMEOUT_MS / 1000)
+
+
+def plan_tasks(db_paths, report, chunks, since=None, until=None, window=None):
+    """切分掃描範圍：mention-back 依時間切分（各段延伸回提及視窗），其餘依訊息主鍵切分"""
+    tasks = []
+    for db_path in db_paths:
+        if not os.path.exists(db_path):
+            continue
+        conn = connect_readonly(db_path)
+        try:
+            if report == TIME_RANGE_REPORT:
+                low, high = conn.execute('SELECT MIN(created_at), MAX(created_at) FROM messages').fetchone()
+                if low is not None and since is not None:
+                    low = max(low, since)
+                if high is not None and until is not None:
+                    high = min(high, until - 1)
+            else:
+                low, high = conn.execute('SELECT MIN(id), MAX(id) FROM messages').fetchone()
+        finally:
+            conn.close()
+        if low is None or high is None or low > high:
+            continue
+        step = max(1, math.ceil((high - low + 1) / chunks))
+        for start in range(low, high + 1, step):
+            tasks.append((db_path, report, start, min(start + step, high + 1), since, until, window))
+    return tasks
+
+
+def run_task(db_path, report, start, end, since, until, window, group_id=None):
+    """在子程序中掃描一段範圍，回傳 (彙總器, 掃描列數)"""
+    if report == TIME_RANGE_REPORT:
+        reducer = MentionBackReducer(start, end, window)
+        where, params = ['m.created_at >= ?', 'm.created_at < ?'], [start, end + window]
+        order = 'm.created_at, m.id'
+    else:
+        reducer = REPORTS[report]()
+        where, params = ['m.id >= ?', 'm.id < ?'], [start, end]
+        order = 'm.id'
+        if since is not None:
+            where.append('m.created_at >= ?')
+            params.append(since)
+        if until is not None:
+            where.append('m.created_at < ?')
+            params.append(until)
+    if group_id:
+        where.append('m.group_id = ?')
+        params.append(group_id)
+
+    conn = connect_readonly(db_path)
+    scanned = 0
+    try:
+        cursor = conn.execute(ROWS_SQL.format(where=' AND '.join(where), order=order), params)
+        while True:
+            rows = cursor.fetchmany(10000)
+            if not rows:
+                break
+            for row in rows:
+                reducer.add_row(*row)
+            scanned += len(rows)
+    finally:
+        conn.close()
+    if report == TIME_RANGE_REPORT:
+        reducer.close()
+    return reducer, scanned
+
+
+def run_report(db_paths, report, workers=None, chunks=None, since=None, until=None,
+               group_id=None, window=7 * 86400 * 1000, progress=None):
+    """平行執行報表，回傳結果列表"""
+    workers = workers or os.cpu_count() or 1
+    tasks = plan_tasks(db_paths, report, chunks or workers * 4, since, until, window)
+    merged = REPORTS[report]() if report != TIME_RANGE_REPORT else MentionBackReducer()
+    started = time.perf_counter()
+    scanned = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_task, *task, group_id=group_id) for task in tasks]
+        for done, future in enumerate(as_completed(futures), 1):
+            reducer, rows = future.result()
+            merged.merge(reducer)
+            scanned += rows
+            if progress:
+                elapsed = time.perf_counter() - started
+                progress(done, len(tasks), scanned, elapsed)
+    return merged.result()
+
+
+def write_output(rows, fmt, out):
+    stream = open(out, 'w', encoding='utf-8', newline='') if out else sys.stdout
+    try:
+        if fmt == 'json':
+            json.dump(rows, stream, ensure_ascii=False, indent=2)
+            stream.write('\n')
+        elif rows:
+            writer = csv.DictWriter(stream, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    finally:
+        if out:
+            stream.close()
+
+
+def _print_progress(done, total, scanned, elapsed):
+    rate = scanned / elapsed if elapsed else 0
+    print(f"\r[{done}/{total}] 已掃描 {scanned:,} 列（{rate:,.0f} 列/秒）", end='', file=sys.stderr, flush=True)
+    if done == total:
+        print(file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='提及資料離線分析')
+    parser.add_argument('report', choices=sorted(REPORTS))
+    parser.add_argument('--db', nargs='+', help='資料庫檔案（預設為 DB_SHARDS 設定的所有分片）')
+    parser.add_argument('--since', help='起始時間（ISO 8601，顯示時區）')
+    parser.add_argument('--until', help='結束時間（ISO 8601，顯示時區，不含）')
+    parser.add_argument('--group', help='只分析指定群組')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunks', type=int, help='切分段數（預設為 workers × 4）')
+    parser.add_argument('--window-hours', type=float, default=168, help='mention-back：超過此時間視為沒有回提及')
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv')
+    parser.add_argument('--out', help='輸出檔案（預設為標準輸出）')
+    args = parser.parse_args()
+
+    db_paths = args.db or shards.ShardSet.from_env(mention_writer.DB_PATH).paths
+    since = timeutil.to_ms(datetime.fromisoformat(args.since)) if args.since else None
+    until = timeutil.to_ms(datetime.fromisoformat(args.until)) if args.until else None
+
+    started = time.perf_counter()
+    rows = run_report(db_paths, args.report, args.workers, args.chunks, since, until, args.group,
+                      int(args.window_hours * 3600 * 1000), _print_progress)
+    write_output(rows, args.format, args.out)
+    print(f"完成：{len(rows)} 列結果，耗時 {time.perf_counter() - started:.2f} 秒", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
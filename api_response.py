@@ -0,0 +1,164 @@
+"""
+前台 JSON API 的回應處理
+欄位投影（fields=）、訊息截斷（truncate=）、統計資料精簡格式與回應壓縮
+"""
+
+import gzip
+from datetime import datetime
+
+import hll
+
+try:
+    import brotli
+except ImportError:  # brotli 為選用套件，未安裝時只使用 gzip
+    brotli = None
+
+# 回應小於此大小時不壓縮（壓縮標頭與 CPU 成本不划算）
+COMPRESS_MIN_SIZE = 1024
+COMPRESSIBLE_TYPES = ('application/json', 'text/html', 'text/plain')
+
+MENTION_FIELDS = ('user_id', 'user_name', 'group_id', 'message', 'mentioned_at', 'message_id')
+
+
+class InvalidQueryError(ValueError):
+    """查詢參數不合法"""
+
+
+def parse_fields(value, allowed=MENTION_FIELDS):
+    """解析 fields= 參數；未指定時回傳 None（表示全部欄位）"""
+    if not value:
+        return None
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise InvalidQueryError(f"未知的欄位: {', '.join(unknown)}")
+    return fields
+
+
+def parse_int(value, name, minimum=0, maximum=None, default=None):
+    """解析非負整數參數"""
+    if value in (None, ''):
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise InvalidQueryError(f"{name} 必須是整數")
+    if number < minimum:
+        raise InvalidQueryError(f"{name} 不可小於 {minimum}")
+    return min(number, maximum) if maximum is not None else number
+
+
+def parse_datetime(value, name):
+    """解析 ISO 8601 時間參數；未指定時回傳 None"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise InvalidQueryError(f"{name} 必須是 ISO 8601 時間，例如 2024-01-01T10:00")
+
+
+def truncate_text(text, length):
+    if text is None or length is None or len(text) <= length:
+        return text
+    return text[:length] + '…'
+
+
+def project_mentions(records, fields=None, truncate=None):
+    """只保留指定欄位，並將訊息截斷為預覽長度"""
+    if fields is None and truncate is None:
+        return records
+    keys = fields or MENTION_FIELDS
+    projected = []
+    for record in records:
+        item = {key: record[key] for key in keys}
+        if truncate is not None and 'message' in item:
+            item['message'] = truncate_text(item['message'], truncate)
+        projected.append(item)
+    return projected
+
+
+def compact_statistics(statistics):
+    """統計資料的精簡格式：排行改為 [名稱, 次數] 陣列"""
+    compact = dict(statistics)
+    compact['top_users'] = [[user['user_name'], user['count']] for user in statistics['top_users']]
+    compact['top_users_columns'] = ['user_name', 'count']
+    return compact
+
+
+def unique_users_response(count, group_id, start, end, exact):
+    """相異使用者數的回應格式；估計值附上相對標準誤差"""
+    return {
+        'group_id': group_id,
+        'start': start.date().isoformat(),
+        'end': end.date().isoformat(),
+        'unique_users': count,
+        'exact': exact,
+        'relative_error': 0 if exact else round(hll.RELATIVE_ERROR, 4),
+    }
+
+
+def _accepted_encodings(accept_encoding):
+    """解析 Accept-Encoding 為 {編碼: q 值}（未指定 q 為 1，格式錯誤的 q 視為 0）"""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        name, *params = [item.strip() for item in part.split(';')]
+        if not name:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.lower()] = quality
+    return accepted
+
+
+def choose_encoding(accept_encoding):
+    """依 Accept-Encoding 選擇壓縮方式：q 值較高者優先，相同時優先 brotli；q=0 表示不接受"""
+    accepted = _accepted_encodings(accept_encoding)
+    wildcard = accepted.get('*', 0.0)
+    best, best_quality = None, 0.0
+    for encoding in ('br', 'gzip'):
+        if encoding == 'br' and brotli is None:
+            continue
+        quality = accepted.get(encoding, wildcard)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress_payload(payload, accept_encoding, content_type='application/json'):
+    """壓縮回應內容；回傳 (內容, Content-Encoding 或 None)"""
+    if len(payload) < COMPRESS_MIN_SIZE or not content_type.startswith(COMPRESSIBLE_TYPES):
+        return payload, None
+    encoding = choose_encoding(accept_encoding)
+    if encoding == 'br':
+        return brotli.compress(payload, quality=5), encoding
+    if encoding == 'gzip':
+        return gzip.compress(payload, compresslevel=6), encoding
+    return payload, None
+
+
+def init_compression(app):
+    """為 Flask app 註冊回應壓縮"""
+    from flask import request
+
+    @app.after_request
+    def compress_response(response):
+        if (response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers or response.status_code < 200
+                or response.status_code in (204, 304)):
+            return response
+        response.vary.add('Accept-Encoding')
+        payload, encoding = compress_payload(response.get_data(), request.headers.get('Accept-Encoding'),
+                                             response.mimetype or '')
+        if encoding:
+            response.set_data(payload)
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+    return app
@@ -1,22 +1,70 @@
-from flask import Flask, request, render_template, jsonify
-from linebot.exceptions import InvalidSignatureError
+from flask import Flask, request, render_template, jsonify, Response
+import json
+import logging
 import os
 from dotenv import load_dotenv
-from line_bot_handler import LineBotMentionHandler, DatabaseManager
+import admission
+import api_response
+import hll
+import mention_writer
+import recent_feed
+import tenants
+import trending
 
 # 載入環境變數
 load_dotenv()
 
+# 設定日誌
+logging.basicConfig(level=logging.INFO)
+
 app = Flask(__name__)
+api_response.init_compression(app)
+
+# 准入控制：webhook 突發時限制並行請求數並分段降級，API 超量時快速回應 503
+admission_controller = admission.AdmissionController.from_env()
+admission.init_admission(app, admission_controller)
+
+# 快速冷啟動：LINE SDK 匯入、處理器建立與資料庫初始化延後到第一次使用
+FAST_STARTUP = os.getenv('FAST_STARTUP') == '1'
+
+# 頻道設定：設定 LINE_CHANNELS_FILE 時同一程序服務多個 LINE 頻道，否則為單一頻道
+channel_registry = tenants.ChannelRegistry.from_env()
+
+def get_line_bot_handler(channel=None, destination=None):
+    """取得頻道的 LINE Bot 處理器（第一次呼叫時建立）"""
+    def create(config):
+        from line_bot_handler import LineBotMentionHandler
+        return LineBotMentionHandler(config.access_token, config.channel_secret, config.db_path, config.name)
+    return channel_registry.resource('handler', channel_registry.resolve(channel, destination), create)
+
+def get_db_manager(channel=None):
+    """取得頻道的資料庫管理器（第一次呼叫時建立並初始化資料庫）"""
+    def create(config):
+        from line_bot_handler import DatabaseManager
+        return DatabaseManager(config.db_path)
+    return channel_registry.resource('db_manager', channel_registry.resolve(channel), create)
+
+# 熱門提及（滑動視窗，記憶體內），由寫入路徑在每次寫入成功後更新；每個頻道（資料庫）各自統計
+trending_trackers = {
+    config.db_path: trending.TrendingTracker(max_groups=int(os.getenv('TRENDING_MAX_GROUPS', 500)))
+    for config in channel_registry.channels.values()
+}
+
+def record_trending(rows, db_path):
+    if db_path in trending_trackers:
+        trending_trackers[db_path].record_rows(rows)
+
+mention_writer.add_listener(record_trending)
 
 # 初始化 LINE Bot 處理器和資料庫管理器
-line_bot_handler = LineBotMentionHandler(
-    os.getenv('LINE_CHANNEL_ACCESS_TOKEN'),
-    os.getenv('LINE_CHANNEL_SECRET')
-)
-db_manager = DatabaseManager()
+if not FAST_STARTUP:
+    for name in channel_registry.channels:
+        get_line_bot_handler(name)
+        get_db_manager(name)
 
-# 資料庫已由 DatabaseManager 初始化
+@app.errorhandler(tenants.UnknownChannelError)
+def unknown_channel(error):
+    return jsonify({'error': str(error)}), 404
 
 @app.route("/")
 def index():
@@ -29,13 +77,25 @@ def test():
     return render_template('test.html')
 
 @app.route("/webhook", methods=['POST'])
-def callback():
-    """LINE Bot Webhook 端點"""
+@app.route("/webhook/<channel>", methods=['POST'])
+def callback(channel=None):
+    """LINE Bot Webhook 端點（未指定頻道時依請求內容的 destination 對應頻道）"""
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
     
+    from linebot.exceptions import InvalidSignatureError
+    
+    destination = None
+    if channel is None:
+        try:
+            destination = json.loads(body).get('destination')
+        except (ValueError, AttributeError):
+            pass
+    
     try:
-        line_bot_handler.handler.handle(body, signature)
+        # 一次解析整個請求的事件，批次儲存與回覆
+        get_line_bot_handler(channel, destination).handle_webhook(body, signature, admission.current_level(),
+                                                                  admission.is_deferred())
     except InvalidSignatureError:
         return 'Invalid signature', 400
     
@@ -45,13 +105,82 @@ def callback():
 
 @app.route("/api/mentioned-users")
 def get_mentioned_users():
-    """API 端點：獲取所有被提及的使用者資料"""
-    return jsonify(db_manager.get_recent_mentions(50))
+    """API 端點：獲取所有被提及的使用者資料（支援 fields、truncate、limit 參數）"""
+    try:
+        fields = api_response.parse_fields(request.args.get('fields'))
+        truncate = api_response.parse_int(request.args.get('truncate'), 'truncate')
+        limit = api_response.parse_int(request.args.get('limit'), 'limit', minimum=1, maximum=50, default=50)
+    except api_response.InvalidQueryError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    db_manager = get_db_manager(request.args.get('channel'))
+    if fields is None and truncate is None:
+        # 未指定欄位與截斷時直接組合預先序列化的 JSON
+        return Response(recent_feed.to_json(db_manager.recent_mentions.latest(limit)), mimetype='application/json')
+    mentions = db_manager.get_recent_mentions(limit)
+    return jsonify(api_response.project_mentions(mentions, fields, truncate))
 
 @app.route("/api/statistics")
 def get_statistics():
-    """API 端點：獲取統計資料"""
-    return jsonify(db_manager.get_mention_statistics())
+    """API 端點：獲取統計資料（format=compact 時排行改為陣列格式，exact=true 時使用者與群組數量精確計算）"""
+    db_manager = get_db_manager(request.args.get('channel'))
+    statistics = db_manager.get_mention_statistics(request.args.get('exact') == 'true')
+    if request.args.get('format') == 'compact':
+        statistics = api_response.compact_statistics(statistics)
+    return jsonify(statistics)
+
+@app.route("/api/timeseries")
+def get_timeseries():
+    """API 端點：提及次數時間序列（resolution、start、end、group_id、user_id）"""
+    resolution = request.args.get('resolution', 'hour')
+    try:
+        start = api_response.parse_datetime(request.args.get('start'), 'start')
+        end = api_response.parse_datetime(request.args.get('end'), 'end')
+        buckets = get_db_manager(request.args.get('channel')).get_timeseries(
+            resolution, start, end, request.args.get('group_id'), request.args.get('user_id'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({
+        'resolution': resolution,
+        'group_id': request.args.get('group_id'),
+        'user_id': request.args.get('user_id'),
+        'buckets': buckets
+    })
+
+@app.route("/api/unique-users")
+def get_unique_users():
+    """API 端點：期間內被提及的相異使用者數（group_id、start、end、exact=true 時精確計算）"""
+    group_id = request.args.get('group_id')
+    exact = request.args.get('exact') == 'true'
+    try:
+        start = api_response.parse_datetime(request.args.get('start'), 'start')
+        end = api_response.parse_datetime(request.args.get('end'), 'end')
+        start, end = hll.day_range(start, end)
+        count = get_db_manager(request.args.get('channel')).get_unique_users(group_id, start, end, exact)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(api_response.unique_users_response(count, group_id, start, end, exact))
+
+@app.route("/api/trending")
+def get_trending():
+    """API 端點：目前熱門的被提及使用者（window=5m / 1h / 24h、group_id、limit）"""
+    window = request.args.get('window', '1h')
+    try:
+        limit = api_response.parse_int(request.args.get('limit'), 'limit', minimum=1, maximum=50, default=10)
+        db_path = channel_registry.resolve(request.args.get('channel')).db_path
+        users = trending_trackers[db_path].top(window, request.args.get('group_id'), limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({
+        'window': window,
+        'group_id': request.args.get('group_id'),
+        'users': users
+    })
+
+@app.route("/api/admission")
+def get_admission():
+    """API 端點：准入控制狀態與捨棄、降級計數"""
+    return jsonify(admission_controller.snapshot())
 
 if __name__ == "__main__":
     # 雲端部署設定
@@ -1,41 +1,91 @@
-from flask import Flask, request, render_template, jsonify
-import sqlite3
+import time
+
+# 記錄匯入開始時間，供冷啟動分析
+STARTUP_STARTED = time.perf_counter()
+
+from flask import Flask, request, render_template, jsonify, send_file, Response
+import hmac
 import json
 import os
 import re
-from datetime import datetime
+import threading
+from collections import Counter
 from dotenv import load_dotenv
-import requests
+import admission
+import api_response
+import digests
+import hll
+import journal
+import mention_writer
+import line_api
+import notifier
+import partitions
+import recent_feed
+import rollups
+import roster
+import shards
+import snapshots
+import timeutil
+import trending
+from chat_commands import ChatCommands, parse_command
+from reply_policy import ReplyPolicy, merge_by_group
 
 # 載入環境變數
 load_dotenv()
 
 app = Flask(__name__)
+api_response.init_compression(app)
+
+# 准入控制：webhook 突發時限制並行請求數並分段降級，API 超量時快速回應 503
+admission_controller = admission.AdmissionController.from_env()
+admission.init_admission(app, admission_controller)
 
 # LINE Bot 設定
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
 LINE_CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET')
+LINE_API_BASE_URL = os.getenv('LINE_API_BASE_URL', 'https://api.line.me')
+
+# 快速冷啟動：資料庫初始化與背景工作延後到第一個請求
+FAST_STARTUP = os.getenv('FAST_STARTUP') == '1'
+
+# 啟動各階段耗時（秒），由 /api/startup 提供
+startup_profile = {
+    'fast_startup': FAST_STARTUP,
+    'import_seconds': None,
+    'init_db_seconds': None,
+    'schema_ddl_executed': None,
+    'background_seconds': None,
+    'background': None,
+    'first_request_seconds': None,
+}
+startup_lock = threading.Lock()
+
+# 提及記錄分片（DB_SHARDS > 1 時依 group_id 分散到多個資料庫檔案）
+shard_set = shards.ShardSet.from_env(mention_writer.DB_PATH)
 
 # 初始化資料庫
 def init_db():
-    conn = sqlite3.connect('line_data.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS mentioned_users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            user_name TEXT,
-            group_id TEXT,
-            message TEXT,
-            mentioned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            message_id TEXT
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    """初始化資料庫（結構已是最新版本時不執行 DDL）"""
+    started = time.perf_counter()
+    startup_profile['schema_ddl_executed'] = shard_set.ensure_schema()
+    startup_profile['init_db_seconds'] = time.perf_counter() - started
 
 # 初始化資料庫
-init_db()
+if not FAST_STARTUP:
+    init_db()
+
+@app.before_request
+def prepare_first_request():
+    """第一個請求時完成延後的初始化與背景工作，並記錄冷啟動耗時（ASGI 應用程式也會呼叫）"""
+    if startup_profile['first_request_seconds'] is not None:
+        return
+    with startup_lock:
+        if startup_profile['first_request_seconds'] is not None:
+            return
+        if FAST_STARTUP:
+            init_db()
+            start_background()
+        startup_profile['first_request_seconds'] = time.perf_counter() - STARTUP_STARTED
 
 @app.route("/")
 def index():
@@ -55,46 +105,183 @@ def callback():
         body = request.get_data(as_text=True)
         data = json.loads(body)
         
-        # 處理訊息事件
-        for event in data.get('events', []):
-            if event['type'] == 'message' and event['message']['type'] == 'text':
-                handle_message(event)
+        # 同一個請求中的所有事件一起處理（依准入控制的降級等級略過回覆或通知）
+        if admission.is_deferred() and defer_webhook(body):
+            return 'OK'
+        if partition_pool is not None:
+            dispatch_webhook(data.get('events', []), admission.current_level(), body)
+        else:
+            handle_events(data.get('events', []), admission.current_level(), body)
         
         return 'OK'
     except Exception as e:
         print(f"Webhook 處理錯誤: {e}")
         return 'Error', 500
 
+def handle_events(events, level=admission.NORMAL, body=None):
+    """批次處理一個 webhook 請求中的 LINE 訊息事件（body 為原始內容，寫入日誌）"""
+    acknowledgements = record_webhook(events, level, body)
+    send_replies(acknowledgements, events, level)
+
+def send_replies(acknowledgements, events, level=admission.NORMAL):
+    """回覆確認訊息與群組內指令（降級時略過）"""
+    if level >= admission.SKIP_REPLIES:
+        # 降級時略過確認回覆，只保留提及記錄
+        return
+    for group_id, reply_token, mentioned_users in acknowledgements:
+        try:
+            # 回覆確認訊息（同一群組的多個事件合併為一則）
+            reply_message(reply_token, mentioned_users, group_id)
+        except Exception as e:
+            print(f"回覆訊息時發生錯誤: {e}")
+    for reply_token, reply_text in answer_commands(events):
+        try:
+            send_reply_text(reply_token, reply_text)
+        except Exception as e:
+            print(f"回覆指令時發生錯誤: {e}")
+
 def handle_message(event):
-    """處理 LINE 訊息事件"""
+    """處理單一 LINE 訊息事件"""
+    handle_events([event])
+
+def record_webhook(events, level=admission.NORMAL, body=None):
+    """先將 webhook 內容寫入日誌再處理；提及記錄全部儲存成功後才提交位移
+
+    寫入失敗時由日誌的背景執行緒重試（失敗多次後移到 dead-letter），
+    程序在處理途中結束時，重新啟動會重播該請求（recover_journal）。
+    """
+    offset = None
+    if body is not None and webhook_journal is not None:
+        offset = webhook_journal.append(body.encode('utf-8'))
     try:
-        # 檢查是否為群組訊息
-        if 'source' in event and 'groupId' in event['source']:
-            group_id = event['source']['groupId']
-            user_id = event['source']['userId']
-            message_text = event['message']['text']
-            
-            print(f"收到群組訊息: {message_text}")
-            
-            # 檢查是否包含 @ 提及
-            if '@' in message_text:
-                mentioned_users = parse_mentions(message_text, group_id)
-                
-                if mentioned_users:
-                    # 儲存提及記錄
-                    save_mentions(mentioned_users, group_id, message_text, event['message']['id'])
-                    
-                    # 回覆確認訊息
-                    reply_message(event['replyToken'], mentioned_users)
-                    
-                    print(f"已記錄 {len(mentioned_users)} 個提及")
+        acknowledgements, complete = record_events(events, level)
+    except Exception:
+        if offset is not None:
+            webhook_journal.fail(offset, body.encode('utf-8'))
+        raise
+    if offset is not None:
+        if complete:
+            webhook_journal.commit(offset)
+        else:
+            webhook_journal.fail(offset, body.encode('utf-8'))
+    return acknowledgements
+
+def defer_webhook(body):
+    """過載時只將 webhook 寫入日誌，由日誌的背景執行緒以 PERSIST_ONLY 處理；回傳是否已延後
+
+    未啟用日誌或分區處理模式（分派本身即不等待處理）時回傳 False，由呼叫端照常處理。
+    """
+    if webhook_journal is None or partition_pool is not None:
+        return False
+    webhook_journal.defer(webhook_journal.append(body.encode('utf-8')), body.encode('utf-8'))
+    return True
+
+def record_events(events, level=admission.NORMAL):
+    """解析並儲存一批事件中的 @ 提及
+
+    所有事件的提及記錄以一次寫入儲存、通知以一次交易排入；
+    單一事件解析或寫入失敗不影響其他事件。
+    level 為 admission.PERSIST_ONLY 時只儲存提及記錄，不排入通知。
+    回傳 (依群組合併的 (group_id, reply_token, mentioned_users) 列表, 是否全部儲存成功)。
+    """
+    parsed = []
+    for event in events:
+        try:
+            mentioned_users = parse_event(event)
+        except Exception as e:
+            print(f"處理訊息時發生錯誤: {e}")
+            continue
+        if mentioned_users:
+            parsed.append((event, mentioned_users))
+    if not parsed:
+        return [], True
+    
+    # 儲存提及記錄
+    written = save_mentions(parsed)
+    recorded = [item for item, ok in zip(parsed, written) if ok]
+    
+    # 通知被提及者
+    if NOTIFY_MENTIONS and recorded and level < admission.PERSIST_ONLY:
+        queue_notifications(recorded)
+    
+    print(f"已記錄 {sum(len(users) for _, users in recorded)} 個提及（{len(recorded)} 則訊息）")
+    return merge_by_group([
+        (event['source']['groupId'], event['replyToken'], mentioned_users)
+        for event, mentioned_users in recorded
+    ]), all(written)
+
+def parse_event(event):
+    """解析單一事件中的 @ 提及（非群組文字訊息或沒有提及時回傳空列表）"""
+    if event.get('type') != 'message' or event['message']['type'] != 'text':
+        return []
+    
+    # 檢查是否為群組訊息
+    if 'source' not in event or 'groupId' not in event['source']:
+        return []
+    
+    group_id = event['source']['groupId']
+    message_text = event['message']['text']
+    
+    print(f"收到群組訊息: {message_text}")
+    
+    # 更新群組成員名冊（LINE 提供的提及位置，以及背景補齊名冊）
+    mentionees = (event['message'].get('mention') or {}).get('mentionees') or []
+    roster_cache.learn_mentionees(group_id, message_text, [
+        (mentionee['index'], mentionee['length'], mentionee['userId'])
+        for mentionee in mentionees if mentionee.get('userId')
+    ])
+    roster_cache.observe(group_id, event['source'].get('userId'))
+    
+    # 檢查是否包含 @ 提及（群組內指令不記錄為提及）
+    if '@' not in message_text or parse_command(message_text):
+        return []
+    
+    return parse_mentions(message_text, group_id)
+
+def answer_commands(events):
+    """回答一批事件中的群組內指令，回傳 [(reply_token, 回覆文字)]"""
+    answers = []
+    for event in events:
+        if event.get('type') != 'message' or event['message']['type'] != 'text':
+            continue
+        source = event.get('source', {})
+        reply_text = chat_commands.answer(source.get('groupId'), source.get('userId'), event['message']['text'])
+        if reply_text:
+            answers.append((event['replyToken'], reply_text))
+    return answers
+
+def queue_notifications(recorded):
+    """將提及通知排入佇列，由背景派送器批次送出"""
+    try:
+        notification_queue.enqueue_many([
+            (mentioned_users, event['source']['groupId'], event['message']['text'],
+             event['message']['id'], event['source'].get('userId'))
+            for event, mentioned_users in recorded
+        ])
     except Exception as e:
-        print(f"處理訊息時發生錯誤: {e}")
+        print(f"排入提及通知時發生錯誤: {e}")
 
 def parse_mentions(text, group_id):
-    """解析訊息中的 @ 提及"""
+    """解析訊息中的 @ 提及
+
+    先以群組成員名冊比對（名稱可含空白，對應到真正的使用者 ID）；
+    名冊不完整時，其餘的 @ 文字以正則表達式解析，並以名稱作為 ID。
+    """
     mentioned_users = []
     
+    for start, end, user_id, user_name in roster_cache.find(group_id, text):
+        if not any(user['user_id'] == user_id for user in mentioned_users):
+            mentioned_users.append({
+                'user_name': user_name,
+                'user_id': user_id,
+                'group_id': group_id
+            })
+        # 已對應到成員的部分不再以正則表達式解析
+        text = text[:start] + ' ' * (end - start) + text[end:]
+    if roster_cache.is_complete(group_id):
+        # 完整名冊中沒有的 @ 文字不是群組成員
+        return mentioned_users
+    
     # 多種提及格式的正則表達式
     mention_patterns = [
         r'@(\w+)',  # @英文名稱
@@ -116,31 +303,15 @@ def parse_mentions(text, group_id):
     
     return mentioned_users
 
-def save_mentions(mentioned_users, group_id, message, message_id):
-    """儲存提及記錄到資料庫"""
-    try:
-        conn = sqlite3.connect('line_data.db')
-        cursor = conn.cursor()
-        
-        for user in mentioned_users:
-            cursor.execute('''
-                INSERT INTO mentioned_users 
-                (user_id, user_name, group_id, message, message_id, mentioned_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                user['user_id'],
-                user['user_name'],
-                group_id,
-                message,
-                message_id,
-                datetime.now().isoformat()
-            ))
-        
-        conn.commit()
-        conn.close()
-        
-    except Exception as e:
-        print(f"儲存提及記錄時發生錯誤: {e}")
+def save_mentions(parsed):
+    """儲存一批事件的提及記錄到資料庫，回傳每個事件是否儲存成功"""
+    batches = [
+        mention_writer.build_mention_rows(mentioned_users, event['source']['groupId'],
+                                          event['message']['text'], event['message']['id'],
+                                          event.get('timestamp'), event['source'].get('userId'))
+        for event, mentioned_users in parsed
+    ]
+    return shard_set.submit_mention_batches(batches)
 
 def is_similar_name(name1, name2):
     """檢查兩個名稱是否相似（可能是同一個人）"""
@@ -161,164 +332,321 @@ def is_similar_name(name1, name2):
     
     return False
 
-def reply_message(reply_token, mentioned_users):
-    """回覆 LINE 訊息"""
+def build_reply_text(mentioned_users):
+    """生成回覆訊息"""
+    if len(mentioned_users) == 1:
+        return f"✅ 已記錄 @{mentioned_users[0]['user_name']} 的提及"
+    names = [f"@{user['user_name']}" for user in mentioned_users]
+    return f"✅ 已記錄 {len(mentioned_users)} 位使用者的提及: {', '.join(names)}"
+
+def build_reply_request(reply_token, reply_text):
+    """組出 LINE Messaging API 回覆請求的 URL、標頭與內容"""
+    url = f'{LINE_API_BASE_URL}/v2/bot/message/reply'
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {LINE_CHANNEL_ACCESS_TOKEN}'
+    }
+    data = {
+        'replyToken': reply_token,
+        'messages': [
+            {
+                'type': 'text',
+                'text': reply_text
+            }
+        ]
+    }
+    return url, headers, data
+
+def send_reply_text(reply_token, reply_text):
+    """以 LINE Messaging API 送出回覆，失敗時拋出 RuntimeError"""
+    response = line_client.reply_text(reply_token, reply_text)
+    if response.status_code != 200:
+        raise RuntimeError(f"回覆訊息失敗: {response.status_code}")
+
+def reply_message(reply_token, mentioned_users, group_id=None):
+    """回覆 LINE 訊息（依群組回覆策略決定立即回覆、合併或不回覆）"""
     try:
-        if len(mentioned_users) == 1:
-            reply_text = f"✅ 已記錄 @{mentioned_users[0]['user_name']} 的提及"
-        else:
-            names = [f"@{user['user_name']}" for user in mentioned_users]
-            reply_text = f"✅ 已記錄 {len(mentioned_users)} 位使用者的提及: {', '.join(names)}"
-        
-        # 使用 LINE Messaging API 回覆
-        url = 'https://api.line.me/v2/bot/message/reply'
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {LINE_CHANNEL_ACCESS_TOKEN}'
-        }
-        data = {
-            'replyToken': reply_token,
-            'messages': [
-                {
-                    'type': 'text',
-                    'text': reply_text
-                }
-            ]
-        }
-        
-        response = requests.post(url, headers=headers, json=data)
-        if response.status_code != 200:
-            print(f"回覆訊息失敗: {response.status_code}")
+        reply_text = reply_policy.acknowledge(group_id, reply_token, mentioned_users)
+        if reply_text:
+            try:
+                send_reply_text(reply_token, reply_text)
+            except Exception:
+                reply_policy.record_reply(False)
+                raise
+            reply_policy.record_reply(True)
             
     except Exception as e:
         print(f"回覆訊息時發生錯誤: {e}")
 
+# LINE API 客戶端（共用連線池）與回覆策略
+line_client = line_api.LineApiClient(
+    LINE_CHANNEL_ACCESS_TOKEN,
+    LINE_API_BASE_URL,
+    quota=line_api.MessageQuota(monthly_limit=int(os.getenv('LINE_MONTHLY_QUOTA', line_api.DEFAULT_MONTHLY_QUOTA)))
+)
+reply_policy = ReplyPolicy.from_env(send_reply_text, build_reply_text)
+
+# 提及通知（NOTIFY_MENTIONS=1 時啟用）
+NOTIFY_MENTIONS = os.getenv('NOTIFY_MENTIONS') == '1'
+notification_queue = notifier.NotificationQueue(dedup_window=int(os.getenv('NOTIFY_DEDUP_SECONDS', 600)))
+notification_dispatcher = notifier.NotificationDispatcher(notification_queue, line_client)
+
+# 群組成員名冊：把「@顯示名稱」對應到使用者 ID（ROSTER_FETCH_MEMBERS=1 時以 LINE API 補齊）
+roster_cache = roster.RosterCache.from_env(line_client.get_group_member_names, line_client.get_group_member_name)
+
+# 群組內指令（/mentions me、/top week、/stats）：由彙總資料回答，並依群組限制頻率
+def run_group_query(group_id, func, *args):
+    """在群組所屬的分片執行 func(conn, *args)"""
+    return shard_set.map(func, *args, group_id=group_id)[0]
+
+# 定期提及摘要：群組以 /digest 設定每小時或每天送出（DIGEST_INTERVAL=0 時本程序不送出）
+digest_scheduler = digests.DigestScheduler.from_env(shard_set.paths, line_client, shard_set.path_for,
+                                                    roster_cache.name_of)
+
+chat_commands = ChatCommands.from_env(run_group_query, roster_cache.name_of, digest_scheduler,
+                                      notification_queue if NOTIFY_MENTIONS else None)
+
+# 定期刪除過期的細粒度時間桶
+rollup_compactors = [
+    rollups.RollupCompactor(path, int(os.getenv('ROLLUP_COMPACT_INTERVAL', 3600))) for path in shard_set.paths
+]
+
+# 唯讀副本（SNAPSHOT_INTERVAL > 0 時定期以 backup API 分段複製），統計等大量讀取改讀副本
+replica_manager = snapshots.ReplicaManager.from_env(shard_set.paths)
+shard_set.replicas = replica_manager
+
+# 備份下載（設定 BACKUP_TOKEN 後啟用）
+BACKUP_TOKEN = os.getenv('BACKUP_TOKEN')
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', 5))
+backup_lock = threading.Lock()
+
+# 熱門提及（滑動視窗，記憶體內），由寫入路徑在每次寫入成功後更新
+trending_tracker = trending.TrendingTracker(max_groups=int(os.getenv('TRENDING_MAX_GROUPS', 500)))
+mention_writer.add_listener(lambda rows, db_path: trending_tracker.record_rows(rows))
+
+def format_group_display(group_id):
+    """格式化群組 ID 為更易讀的名稱"""
+    if not group_id:
+        return "未知群組"
+    # 如果群組 ID 很長，取前8位並加上省略號
+    if len(group_id) > 12:
+        return f"群組 {group_id[:8]}..."
+    return f"群組 {group_id}"
+
+# 最近提及記錄（每個分片一個環形緩衝），群組名稱在加入時格式化
+recent_feeds = {
+    path: recent_feed.RecentMentions(path, format_group=format_group_display) for path in shard_set.paths
+}
+
+def record_recent(rows, db_path):
+    if db_path in recent_feeds:
+        recent_feeds[db_path].record_rows(rows)
+
+mention_writer.add_listener(record_recent)
+
+# 啟動時由資料庫載入（快速冷啟動時延後到第一次查詢）
+if not FAST_STARTUP:
+    for feed in recent_feeds.values():
+        feed.latest(0)
+
+def query_total_mentions(cursor):
+    """總提及次數"""
+    cursor.execute('SELECT COUNT(*) FROM mentions')
+    return cursor.fetchone()[0]
+
+def query_unique_users(cursor, exact=False):
+    """被提及的使用者數量（預設為 HyperLogLog 估計值，exact=True 時精確計算）"""
+    if exact:
+        return hll.exact(cursor.connection, hll.USERS)
+    return hll.estimate(cursor.connection, hll.USERS)
+
+def query_group_count(cursor, exact=False):
+    """群組數量（預設為 HyperLogLog 估計值，exact=True 時精確計算）"""
+    if exact:
+        return hll.exact(cursor.connection, hll.GROUPS)
+    return hll.estimate(cursor.connection, hll.GROUPS)
+
+def query_name_counts(cursor, limit=20):
+    """各名稱的提及次數（依次數排序，limit 為 None 時回傳全部）"""
+    cursor.execute('''
+        SELECT user_name, COUNT(*) as mention_count
+        FROM mentions
+        GROUP BY user_name
+        ORDER BY mention_count DESC
+        LIMIT ?
+    ''', (-1 if limit is None else limit,))
+    return cursor.fetchall()
+
+def query_top_users(cursor):
+    """最常被提及的使用者（智能合併相似名稱）"""
+    return merge_similar_names(query_name_counts(cursor))
+
+def merge_similar_names(name_counts):
+    """將 (名稱, 次數) 依相似名稱合併，回傳前 10 名"""
+    user_groups = {}
+    for row in name_counts:
+        user_name, count = row
+        
+        # 檢查是否與現有用戶組相似
+        matched = False
+        for group_key in user_groups:
+            if is_similar_name(user_name, group_key):
+                user_groups[group_key]['count'] += count
+                user_groups[group_key]['names'].append(user_name)
+                matched = True
+                break
+        
+        if not matched:
+            user_groups[user_name] = {
+                'count': count,
+                'names': [user_name]
+            }
+    
+    # 轉換為列表格式
+    top_users = []
+    for group_key, group_data in user_groups.items():
+        names = group_data['names']
+        if len(names) > 1:
+            # 使用最長的名稱作為顯示名稱
+            display_name = max(names, key=len)
+            display_name = f"{display_name} ({len(names)}個名稱)"
+        else:
+            display_name = names[0]
+            
+        top_users.append({
+            'user_name': display_name,
+            'count': group_data['count']
+        })
+    
+    # 按提及次數排序並取前10名
+    top_users.sort(key=lambda x: x['count'], reverse=True)
+    return top_users[:10]
+
+def query_today_mentions(cursor):
+    """今日（顯示時區）提及次數；日界線預先算好，以提及時間索引範圍查詢"""
+    cursor.execute('''
+        SELECT COUNT(*) FROM mentioned_users 
+        WHERE mentioned_at >= ? AND mentioned_at < ?
+    ''', timeutil.today_bounds())
+    return cursor.fetchone()[0]
+
+# 統計資料各欄位對應的查詢；各查詢彼此獨立，非同步模式會並行執行
+STATISTICS_QUERIES = {
+    'total_mentions': query_total_mentions,
+    'unique_users': query_unique_users,
+    'group_count': query_group_count,
+    'top_users': query_top_users,
+    'today_mentions': query_today_mentions,
+}
+
+# 以 HyperLogLog 估計的統計欄位（可傳入 exact 參數改為精確計算）
+APPROXIMATE_STATISTICS = ('unique_users', 'group_count')
+
+def statistics_args(key, exact=False):
+    """統計查詢除了 cursor 以外的參數"""
+    return (exact,) if key in APPROXIMATE_STATISTICS else ()
+
+def query_statistics(cursor, exact=False):
+    """依序執行所有統計查詢"""
+    return {key: query(cursor, *statistics_args(key, exact)) for key, query in STATISTICS_QUERIES.items()}
+
+def query_shard_statistics(conn, exact=False):
+    """單一分片的部分統計結果（供跨分片合併）"""
+    cursor = conn.cursor()
+    return {
+        'total_mentions': query_total_mentions(cursor),
+        'users': hll.exact_members(conn, hll.USERS) if exact else hll.registers(conn, hll.USERS),
+        # 同一群組只會在一個分片，精確計數可直接相加
+        'groups': query_group_count(cursor, True) if exact else hll.registers(conn, hll.GROUPS),
+        'name_counts': query_name_counts(cursor, None),
+        'today_mentions': query_today_mentions(cursor),
+    }
+
+def merge_shard_statistics(partials, exact=False):
+    """合併各分片的部分統計結果"""
+    name_counts = Counter()
+    for partial in partials:
+        name_counts.update(dict(partial['name_counts']))
+    if exact:
+        unique_users = len(set().union(*(partial['users'] for partial in partials)))
+        group_count = sum(partial['groups'] for partial in partials)
+    else:
+        unique_users = hll.count_registers(sketch for partial in partials for sketch in partial['users'])
+        group_count = hll.count_registers(sketch for partial in partials for sketch in partial['groups'])
+    return {
+        'total_mentions': sum(partial['total_mentions'] for partial in partials),
+        'unique_users': unique_users,
+        'group_count': group_count,
+        'top_users': merge_similar_names(name_counts.most_common(20)),
+        'today_mentions': sum(partial['today_mentions'] for partial in partials),
+    }
+
+def query_all_statistics(exact=False):
+    """統計資料；分片部署時並行查詢各分片後合併"""
+    if shard_set.count == 1:
+        return shard_set.map(lambda conn: query_statistics(conn.cursor(), exact), replica=True)[0]
+    return merge_shard_statistics(shard_set.map(query_shard_statistics, exact, replica=True), exact)
+
+def query_recent_mentions(limit=50):
+    """最近的提及記錄（由記憶體內的環形緩衝提供）；分片部署時合併各分片的最新記錄"""
+    return [record.to_dict() for record in recent_mention_records(limit)]
+
+def recent_mention_records(limit=50):
+    return recent_feed.merge_latest(list(recent_feeds.values()), limit)
+
+def query_timeseries(resolution, start=None, end=None, group_id=None, user_id=None):
+    """時間序列；指定群組時只查詢其所屬分片，否則合併各分片"""
+    results = shard_set.map(rollups.query, resolution, start, end, group_id, user_id, group_id=group_id)
+    return shards.merge_buckets(results)
+
+def count_unique_users(group_id=None, start=None, end=None, exact=False):
+    """期間內被提及的相異使用者數；分片部署時合併各分片的摘要（精確模式則聯集）"""
+    if exact:
+        members = shard_set.map(hll.exact_members, hll.USERS, group_id, start, end,
+                                group_id=group_id, replica=True)
+        return len(set().union(*members))
+    sketches = shard_set.map(hll.registers, hll.USERS, group_id, start, end, group_id=group_id)
+    return hll.count_registers(sketch for shard_sketches in sketches for sketch in shard_sketches)
+
 @app.route("/api/mentioned-users")
 def get_mentioned_users():
-    """API 端點：獲取所有被提及的使用者資料"""
+    """API 端點：獲取所有被提及的使用者資料
+
+    查詢參數：
+    - fields：只回傳指定欄位（逗號分隔），例如 fields=user_name,mentioned_at
+    - truncate：訊息預覽長度
+    - limit：筆數（最多 50）
+    """
     try:
-        conn = sqlite3.connect('line_data.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT user_id, user_name, group_id, message, mentioned_at, message_id
-            FROM mentioned_users
-            ORDER BY mentioned_at DESC
-            LIMIT 50
-        ''')
-        
-        users = []
-        for row in cursor.fetchall():
-            # 格式化群組 ID 為更易讀的名稱
-            group_id = row[2]
-            if group_id:
-                # 如果群組 ID 很長，取前8位並加上省略號
-                if len(group_id) > 12:
-                    group_display = f"群組 {group_id[:8]}..."
-                else:
-                    group_display = f"群組 {group_id}"
-            else:
-                group_display = "未知群組"
-                
-            users.append({
-                'user_id': row[0],
-                'user_name': row[1],
-                'group_id': group_display,
-                'message': row[3],
-                'mentioned_at': row[4],
-                'message_id': row[5]
-            })
-        
-        conn.close()
-        return jsonify(users)
+        fields = api_response.parse_fields(request.args.get('fields'))
+        truncate = api_response.parse_int(request.args.get('truncate'), 'truncate')
+        limit = api_response.parse_int(request.args.get('limit'), 'limit', minimum=1, maximum=50, default=50)
+    except api_response.InvalidQueryError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        if fields is None and truncate is None:
+            # 未指定欄位與截斷時直接組合預先序列化的 JSON
+            return Response(recent_feed.to_json(recent_mention_records(limit)), mimetype='application/json')
+        users = query_recent_mentions(limit)
+        return jsonify(api_response.project_mentions(users, fields, truncate))
     except Exception as e:
         print(f"提及記錄 API 錯誤: {e}")
         return jsonify([]), 500
 
 @app.route("/api/statistics")
 def get_statistics():
-    """API 端點：獲取統計資料"""
+    """API 端點：獲取統計資料
+
+    查詢參數：format=compact 時排行改為陣列格式；exact=true 時使用者與群組數量改為精確計算
+    """
     try:
-        conn = sqlite3.connect('line_data.db')
-        cursor = conn.cursor()
-        
-        # 總提及次數
-        cursor.execute('SELECT COUNT(*) FROM mentioned_users')
-        total_mentions = cursor.fetchone()[0]
-        
-        # 被提及的使用者數量（按 user_id 分組）
-        cursor.execute('SELECT COUNT(DISTINCT user_id) FROM mentioned_users')
-        unique_users = cursor.fetchone()[0]
-        
-        # 群組數量
-        cursor.execute('SELECT COUNT(DISTINCT group_id) FROM mentioned_users')
-        group_count = cursor.fetchone()[0]
-        
-        # 最常被提及的使用者（智能合併相似名稱）
-        cursor.execute('''
-            SELECT user_name, COUNT(*) as mention_count
-            FROM mentioned_users
-            GROUP BY user_name
-            ORDER BY mention_count DESC
-            LIMIT 20
-        ''')
-        
-        # 智能合併相似名稱
-        user_groups = {}
-        for row in cursor.fetchall():
-            user_name, count = row
-            
-            # 檢查是否與現有用戶組相似
-            matched = False
-            for group_key in user_groups:
-                if is_similar_name(user_name, group_key):
-                    user_groups[group_key]['count'] += count
-                    user_groups[group_key]['names'].append(user_name)
-                    matched = True
-                    break
-            
-            if not matched:
-                user_groups[user_name] = {
-                    'count': count,
-                    'names': [user_name]
-                }
-        
-        # 轉換為列表格式
-        top_users = []
-        for group_key, group_data in user_groups.items():
-            names = group_data['names']
-            if len(names) > 1:
-                # 使用最長的名稱作為顯示名稱
-                display_name = max(names, key=len)
-                display_name = f"{display_name} ({len(names)}個名稱)"
-            else:
-                display_name = names[0]
-                
-            top_users.append({
-                'user_name': display_name,
-                'count': group_data['count']
-            })
-        
-        # 按提及次數排序並取前10名
-        top_users.sort(key=lambda x: x['count'], reverse=True)
-        top_users = top_users[:10]
-        
-        # 今日提及次數
-        cursor.execute('''
-            SELECT COUNT(*) FROM mentioned_users 
-            WHERE DATE(mentioned_at) = DATE('now')
-        ''')
-        today_mentions = cursor.fetchone()[0]
+        statistics = query_all_statistics(request.args.get('exact') == 'true')
         
-        conn.close()
-        
-        return jsonify({
-            'total_mentions': total_mentions,
-            'unique_users': unique_users,
-            'group_count': group_count,
-            'top_users': top_users,
-            'today_mentions': today_mentions
-        })
+        if request.args.get('format') == 'compact':
+            statistics = api_response.compact_statistics(statistics)
+        return jsonify(statistics)
     except Exception as e:
         print(f"統計 API 錯誤: {e}")
         return jsonify({
@@ -330,6 +658,308 @@ def get_statistics():
             'error': str(e)
         }), 500
 
+@app.route("/api/timeseries")
+def get_timeseries():
+    """API 端點：提及次數時間序列
+
+    查詢參數：resolution（minute / hour / day）、start、end（ISO 8601）、group_id、user_id
+    """
+    resolution = request.args.get('resolution', 'hour')
+    group_id = request.args.get('group_id')
+    user_id = request.args.get('user_id')
+    try:
+        start = api_response.parse_datetime(request.args.get('start'), 'start')
+        end = api_response.parse_datetime(request.args.get('end'), 'end')
+        buckets = query_timeseries(resolution, start, end, group_id, user_id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"時間序列 API 錯誤: {e}")
+        return jsonify({'error': str(e)}), 500
+    
+    return jsonify({
+        'resolution': resolution,
+        'group_id': group_id,
+        'user_id': user_id,
+        'buckets': buckets
+    })
+
+@app.route("/api/unique-users")
+def get_unique_users():
+    """API 端點：期間內被提及的相異使用者數
+
+    查詢參數：group_id、start、end（ISO 8601，以日為單位，預設最近 30 天）、exact=true 時精確計算
+    """
+    group_id = request.args.get('group_id')
+    exact = request.args.get('exact') == 'true'
+    try:
+        start = api_response.parse_datetime(request.args.get('start'), 'start')
+        end = api_response.parse_datetime(request.args.get('end'), 'end')
+        start, end = hll.day_range(start, end)
+        count = count_unique_users(group_id, start, end, exact)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"相異使用者 API 錯誤: {e}")
+        return jsonify({'error': str(e)}), 500
+    
+    return jsonify(api_response.unique_users_response(count, group_id, start, end, exact))
+
+@app.route("/api/trending")
+def get_trending():
+    """API 端點：目前熱門的被提及使用者
+
+    查詢參數：window（5m / 1h / 24h）、group_id（未指定為全部群組）、limit
+    """
+    window = request.args.get('window', '1h')
+    group_id = request.args.get('group_id')
+    try:
+        limit = api_response.parse_int(request.args.get('limit'), 'limit', minimum=1, maximum=50, default=10)
+        users = trending_tracker.top(window, group_id, limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'window': window,
+        'group_id': group_id,
+        'users': users
+    })
+
+def quota_status():
+    """本月 LINE 訊息用量、回覆策略與通知佇列統計"""
+    return {
+        'quota': line_client.quota.snapshot(),
+        'reply_policy': reply_policy.snapshot(),
+        'notifications': notification_queue.status_counts()
+    }
+
+@app.route("/api/quota")
+def get_quota():
+    """API 端點：本月 LINE 訊息用量與回覆策略統計"""
+    try:
+        return jsonify(quota_status())
+    except Exception as e:
+        print(f"用量 API 錯誤: {e}")
+        return jsonify({'error': str(e)}), 500
+
+def check_backup_authorization(authorization):
+    """驗證備份下載的 Authorization 標頭；拒絕時回傳 (狀態碼, 錯誤訊息)"""
+    if not BACKUP_TOKEN:
+        return 404, '未啟用備份下載'
+    if not hmac.compare_digest(authorization.encode('utf-8'), f'Bearer {BACKUP_TOKEN}'.encode('utf-8')):
+        return 401, 'unauthorized'
+    return None
+
+def create_backup():
+    """建立時間點備份並回傳檔案路徑（同時只進行一份）"""
+    with backup_lock:
+        return snapshots.create_backup(dict.fromkeys([shard_set.base_path] + shard_set.paths),
+                                       BACKUP_DIR, BACKUP_KEEP,
+                                       replica_manager.pages, replica_manager.pause)
+
+@app.route("/api/backup")
+def download_backup():
+    """API 端點：下載時間點備份（需 Authorization: Bearer <BACKUP_TOKEN>）
+
+    以 backup API 分段複製，不中斷寫入；分片部署時為包含各資料庫的 zip。
+    """
+    denied = check_backup_authorization(request.headers.get('Authorization', ''))
+    if denied:
+        return jsonify({'error': denied[1]}), denied[0]
+    
+    try:
+        path = create_backup()
+    except Exception as e:
+        print(f"備份 API 錯誤: {e}")
+        return jsonify({'error': str(e)}), 500
+    return send_file(os.path.abspath(path), as_attachment=True)
+
+@app.route("/api/snapshots")
+def get_snapshots():
+    """API 端點：唯讀副本狀態"""
+    return jsonify(replica_manager.status())
+
+@app.route("/api/admission")
+def get_admission():
+    """API 端點：准入控制狀態與捨棄、降級計數"""
+    return jsonify(admission_controller.snapshot())
+
+@app.route("/api/chat-commands")
+def get_chat_commands():
+    """API 端點：群組內指令的回答、快取與頻率限制計數"""
+    return jsonify(chat_commands.snapshot())
+
+@app.route("/api/digests")
+def get_digests():
+    """API 端點：提及摘要的排程、待送計數與送出狀態"""
+    try:
+        return jsonify(digest_scheduler.snapshot())
+    except Exception as e:
+        print(f"摘要 API 錯誤: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route("/api/startup")
+def get_startup_profile():
+    """API 端點：冷啟動各階段耗時"""
+    return jsonify(startup_profile)
+
+# webhook 預寫日誌（JOURNAL_DIR，預設 journal；設為空字串停用）
+def is_replayable(body):
+    """日誌壓縮時保留的內容：含有群組文字訊息且可能有 @ 提及"""
+    try:
+        events = json.loads(body).get('events', [])
+    except (ValueError, AttributeError):
+        return False
+    return any(
+        event.get('type') == 'message' and event.get('message', {}).get('type') == 'text'
+        and '@' in event['message'].get('text', '') and 'groupId' in event.get('source', {})
+        for event in events
+    )
+
+def _unstored_events(events):
+    """略過訊息編號已儲存的訊息事件"""
+    message_ids = [event['message']['id'] for event in events if event.get('type') == 'message']
+    if not message_ids:
+        return events
+    stored = set().union(*shard_set.map(_stored_message_ids, message_ids))
+    return [event for event in events
+            if event.get('type') != 'message' or event['message']['id'] not in stored]
+
+def _stored_message_ids(conn, message_ids):
+    placeholders = ','.join('?' * len(message_ids))
+    return {row[0] for row in conn.execute(
+        f'SELECT message_id FROM messages WHERE message_id IN ({placeholders})', message_ids)}
+
+def _delete_messages(path, message_ids):
+    conn = mention_writer.connect(path)
+    try:
+        with conn:
+            placeholders = ','.join('?' * len(message_ids))
+            conn.execute(f'''
+                DELETE FROM mentions WHERE message_ref IN
+                    (SELECT id FROM messages WHERE message_id IN ({placeholders}))
+            ''', message_ids)
+            conn.execute(f'DELETE FROM messages WHERE message_id IN ({placeholders})', message_ids)
+    finally:
+        conn.close()
+
+def _rebuild_aggregates(path):
+    conn = mention_writer.connect(path)
+    try:
+        with conn:
+            rollups.backfill(conn)
+            hll.backfill(conn)
+    finally:
+        conn.close()
+
+def replay_webhooks(bodies, replace=False):
+    """以目前的解析程式重新處理 webhook 內容（不回覆、不通知），回傳處理的訊息事件數
+
+    預設略過已儲存的訊息（以訊息編號判斷）；replace=True 時先刪除已儲存的同一訊息，
+    重新寫入後重建時間序列彙總與相異計數摘要。
+    """
+    written = 0
+    for body in bodies:
+        events = json.loads(body).get('events', [])
+        message_ids = [event['message']['id'] for event in events if event.get('type') == 'message']
+        if replace and message_ids:
+            for path in shard_set.paths:
+                _delete_messages(path, message_ids)
+        elif not replace:
+            events = _unstored_events(events)
+        acknowledgements, complete = record_events(events, admission.PERSIST_ONLY)
+        if not complete:
+            raise RuntimeError("重播的提及記錄未能全部寫入")
+        written += len([event for event in events if event.get('type') == 'message'])
+    if replace:
+        for path in shard_set.paths:
+            _rebuild_aggregates(path)
+    return written
+
+webhook_journal = journal.Journal.from_env(keep=is_replayable)
+
+def recover_journal():
+    """開啟本程序的日誌，並重播已結束程序尚未處理完的 webhook"""
+    if webhook_journal is None:
+        return
+    replay = lambda payload, key: replay_webhooks([payload])
+    webhook_journal.start(replay)
+    webhook_journal.recover(replay)
+
+@app.route("/api/journal")
+def get_journal_status():
+    """API 端點：webhook 日誌的寫入與提交位移"""
+    return jsonify(webhook_journal.status() if webhook_journal is not None else {'enabled': False})
+
+# 依群組分區的多程序處理（PROCESSING_WORKERS > 0 時啟用）：本程序只寫入日誌並分派事件，
+# 同一群組的事件由同一個 worker 程序依序處理；寫入成功的資料列回傳後更新熱門與最近提及
+partition_pool = partitions.PartitionPool.from_env(on_rows=mention_writer.notify_listeners)
+
+def dispatch_webhook(events, level=admission.NORMAL, body=None):
+    """分區處理模式：寫入日誌後將事件交給分區 worker，不等待處理完成
+
+    所有分區回報提及記錄都已儲存後才提交日誌位移；有分區失敗或捨棄時交給日誌重試。
+    """
+    offset = None
+    if body is not None and webhook_journal is not None:
+        offset = webhook_journal.append(body.encode('utf-8'))
+
+    def done(complete):
+        if offset is None:
+            return
+        if complete:
+            webhook_journal.commit(offset)
+        else:
+            webhook_journal.fail(offset, body.encode('utf-8'))
+    partition_pool.submit(events, level, done)
+
+def process_partition_batch(events, level=admission.NORMAL, redelivered=False):
+    """分區 worker 處理同一分區的一批事件並回覆，回傳提及記錄是否全部儲存成功
+
+    redelivered 為 True（原 worker 結束前未回報完成）時略過已儲存的訊息，不重複記錄與回覆；
+    群組內指令不會儲存，無法得知原 worker 是否已回答（reply token 只能使用一次），重送時一律不回答。
+    失敗或放棄的批次由 dispatch_webhook 交給日誌重試（只儲存提及記錄，不回覆）。
+    """
+    if redelivered:
+        events = _unstored_events(events)
+    acknowledgements, complete = record_events(events, level)
+    send_replies(acknowledgements, [] if redelivered else events, level)
+    return complete
+
+@app.route("/api/partitions")
+def get_partitions():
+    """API 端點：分區 worker 狀態與各分區的延遲"""
+    return jsonify(partition_pool.snapshot() if partition_pool is not None else {'enabled': False})
+
+def start_background():
+    """啟動本程序的背景工作（匯入時呼叫；FAST_STARTUP 時延後到第一個請求）
+
+    包含通知派送、摘要排程、時間桶清理、唯讀副本、日誌維護與重播，以及分區 worker；
+    設定為停用的項目不啟動。各項是否啟動與總耗時記錄在 startup_profile，由 /api/startup 提供。
+    """
+    started = time.perf_counter()
+    if NOTIFY_MENTIONS:
+        notification_dispatcher.start()
+    digest_scheduler.start()
+    for rollup_compactor in rollup_compactors:
+        rollup_compactor.start()
+    replica_manager.start()
+    recover_journal()
+    if partition_pool is not None:
+        partition_pool.start()
+    startup_profile['background'] = {
+        'notification_dispatcher': NOTIFY_MENTIONS,
+        'digest_scheduler': digest_scheduler.interval > 0,
+        'rollup_compactors': sum(1 for rollup_compactor in rollup_compactors if rollup_compactor.interval > 0),
+        'replica_manager': replica_manager.enabled,
+        'journal': webhook_journal is not None,
+        'partition_workers': partition_pool.worker_count if partition_pool is not None else 0,
+    }
+    startup_profile['background_seconds'] = time.perf_counter() - started
+
+if not FAST_STARTUP:
+    start_background()
+
 if __name__ == "__main__":
     # 雲端部署設定
     port = int(os.environ.get('PORT', 5000))
@@ -337,4 +967,6 @@ if __name__ == "__main__":
     app.run(debug=debug, host='0.0.0.0', port=port)
 
 # 確保應用程式可以正確啟動
-app.config['SERVER_NAME'] = None 
\ No newline at end of file
+app.config['SERVER_NAME'] = None 
+
+startup_profile['import_seconds'] = time.perf_counter() - STARTUP_STARTED
@@ -0,0 +1,438 @@
+"""
+ASGI 進入點（非同步伺服器模式）
+與 wsgi.py 共用 app_simple 的解析與儲存程式碼：
+SQLite 工作交由專用執行緒池處理，LINE 回覆使用非同步 HTTP 客戶端
+
+啟動方式: uvicorn asgi:app
+"""
+
+import asyncio
+import json
+import logging
+import mimetypes
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+import requests
+from jinja2 import Environment, FileSystemLoader
+
+import admission
+import api_response
+import app_simple
+import hll
+import mention_writer
+import recent_feed
+
+try:
+    import httpx
+except ImportError:  # 未安裝 httpx 時以執行緒池執行 requests
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+# SQLite 專用執行緒池；寫入程序模式下 worker 只做讀取，可以放寬
+DB_EXECUTOR_WORKERS = int(os.getenv('ASGI_DB_WORKERS', 4))
+
+# 備份下載每次送出的大小
+BACKUP_CHUNK_BYTES = 1024 * 1024
+
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='sqlite')
+templates = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), 'templates')))
+
+_http_client = None
+
+
+def _run_db(func, *args):
+    """在 SQLite 執行緒池中執行同步函式"""
+    return asyncio.get_running_loop().run_in_executor(db_executor, func, *args)
+
+
+def _query(query, *args):
+    """開啟讀取連線執行單一統計查詢（副本可用時讀取唯讀副本）"""
+    conn = app_simple.replica_manager.connect(mention_writer.DB_PATH, mention_writer.connect_reader)
+    try:
+        return query(conn.cursor(), *args)
+    finally:
+        conn.close()
+
+
+async def reply_message(group_id, reply_token, mentioned_users):
+    """依回覆策略以非同步 HTTP 客戶端回覆 LINE 訊息"""
+    reply_text = app_simple.reply_policy.acknowledge(group_id, reply_token, mentioned_users)
+    if reply_text:
+        app_simple.reply_policy.record_reply(await send_reply_text(reply_token, reply_text))
+
+
+async def send_reply_text(reply_token, reply_text):
+    """以非同步 HTTP 客戶端送出回覆，回傳是否成功"""
+    try:
+        url, headers, data = app_simple.build_reply_request(reply_token, reply_text)
+
+        if _http_client is not None:
+            response = await _http_client.post(url, headers=headers, json=data)
+        else:
+            response = await asyncio.get_running_loop().run_in_executor(
+                None, lambda: requests.post(url, headers=headers, json=data))
+        if response.status_code == 200:
+            app_simple.line_client.quota.record('reply')
+            return True
+        logger.warning(f"回覆訊息失敗: {response.status_code}")
+    except Exception as e:
+        logger.error(f"回覆訊息時發生錯誤: {e}")
+    return False
+
+
+async def send_acknowledgement(group_id, reply_token, mentioned_users):
+    try:
+        await reply_message(group_id, reply_token, mentioned_users)
+    except Exception as e:
+        logger.error(f"回覆訊息時發生錯誤: {e}")
+
+
+async def callback(body, level=admission.NORMAL, deferred=False):
+    """LINE Bot Webhook 端點：整批事件在執行緒池中一次儲存，再依群組並行回覆
+
+    level 為准入控制的降級等級：SKIP_REPLIES 以上略過回覆，PERSIST_ONLY 另略過通知；
+    deferred（超過排隊時間預算）時只寫入日誌，由背景處理。
+    """
+    try:
+        if deferred and await asyncio.get_running_loop().run_in_executor(None, app_simple.defer_webhook, body):
+            return 200, 'text/plain', 'OK'
+        data = json.loads(body)
+        if app_simple.partition_pool is not None:
+            # 分區處理模式：寫入日誌後交給分區 worker，儲存與回覆由 worker 依群組順序完成
+            await _run_db(app_simple.dispatch_webhook, data.get('events', []), level, body)
+            return 200, 'text/plain', 'OK'
+        acknowledgements = await _run_db(app_simple.record_webhook, data.get('events', []), level, body)
+        if level < admission.SKIP_REPLIES:
+            answers = await _run_db(app_simple.answer_commands, data.get('events', []))
+            await asyncio.gather(*(send_acknowledgement(*ack) for ack in acknowledgements),
+                                 *(send_reply_text(*answer) for answer in answers))
+        return 200, 'text/plain', 'OK'
+    except Exception as e:
+        logger.error(f"Webhook 處理錯誤: {e}")
+        return 500, 'text/plain', 'Error'
+
+
+async def get_mentioned_users(query):
+    """API 端點：獲取所有被提及的使用者資料（支援 fields、truncate、limit 參數）"""
+    try:
+        fields = api_response.parse_fields(query.get('fields'))
+        truncate = api_response.parse_int(query.get('truncate'), 'truncate')
+        limit = api_response.parse_int(query.get('limit'), 'limit', minimum=1, maximum=50, default=50)
+    except api_response.InvalidQueryError as e:
+        return 400, 'application/json', {'error': str(e)}
+
+    try:
+        if fields is None and truncate is None:
+            # 未指定欄位與截斷時直接組合預先序列化的 JSON
+            records = await _run_db(app_simple.recent_mention_records, limit)
+            return 200, 'application/json', recent_feed.to_json(records).encode('utf-8')
+        users = await _run_db(app_simple.query_recent_mentions, limit)
+        return 200, 'application/json', api_response.project_mentions(users, fields, truncate)
+    except Exception as e:
+        logger.error(f"提及記錄 API 錯誤: {e}")
+        return 500, 'application/json', []
+
+
+async def get_statistics(query):
+    """API 端點：獲取統計資料（各統計查詢並行執行，format=compact 時排行改為陣列格式，exact=true 時精確計算）"""
+    keys = list(app_simple.STATISTICS_QUERIES)
+    exact = query.get('exact') == 'true'
+    try:
+        if app_simple.shard_set.count > 1:
+            # 分片部署時由分片查詢執行緒池並行查詢各分片
+            statistics = await _run_db(app_simple.query_all_statistics, exact)
+        else:
+            results = await asyncio.gather(*(
+                _run_db(_query, app_simple.STATISTICS_QUERIES[key], *app_simple.statistics_args(key, exact))
+                for key in keys
+            ))
+            statistics = dict(zip(keys, results))
+        if query.get('format') == 'compact':
+            statistics = api_response.compact_statistics(statistics)
+        return 200, 'application/json', statistics
+    except Exception as e:
+        logger.error(f"統計 API 錯誤: {e}")
+        return 500, 'application/json', {
+            'total_mentions': 0,
+            'unique_users': 0,
+            'group_count': 0,
+            'top_users': [],
+            'today_mentions': 0,
+            'error': str(e)
+        }
+
+
+async def get_timeseries(query):
+    """API 端點：提及次數時間序列（resolution、start、end、group_id、user_id）"""
+    resolution = query.get('resolution', 'hour')
+    group_id = query.get('group_id')
+    user_id = query.get('user_id')
+    try:
+        start = api_response.parse_datetime(query.get('start'), 'start')
+        end = api_response.parse_datetime(query.get('end'), 'end')
+        buckets = await _run_db(app_simple.query_timeseries, resolution, start, end, group_id, user_id)
+    except ValueError as e:
+        return 400, 'application/json', {'error': str(e)}
+    except Exception as e:
+        logger.error(f"時間序列 API 錯誤: {e}")
+        return 500, 'application/json', {'error': str(e)}
+    return 200, 'application/json', {
+        'resolution': resolution,
+        'group_id': group_id,
+        'user_id': user_id,
+        'buckets': buckets
+    }
+
+
+async def get_unique_users(query):
+    """API 端點：期間內被提及的相異使用者數（group_id、start、end、exact=true 時精確計算）"""
+    group_id = query.get('group_id')
+    exact = query.get('exact') == 'true'
+    try:
+        start = api_response.parse_datetime(query.get('start'), 'start')
+        end = api_response.parse_datetime(query.get('end'), 'end')
+        start, end = hll.day_range(start, end)
+        count = await _run_db(app_simple.count_unique_users, group_id, start, end, exact)
+    except ValueError as e:
+        return 400, 'application/json', {'error': str(e)}
+    except Exception as e:
+        logger.error(f"相異使用者 API 錯誤: {e}")
+        return 500, 'application/json', {'error': str(e)}
+    return 200, 'application/json', api_response.unique_users_response(count, group_id, start, end, exact)
+
+
+async def get_trending(query):
+    """API 端點：目前熱門的被提及使用者（記憶體內計算，不需要資料庫執行緒）"""
+    window = query.get('window', '1h')
+    try:
+        limit = api_response.parse_int(query.get('limit'), 'limit', minimum=1, maximum=50, default=10)
+        users = app_simple.trending_tracker.top(window, query.get('group_id'), limit)
+    except ValueError as e:
+        return 400, 'application/json', {'error': str(e)}
+    return 200, 'application/json', {'window': window, 'group_id': query.get('group_id'), 'users': users}
+
+
+async def get_quota(query):
+    """API 端點：本月 LINE 訊息用量與回覆策略統計"""
+    try:
+        return 200, 'application/json', await _run_db(app_simple.quota_status)
+    except Exception as e:
+        logger.error(f"用量 API 錯誤: {e}")
+        return 500, 'application/json', {'error': str(e)}
+
+
+async def get_startup_profile(query):
+    """API 端點：冷啟動各階段耗時"""
+    return 200, 'application/json', app_simple.startup_profile
+
+
+async def download_backup(send, authorization, head=False):
+    """API 端點：下載時間點備份（需 Authorization: Bearer <BACKUP_TOKEN>），分段送出檔案"""
+    denied = app_simple.check_backup_authorization(authorization)
+    if denied:
+        await _send_response(send, denied[0], 'application/json', {'error': denied[1]}, head=head)
+        return
+    try:
+        # 備份可能需要數秒，不佔用 SQLite 執行緒池
+        path = await asyncio.get_running_loop().run_in_executor(None, app_simple.create_backup)
+    except Exception as e:
+        logger.error(f"備份 API 錯誤: {e}")
+        await _send_response(send, 500, 'application/json', {'error': str(e)}, head=head)
+        return
+    name = os.path.basename(path)
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', (mimetypes.guess_type(name)[0] or 'application/octet-stream').encode('latin-1')),
+            (b'content-length', str(os.path.getsize(path)).encode('latin-1')),
+            (b'content-disposition', f'attachment; filename="{name}"'.encode('latin-1')),
+        ],
+    })
+    if head:
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    loop = asyncio.get_running_loop()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = await loop.run_in_executor(None, f.read, BACKUP_CHUNK_BYTES)
+            more = len(chunk) == BACKUP_CHUNK_BYTES
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': more})
+            if not more:
+                return
+
+
+async def get_snapshots(query):
+    """API 端點：唯讀副本狀態"""
+    return 200, 'application/json', app_simple.replica_manager.status()
+
+
+async def get_admission(query):
+    """API 端點：准入控制狀態與捨棄、降級計數"""
+    return 200, 'application/json', app_simple.admission_controller.snapshot()
+
+
+async def get_chat_commands(query):
+    """API 端點：群組內指令的回答、快取與頻率限制計數"""
+    return 200, 'application/json', app_simple.chat_commands.snapshot()
+
+
+async def get_digests(query):
+    """API 端點：提及摘要的排程、待送計數與送出狀態"""
+    try:
+        return 200, 'application/json', await _run_db(app_simple.digest_scheduler.snapshot)
+    except Exception as e:
+        logger.error(f"摘要 API 錯誤: {e}")
+        return 500, 'application/json', {'error': str(e)}
+
+
+async def get_journal_status(query):
+    """API 端點：webhook 日誌的寫入與提交位移"""
+    journal = app_simple.webhook_journal
+    return 200, 'application/json', journal.status() if journal is not None else {'enabled': False}
+
+
+async def get_partitions(query):
+    """API 端點：分區 worker 狀態與各分區的延遲"""
+    pool = app_simple.partition_pool
+    return 200, 'application/json', pool.snapshot() if pool is not None else {'enabled': False}
+
+
+async def render_page(name, query=None):
+    return 200, 'text/html; charset=utf-8', templates.get_template(name).render()
+
+
+async def _read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def _send_response(send, status, content_type, content, accept_encoding=None, extra_headers=None,
+                         head=False):
+    """送出回應；head 為 True（HEAD 請求）時只送出標頭，不送出內容"""
+    if isinstance(content, bytes):
+        payload = content
+    elif content_type == 'application/json':
+        payload = json.dumps(content, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    else:
+        payload = content.encode('utf-8')
+    payload, encoding = api_response.compress_payload(payload, accept_encoding, content_type)
+    headers = [
+        (b'content-type', content_type.encode('latin-1')),
+        (b'content-length', str(len(payload)).encode('latin-1')),
+        (b'vary', b'Accept-Encoding'),
+    ]
+    if encoding:
+        headers.append((b'content-encoding', encoding.encode('latin-1')))
+    for name, value in (extra_headers or {}).items():
+        headers.append((name.lower().encode('latin-1'), value.encode('latin-1')))
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': headers,
+    })
+    await send({'type': 'http.response.body', 'body': b'' if head else payload})
+
+
+async def _lifespan(receive, send):
+    global _http_client
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            if httpx is not None:
+                # 連線池讓回覆呼叫重用 TLS 連線
+                _http_client = httpx.AsyncClient(timeout=10)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            app_simple.reply_policy.flush_all()
+            if app_simple.partition_pool is not None:
+                await asyncio.get_running_loop().run_in_executor(None, app_simple.partition_pool.stop)
+            if _http_client is not None:
+                await _http_client.aclose()
+            db_executor.shutdown(wait=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+GET_ROUTES = {
+    '/': lambda query: render_page('index.html'),
+    '/test': lambda query: render_page('test.html'),
+    '/api/mentioned-users': get_mentioned_users,
+    '/api/statistics': get_statistics,
+    '/api/timeseries': get_timeseries,
+    '/api/unique-users': get_unique_users,
+    '/api/trending': get_trending,
+    '/api/quota': get_quota,
+    '/api/startup': get_startup_profile,
+    '/api/snapshots': get_snapshots,
+    '/api/admission': get_admission,
+    '/api/journal': get_journal_status,
+    '/api/chat-commands': get_chat_commands,
+    '/api/digests': get_digests,
+    '/api/partitions': get_partitions,
+}
+
+
+async def app(scope, receive, send):
+    """ASGI 應用程式"""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    if app_simple.startup_profile['first_request_seconds'] is None:
+        # 與 Flask 的 before_request 相同：FAST_STARTUP 延後的初始化與背景工作在第一個請求時完成
+        await asyncio.get_running_loop().run_in_executor(None, app_simple.prepare_first_request)
+
+    path, method = scope['path'], scope['method']
+    headers = dict(scope.get('headers') or [])
+    accept_encoding = headers.get(b'accept-encoding', b'').decode('latin-1')
+    head = method == 'HEAD'
+
+    # 准入控制：超過並行上限與排隊時間預算時快速回應 503
+    controller = app_simple.admission_controller
+    kind = controller.classify(path)
+    ticket = None
+    if kind is not None:
+        try:
+            ticket = await controller.acquire_async(kind)
+        except admission.Overloaded as e:
+            logger.warning(f"請求過多，捨棄 {path}")
+            await _send_response(send, 503, 'application/json', {'error': 'overloaded'},
+                                 extra_headers=admission.overloaded_headers(e), head=head)
+            return
+    try:
+        await _dispatch(scope, receive, send, path, method, headers, accept_encoding, ticket)
+    finally:
+        if ticket is not None:
+            controller.release(ticket)
+
+
+async def _dispatch(scope, receive, send, path, method, headers, accept_encoding, ticket):
+    if path == '/webhook' and method == 'POST':
+        body = (await _read_body(receive)).decode('utf-8')
+        if ticket is None:
+            response = await callback(body)
+        else:
+            response = await callback(body, ticket.level, ticket.deferred)
+    elif path == '/api/backup' and method in ('GET', 'HEAD'):
+        await download_backup(send, headers.get(b'authorization', b'').decode('latin-1'), method == 'HEAD')
+        return
+    elif path == '/api/backup':
+        response = (405, 'text/plain', 'Method Not Allowed')
+    elif path in GET_ROUTES and method in ('GET', 'HEAD'):
+        query = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        response = await GET_ROUTES[path](query)
+    elif path == '/webhook' or path in GET_ROUTES:
+        response = (405, 'text/plain', 'Method Not Allowed')
+    else:
+        response = (404, 'text/plain', 'Not Found')
+    await _send_response(send, *response, accept_encoding=accept_encoding, head=method == 'HEAD')
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+冷啟動基準測試：從啟動程序到第一個 webhook 完成處理的時間
+
+分別以一般模式與 FAST_STARTUP=1 啟動 gunicorn，量測程序啟動到
+第一個 POST /webhook 回應 200 的時間，並列出 /api/startup 回報的各階段耗時
+與匯入最慢的模組（python -X importtime）。
+
+使用方式:
+    python benchmarks/bench_cold_start.py --runs 5
+"""
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from line_api_emulator import LineApiEmulator  # noqa: E402
+
+WEBHOOK_BODY = json.dumps({'events': [{
+    'type': 'message',
+    'replyToken': 'cold-start-token',
+    'source': {'type': 'group', 'groupId': 'Cbench', 'userId': 'Ubench'},
+    'message': {'type': 'text', 'id': 'cold-start', 'text': 'wake up @bench'},
+}]})
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def request(port, method, path, body=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        conn.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def time_to_first_webhook(workdir, env, timeout=30):
+    """啟動 gunicorn 並輪詢 webhook，回傳 (秒數, /api/startup 內容)"""
+    port = free_port()
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'wsgi:app', '-b', f'127.0.0.1:{port}', '-w', '1'],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                status, _ = request(port, 'POST', '/webhook', WEBHOOK_BODY)
+            except OSError:
+                time.sleep(0.005)
+                continue
+            if status == 200:
+                elapsed = time.perf_counter() - started
+                _, profile = request(port, 'GET', '/api/startup')
+                return elapsed, json.loads(profile)
+        raise RuntimeError('伺服器未在時限內回應 webhook')
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+
+def slowest_imports(env, module='wsgi', top=10):
+    """以 -X importtime 找出應用程式直接匯入的模組中累計時間最長者"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=REPO_ROOT, env=env, capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # importtime 以每層兩個空白縮排表示巢狀匯入；列出 wsgi → app_simple 底下兩層
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth in (2, 3):
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='量測冷啟動到第一個 webhook 的時間')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    emulator = LineApiEmulator().start()
+    base_env = dict(os.environ, PYTHONPATH=REPO_ROOT, LINE_API_BASE_URL=emulator.base_url,
+                    LINE_CHANNEL_ACCESS_TOKEN='bench')
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # 先啟動一次建立資料庫，之後的量測都是「結構已是最新」的情境
+        time_to_first_webhook(workdir, base_env)
+
+        for label, extra in (('default', {}), ('fast_startup', {'FAST_STARTUP': '1'})):
+            env = dict(base_env, **extra)
+            samples, profile = [], None
+            for _ in range(args.runs):
+                elapsed, profile = time_to_first_webhook(workdir, env)
+                samples.append(elapsed)
+            print(f"{label:<13} median {statistics.median(samples) * 1000:7.1f} ms  "
+                  f"min {min(samples) * 1000:7.1f} ms  ({args.runs} runs)")
+            print(f"              last run profile: {json.dumps(profile)}")
+
+        print('\n匯入最慢的模組（累計微秒）:')
+        for cumulative, name in slowest_imports(base_env):
+            print(f"  {cumulative:>8}  {name}")
+
+    emulator.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+對外 LINE API 呼叫的吞吐量與容錯測試
+
+以本機 LINE API 替身（line_api_emulator.py）模擬延遲、錯誤與速率限制，
+量測 line_api.LineApiClient 在各並行數下的回覆、推播、使用者資料與群組成員呼叫，
+以及通知派送器在錯誤注入下清空佇列所需的時間與最終派送狀態。
+
+使用方式:
+    python benchmarks/bench_outbound.py --concurrency 1 10 50 --requests 500
+    python benchmarks/bench_outbound.py --latency lognormal:80:0.5 --error-rate 0.05 --rate-limit 200
+    python benchmarks/bench_outbound.py --scenarios notify --notifications 5000 --error-rate 0.2
+"""
+
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import line_api  # noqa: E402
+import notifier  # noqa: E402
+from line_api_emulator import LineApiEmulator, parse_latency_args  # noqa: E402
+
+SCENARIOS = ('reply', 'push', 'profile', 'members', 'notify')
+
+
+def run_calls(call, requests, concurrency):
+    """以 concurrency 個執行緒呼叫 call(i) 共 requests 次，回傳 (耗時, 各次延遲, 狀態統計)"""
+    latencies = []
+    statuses = Counter()
+
+    def one(i):
+        started = time.perf_counter()
+        try:
+            status = call(i)
+        except Exception as e:
+            status = type(e).__name__
+        latencies.append(time.perf_counter() - started)
+        statuses[status] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(one, range(requests)))
+    return time.perf_counter() - started, latencies, statuses
+
+
+def bench_client_calls(emulator, client, scenario, requests, concurrency, expired_ratio):
+    if scenario == 'reply':
+        # 部分權杖在回覆前已過期（模擬處理太慢才回覆）
+        expired = int(requests * expired_ratio)
+        tokens = [emulator.issue_reply_token(age=emulator.reply_token_ttl + 1 if i < expired else 0)
+                  for i in range(requests)]
+        return run_calls(lambda i: client.reply_text(tokens[i], 'bench').status_code, requests, concurrency)
+    if scenario == 'push':
+        return run_calls(lambda i: client.push(f'U{i:032x}', client.text_messages('bench')).status_code,
+                         requests, concurrency)
+    if scenario == 'profile':
+        return run_calls(lambda i: 200 if client.get_profile(f'U{i:032x}') else 'none', requests, concurrency)
+    # members：每次取得一個群組的完整名冊（成員 ID 分頁 + 每位成員一次資料查詢），
+    # 群組數依成員數縮減，使對外呼叫總數接近 requests
+    groups = max(1, requests // (emulator.members_per_group + 1))
+    return run_calls(lambda i: len(client.get_group_member_names(f'C{i:032x}')) and 200,
+                     groups, concurrency)
+
+
+def bench_notify(emulator, client, notifications):
+    """排入 notifications 則通知，反覆派送到佇列清空，回傳 (耗時, 派送輪數, 狀態統計)"""
+    with tempfile.TemporaryDirectory() as workdir:
+        queue = notifier.NotificationQueue(os.path.join(workdir, 'notify.db'), dedup_window=0)
+        # 每則訊息提及 10 人，收件人依訊息分組
+        queue.enqueue_many([
+            ([{'user_id': f'U{(i * 10 + j) % 5000:032x}'} for j in range(10)],
+             f'C{i % 50:032x}', f'bench {i}', f'm{i}', None)
+            for i in range(notifications // 10)
+        ])
+        dispatcher = notifier.NotificationDispatcher(queue, client, interval=0.05)
+        started = time.perf_counter()
+        rounds = 0
+        while True:
+            counts = queue.status_counts()
+            if not counts.get(notifier.STATUS_PENDING) and not counts.get(notifier.STATUS_SENDING):
+                break
+            if not dispatcher.dispatch_once():
+                time.sleep(dispatcher.interval)
+            rounds += 1
+        return time.perf_counter() - started, rounds, queue.status_counts()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='對外 LINE API 呼叫的吞吐量與容錯測試')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 10, 50])
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--latency', action='append', metavar='[KIND=]DIST', help='替身延遲分布（可重複）')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=float, default=0)
+    parser.add_argument('--expired-ratio', type=float, default=0.0, help='回覆前已過期的權杖比例')
+    parser.add_argument('--members-per-group', type=int, default=20)
+    parser.add_argument('--notifications', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    # 注入的錯誤會讓客戶端與派送器大量記錄錯誤，只保留結果輸出
+    logging.basicConfig(level=logging.CRITICAL)
+
+    emulator = LineApiEmulator(
+        latency=parse_latency_args(args.latency or ['lognormal:50:0.4']),
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        rate_limit=args.rate_limit,
+        members_per_group=args.members_per_group,
+        seed=args.seed,
+    ).start()
+    print(f"替身設定: {emulator.config()}")
+
+    try:
+        print(f"\n{'情境':<10} {'並行':>6} {'請求/秒':>10} {'p50 (ms)':>10} {'p95 (ms)':>10}  狀態")
+        for scenario in args.scenarios:
+            if scenario == 'notify':
+                continue
+            for concurrency in args.concurrency:
+                client = line_api.LineApiClient('bench-token', emulator.base_url, pool_size=concurrency)
+                elapsed, latencies, statuses = bench_client_calls(
+                    emulator, client, scenario, args.requests, concurrency, args.expired_ratio)
+                print(f"{scenario:<10} {concurrency:>6} {len(latencies) / elapsed:>10.1f} "
+                      f"{statistics.median(latencies) * 1000:>10.1f} {percentile(latencies, 0.95) * 1000:>10.1f}"
+                      f"  {dict(statuses)}")
+
+        if 'notify' in args.scenarios:
+            client = line_api.LineApiClient('bench-token', emulator.base_url)
+            elapsed, rounds, counts = bench_notify(emulator, client, args.notifications)
+            print(f"\n通知派送：{args.notifications} 則，{rounds} 輪，耗時 {elapsed:.2f} 秒，最終狀態 {counts}")
+
+        print(f"\n替身回應統計: {emulator.stats()}")
+    finally:
+        emulator.stop()
+
+
+if __name__ == "__main__":
+    main()
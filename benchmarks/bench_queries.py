@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+資料規模基準測試：各 API 查詢與寫入路徑在不同資料量下的耗時
+
+每個規模以 generate_data.py 建立合成資料庫（快取於 --data-dir，參數相同時重複使用），
+複製一份後在子程序中載入 app_simple，以 Flask 測試客戶端呼叫各 API 端點，
+並量測 webhook 寫入路徑（record_events）的吞吐量；安裝 LINE SDK 時另量測
+line_bot_handler.DatabaseManager 的查詢。
+
+結果寫入 --out 目錄的 JSON 檔，--compare 指定先前的結果時列出變慢超過 --threshold 倍的項目。
+
+使用方式:
+    python benchmarks/bench_queries.py --scales 10k 1m 10m
+    python benchmarks/bench_queries.py --scales 10k 1m --compare benchmarks/results/baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import generate_data  # noqa: E402
+
+API_QUERIES = {
+    'statistics': '/api/statistics',
+    'statistics_exact': '/api/statistics?exact=true',
+    'statistics_compact': '/api/statistics?format=compact',
+    'mentioned_users': '/api/mentioned-users',
+    'mentioned_users_fields': '/api/mentioned-users?fields=user_name,mentioned_at&limit=20',
+    'timeseries_hour': '/api/timeseries?resolution=hour',
+    'timeseries_day': '/api/timeseries?resolution=day&start={year_ago}',
+    'timeseries_day_group': '/api/timeseries?resolution=day&start={year_ago}&group_id={top_group}',
+    'unique_users': '/api/unique-users',
+    'unique_users_exact': '/api/unique-users?exact=true',
+    'unique_users_group_exact': '/api/unique-users?exact=true&group_id={top_group}',
+    'trending': '/api/trending',
+}
+
+WRITE_BATCH_EVENTS = 10
+
+
+def parse_scale(text):
+    text = text.lower()
+    multiplier = {'k': 1_000, 'm': 1_000_000}.get(text[-1], 1)
+    return int(float(text.rstrip('km')) * multiplier)
+
+
+def timed(func, repeat):
+    """回傳 (第一次耗時, 其後各次耗時列表)，單位毫秒"""
+    samples = []
+    for _ in range(repeat + 1):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples[0], samples[1:]
+
+
+def summarize(cold, samples):
+    samples = sorted(samples)
+    return {
+        'cold_ms': round(cold, 3),
+        'median_ms': round(statistics.median(samples), 3),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+    }
+
+
+def synthetic_events(count, seed_id):
+    events = []
+    for index in range(count):
+        events.append({
+            'type': 'message',
+            'replyToken': f'bench-{seed_id}-{index}',
+            'timestamp': int(time.time() * 1000),
+            'source': {'type': 'group', 'groupId': f'C{index % 50:032x}', 'userId': f'U{index % 997:032x}'},
+            'message': {'type': 'text', 'id': f'bench-{seed_id}-{index}',
+                        'text': f'@使用者{index % 1000} @使用者{index % 37} 請看一下這個'},
+        })
+    return events
+
+
+def run_child(repeat, writes):
+    """子程序：在目前目錄的 line_data.db 上量測，結果以 JSON 輸出到標準輸出"""
+    started = time.perf_counter()
+    import app_simple
+    import_seconds = time.perf_counter() - started
+
+    import mention_writer
+    conn = mention_writer.connect_reader('line_data.db')
+    try:
+        top_group = conn.execute('''
+            SELECT group_id FROM messages GROUP BY group_id ORDER BY COUNT(*) DESC LIMIT 1
+        ''').fetchone()[0]
+    finally:
+        conn.close()
+    params = {
+        'top_group': top_group,
+        'year_ago': datetime.fromtimestamp(time.time() - 365 * 86400).strftime('%Y-%m-%dT%H:%M'),
+    }
+
+    client = app_simple.app.test_client()
+    queries = {}
+    for name, path in API_QUERIES.items():
+        url = path.format(**params)
+
+        def call():
+            response = client.get(url)
+            if response.status_code != 200:
+                raise RuntimeError(f"{url} 回應 {response.status_code}")
+        queries[name] = summarize(*timed(call, repeat))
+
+    try:
+        import line_bot_handler
+    except ImportError:
+        queries['database_manager'] = 'skipped（未安裝 line-bot-sdk）'
+    else:
+        manager = line_bot_handler.DatabaseManager('line_data.db')
+        queries['db_manager_statistics'] = summarize(*timed(manager.get_mention_statistics, repeat))
+        queries['db_manager_recent'] = summarize(*timed(lambda: manager.get_recent_mentions(50), repeat))
+        queries['db_manager_timeseries'] = summarize(*timed(manager.get_timeseries, repeat))
+
+    # 寫入路徑：每批 WRITE_BATCH_EVENTS 個事件（每個事件提及 2 位）
+    batch_ms = []
+    for batch in range(max(1, writes // WRITE_BATCH_EVENTS)):
+        events = synthetic_events(WRITE_BATCH_EVENTS, batch)
+        started = time.perf_counter()
+        app_simple.record_events(events, app_simple.admission.PERSIST_ONLY)
+        batch_ms.append((time.perf_counter() - started) * 1000)
+    total_seconds = sum(batch_ms) / 1000
+    write = summarize(batch_ms[0], batch_ms[1:] or batch_ms)
+    write['events_per_second'] = round(len(batch_ms) * WRITE_BATCH_EVENTS / total_seconds, 1)
+
+    json.dump({'import_seconds': round(import_seconds, 3), 'queries': queries, 'write_batch': write},
+              sys.stdout)
+
+
+def prepare_database(data_dir, mentions, seed):
+    """建立（或重複使用）合成資料庫，回傳路徑"""
+    directory = os.path.join(data_dir, str(mentions))
+    path = os.path.join(directory, 'line_data.db')
+    meta_path = os.path.join(directory, 'meta.json')
+    meta = {'mentions': mentions, 'seed': seed}
+    if os.path.exists(path) and os.path.exists(meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            if {key: value for key, value in json.load(f).items() if key in meta} == meta:
+                return path, meta_path
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    print(f"建立 {mentions:,} 筆提及的合成資料庫...", file=sys.stderr)
+    started = time.perf_counter()
+    messages, actual = generate_data.generate(path, mentions, seed=seed)
+    meta.update({'messages': messages, 'actual_mentions': actual,
+                 'generate_seconds': round(time.perf_counter() - started, 1)})
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    return path, meta_path
+
+
+def run_scale(data_dir, mentions, seed, repeat, writes):
+    source, meta_path = prepare_database(data_dir, mentions, seed)
+    workdir = os.path.join(os.path.dirname(source), 'work')
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+    # 寫入測試會改變資料庫，在複本上執行
+    import snapshots
+    snapshots.backup_database(source, os.path.join(workdir, 'line_data.db'), pages=-1, pause=0)
+
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT, JOURNAL_DIR='', SNAPSHOT_INTERVAL='0', DB_SHARDS='1',
+               ROSTER_FETCH_MEMBERS='0', NOTIFY_MENTIONS='0')
+    env.pop('MENTION_WRITER_SOCKET', None)
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', '--repeat', str(repeat), '--writes', str(writes)],
+        cwd=workdir, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    shutil.rmtree(workdir, ignore_errors=True)
+    result = json.loads(output.strip().splitlines()[-1])
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        result['dataset'] = json.load(f)
+    result['db_bytes'] = os.path.getsize(source)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline, threshold):
+    """列出與基準相比變慢超過 threshold 倍的項目，回傳變慢的項目數"""
+    regressions = 0
+    for scale, result in results['scales'].items():
+        base = baseline.get('scales', {}).get(scale)
+        if not base:
+            continue
+        items = dict(result['queries'], write_batch=result['write_batch'])
+        base_items = dict(base['queries'], write_batch=base['write_batch'])
+        for name, stats in items.items():
+            before = base_items.get(name)
+            if not isinstance(stats, dict) or not isinstance(before, dict) or not before['median_ms']:
+                continue
+            ratio = stats['median_ms'] / before['median_ms']
+            flag = '  ← 變慢' if ratio > threshold else ''
+            regressions += ratio > threshold
+            print(f"{scale:>8} {name:<28} {before['median_ms']:>10.2f} → {stats['median_ms']:>10.2f} ms"
+                  f"  ×{ratio:.2f}{flag}")
+    return regressions
+
+
+def print_results(results):
+    for scale, result in results['scales'].items():
+        print(f"\n== {scale} 筆提及（{result['db_bytes'] / 1e6:,.1f} MB，載入 {result['import_seconds']:.2f} 秒）")
+        print(f"{'項目':<28} {'首次 (ms)':>10} {'中位數 (ms)':>12} {'p95 (ms)':>10}")
+        for name, stats in dict(result['queries'], write_batch=result['write_batch']).items():
+            if isinstance(stats, dict):
+                print(f"{name:<28} {stats['cold_ms']:>10.2f} {stats['median_ms']:>12.2f} {stats['p95_ms']:>10.2f}")
+            else:
+                print(f"{name:<28} {stats}")
+        print(f"寫入：每秒 {result['write_batch']['events_per_second']:,.0f} 個事件")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='資料規模基準測試')
+    parser.add_argument('--scales', nargs='+', default=['10k', '1m', '10m'], help='提及筆數（可用 k / m）')
+    parser.add_argument('--data-dir', default=os.path.join(REPO_ROOT, 'benchmarks', 'data'))
+    parser.add_argument('--out', default=os.path.join(REPO_ROOT, 'benchmarks', 'results'))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--writes', type=int, default=500, help='寫入測試的事件數')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--compare', help='比較用的先前結果 JSON')
+    parser.add_argument('--threshold', type=float, default=1.25)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.repeat, args.writes)
+        return
+
+    results = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'scales': {},
+    }
+    for scale in args.scales:
+        results['scales'][scale] = run_scale(args.data_dir, parse_scale(scale), args.seed,
+                                             args.repeat, args.writes)
+    print_results(results)
+
+    os.makedirs(args.out, exist_ok=True)
+    out_path = os.path.join(args.out, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{results['git_revision'] or 'local'}.json")
+    with open(out_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\n結果已寫入 {out_path}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"\n與 {args.compare} 比較（門檻 ×{args.threshold}）")
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
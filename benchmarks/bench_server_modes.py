@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+WSGI（gunicorn）與 ASGI（uvicorn）模式的並行連線吞吐量比較
+
+以本機假 LINE API（固定延遲）承接回覆呼叫，分別對兩種模式送出
+webhook 與統計 API 請求，輸出各並行數下的吞吐量與延遲。
+
+使用方式:
+    python benchmarks/bench_server_modes.py --concurrency 1 10 50 --requests 500
+"""
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_fake_line_api(latency):
+    """啟動固定延遲的假 LINE API，回傳 base URL"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'{}')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def seed_database(workdir, rows):
+    """建立含測試資料的資料庫"""
+    conn = sqlite3.connect(os.path.join(workdir, 'line_data.db'))
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS mentioned_users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            user_name TEXT,
+            group_id TEXT,
+            message TEXT,
+            mentioned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            message_id TEXT
+        )
+    ''')
+    conn.executemany(
+        'INSERT INTO mentioned_users (user_id, user_name, group_id, message, message_id, mentioned_at) '
+        'VALUES (?, ?, ?, ?, ?, ?)',
+        ((f'user{i % 200}', f'user{i % 200}', f'group{i % 20}', f'hello @user{i % 200}',
+          f'msg{i}', f'2024-01-01T{i % 24:02d}:00:00') for i in range(rows))
+    )
+    conn.commit()
+    conn.close()
+
+
+def wait_for_port(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'伺服器未在 {timeout} 秒內啟動 (port {port})')
+
+
+def webhook_body(i):
+    return json.dumps({'events': [{
+        'type': 'message',
+        'replyToken': f'token{i}',
+        'source': {'type': 'group', 'groupId': f'group{i % 20}', 'userId': 'sender'},
+        'message': {'type': 'text', 'id': f'bench{i}', 'text': f'hi @user{i % 200}'},
+    }]})
+
+
+def run_load(port, method, path, body_factory, concurrency, total):
+    """以固定並行數送出請求，回傳 (吞吐量, p50, p99)"""
+    latencies = []
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def worker():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                break
+            body = body_factory(i) if body_factory else None
+            headers = {'Content-Type': 'application/json'} if body else {}
+            start = time.perf_counter()
+            conn.request(method, path, body=body, headers=headers)
+            conn.getresponse().read()
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+        conn.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    duration = time.perf_counter() - start
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return total / duration, p50, p99
+
+
+SERVER_COMMANDS = {
+    'wsgi': lambda port, threads: [sys.executable, '-m', 'gunicorn', 'wsgi:app', '-b', f'127.0.0.1:{port}',
+                                   '-w', '1', '-k', 'gthread', '--threads', str(threads)],
+    'asgi': lambda port, threads: [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(port),
+                                   '--log-level', 'warning'],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='比較 WSGI 與 ASGI 模式的並行吞吐量')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--requests', type=int, default=500, help='每個情境的請求數')
+    parser.add_argument('--rows', type=int, default=10000, help='預先建立的提及記錄數')
+    parser.add_argument('--line-latency', type=float, default=0.1, help='假 LINE API 的回應延遲（秒）')
+    parser.add_argument('--threads', type=int, default=8, help='gunicorn gthread 的執行緒數')
+    parser.add_argument('--modes', nargs='+', default=['wsgi', 'asgi'], choices=list(SERVER_COMMANDS))
+    args = parser.parse_args()
+
+    line_api = start_fake_line_api(args.line_latency)
+    scenarios = [
+        ('webhook', 'POST', '/webhook', webhook_body),
+        ('statistics', 'GET', '/api/statistics', None),
+    ]
+
+    print(f"{'mode':<6} {'endpoint':<11} {'conc':>5} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory() as workdir:
+            seed_database(workdir, args.rows)
+            port = free_port()
+            env = dict(os.environ, LINE_API_BASE_URL=line_api, PYTHONPATH=REPO_ROOT,
+                       LINE_CHANNEL_ACCESS_TOKEN='bench')
+            process = subprocess.Popen(SERVER_COMMANDS[mode](port, args.threads), cwd=workdir, env=env,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_for_port(port)
+                for name, method, path, body_factory in scenarios:
+                    for concurrency in args.concurrency:
+                        rps, p50, p99 = run_load(port, method, path, body_factory, concurrency, args.requests)
+                        print(f"{mode:<6} {name:<11} {concurrency:>5} {rps:>9.1f} {p50 * 1000:>9.1f} {p99 * 1000:>9.1f}")
+            finally:
+                process.terminate()
+                process.wait(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+儲存格式基準測試：舊版 mentioned_users 單一資料表 vs. messages + mentions 正規化
+
+以相同的合成訊息（每則訊息提及 k 位使用者）分別寫入兩種格式，
+比較資料庫大小與寫入吞吐量（包含時間序列彙總與相異計數摘要的更新），
+並量測舊版資料庫升級為正規化格式的轉換時間。
+
+使用方式:
+    python benchmarks/bench_storage.py --messages 20000 --mentions 1 3 10
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import hll  # noqa: E402
+import mention_writer  # noqa: E402
+import rollups  # noqa: E402
+import schema  # noqa: E402
+import timeutil  # noqa: E402
+
+LEGACY_TABLE = '''
+    CREATE TABLE mentioned_users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        user_name TEXT,
+        group_id TEXT,
+        message TEXT,
+        mentioned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        message_id TEXT,
+        sender_id TEXT
+    )
+'''
+
+LEGACY_INSERT = '''
+    INSERT INTO mentioned_users (user_id, user_name, group_id, message, message_id, mentioned_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+
+def synthetic_batches(messages, mentions, message_length, batch_size=50, seed=1):
+    """產生寫入批次：每批 batch_size 則訊息，每則訊息提及 mentions 位使用者"""
+    rng = random.Random(seed)
+    started = datetime(2024, 1, 1)
+    batches, batch = [], []
+    for index in range(messages):
+        users = rng.sample(range(2000), mentions)
+        text = ' '.join(f'@使用者{user}' for user in users)
+        text += ' ' + ''.join(rng.choice('提及測試訊息內容abcdef ') for _ in range(max(0, message_length - len(text))))
+        mentioned_at = timeutil.to_ms(started + timedelta(seconds=index * 7))
+        group_id = f'C{rng.randrange(200):032x}'
+        message_id = str(460000000000000000 + index)
+        batch.extend((f'U{user:032x}', f'使用者{user}', group_id, text, message_id, mentioned_at) for user in users)
+        if (index + 1) % batch_size == 0:
+            batches.append(batch)
+            batch = []
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def create_legacy(path):
+    """建立舊版格式的資料庫（mentioned_users 為資料表）"""
+    schema.ensure_schema(path)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute('DROP VIEW mentioned_users')
+        conn.execute(LEGACY_TABLE)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def write_legacy(conn, rows):
+    with conn:
+        conn.executemany(LEGACY_INSERT, rows)
+        rollups.record(conn, rows)
+        hll.record(conn, rows)
+
+
+def database_size(conn):
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    pages = conn.execute('PRAGMA page_count').fetchone()[0] - conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return page_size * pages
+
+
+def run(conn, write, batches):
+    started = time.perf_counter()
+    for rows in batches:
+        write(conn, rows)
+    elapsed = time.perf_counter() - started
+    return sum(len(rows) for rows in batches) / elapsed, database_size(conn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='儲存格式基準測試')
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--mentions', type=int, nargs='+', default=[1, 3, 10], help='每則訊息提及的人數')
+    parser.add_argument('--message-length', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'提及/訊息':>9} {'格式':<6} {'提及/秒':>10} {'大小 (MB)':>10} {'轉換 (秒)':>10}")
+    for mentions in args.mentions:
+        batches = synthetic_batches(args.messages, mentions, args.message_length)
+        with tempfile.TemporaryDirectory() as workdir:
+            legacy = create_legacy(os.path.join(workdir, 'legacy.db'))
+            legacy_rate, legacy_size = run(legacy, write_legacy, batches)
+
+            normalized = mention_writer.connect(os.path.join(workdir, 'normalized.db'))
+            normalized_rate, normalized_size = run(normalized, mention_writer.write_rows, batches)
+
+            started = time.perf_counter()
+            with legacy:
+                schema.normalize_mentions(legacy)
+            migrate_seconds = time.perf_counter() - started
+            legacy.execute('VACUUM')
+            migrated_size = database_size(legacy)
+            for conn in (legacy, normalized):
+                conn.close()
+
+        print(f"{mentions:>9} {'舊版':<6} {legacy_rate:>10,.0f} {legacy_size / 1e6:>10.1f}")
+        print(f"{'':>9} {'正規化':<6} {normalized_rate:>10,.0f} {normalized_size / 1e6:>10.1f}")
+        print(f"{'':>9} {'轉換後':<6} {'':>10} {migrated_size / 1e6:>10.1f} {migrate_seconds:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
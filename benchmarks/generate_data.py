@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+合成資料產生器：建立指定規模的提及資料庫
+
+分布接近實際使用情況：
+- 被提及者、發言者與群組依 Zipf 分布（少數使用者與群組佔大部分提及）
+- 時間有日夜週期，並有隨機的爆量時段；同一小時內的訊息集中在前段
+- 每則訊息提及 1 位以上（幾何分布），最新的訊息時間接近目前時間
+
+寫入時一併建立時間序列彙總與相異計數摘要，與正式寫入路徑產生的資料相同。
+
+使用方式:
+    python benchmarks/generate_data.py --mentions 1000000 --out /tmp/bench.db
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+import time
+from collections import Counter
+from itertools import accumulate
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import hll  # noqa: E402
+import mention_writer  # noqa: E402
+import rollups  # noqa: E402
+import schema  # noqa: E402
+import timeutil  # noqa: E402
+
+# 每則訊息再多提及一位的機率（平均每則約 1.5 位）
+EXTRA_MENTION_PROBABILITY = 0.35
+MAX_MENTIONS_PER_MESSAGE = 10
+# 爆量時段的機率與倍數
+BURST_PROBABILITY = 0.02
+BURST_FACTOR = 20
+# 日夜週期：各小時（顯示時區）的相對訊息量
+DIURNAL = [0.2, 0.1, 0.05, 0.05, 0.05, 0.1, 0.3, 0.6, 1.0, 1.2, 1.2, 1.3,
+           1.5, 1.3, 1.1, 1.1, 1.2, 1.3, 1.4, 1.6, 1.8, 1.7, 1.2, 0.6]
+
+
+def zipf_cum_weights(count, exponent):
+    return list(accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+
+def default_sizes(mentions):
+    """依規模決定使用者數與群組數"""
+    return max(100, mentions // 200), max(20, mentions // 2000)
+
+
+def hourly_counts(rng, messages, hours):
+    """將訊息依日夜週期與爆量時段分配到各小時，回傳每小時的訊息數"""
+    start_hour = time.time() // 3600 - hours
+    weights = []
+    for hour in range(hours):
+        local_hour = timeutil.from_ms(int((start_hour + hour) * 3600 * 1000)).hour
+        weight = DIURNAL[local_hour] * rng.lognormvariate(0, 0.3)
+        if rng.random() < BURST_PROBABILITY:
+            weight *= BURST_FACTOR
+        weights.append(weight)
+    cum_weights = list(accumulate(weights))
+    counts = Counter()
+    remaining = messages
+    while remaining:
+        chunk = min(remaining, 1_000_000)
+        counts.update(rng.choices(range(hours), cum_weights=cum_weights, k=chunk))
+        remaining -= chunk
+    return start_hour, counts
+
+
+def generate(path, mentions, users=None, groups=None, days=365, exponent=1.1, seed=1,
+             batch_messages=20000, progress=None):
+    """建立約含 mentions 筆提及的資料庫，回傳實際的 (訊息數, 提及數)"""
+    rng = random.Random(seed)
+    default_users, default_groups = default_sizes(mentions)
+    users = users or default_users
+    groups = groups or default_groups
+    user_weights = zipf_cum_weights(users, exponent)
+    group_weights = zipf_cum_weights(groups, exponent)
+    # 被提及者的排名與發言者不同（常發言的人不一定常被提及）
+    sender_order = list(range(users))
+    rng.shuffle(sender_order)
+
+    mean_mentions = 1 / (1 - EXTRA_MENTION_PROBABILITY)
+    messages = math.ceil(mentions / mean_mentions)
+    start_hour, counts = hourly_counts(rng, messages, days * 24)
+
+    schema.ensure_schema(path)
+    conn = mention_writer.connect(path)
+    conn.execute('PRAGMA synchronous=OFF')
+
+    message_rows, mention_rows, derived_rows = [], [], []
+    message_count = mention_count = 0
+    next_id = (conn.execute('SELECT MAX(id) FROM messages').fetchone()[0] or 0) + 1
+
+    def flush():
+        with conn:
+            conn.executemany('''
+                INSERT INTO messages (id, message_id, group_id, sender_id, message, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', message_rows)
+            conn.executemany(mention_writer.INSERT_MENTION_SQL, mention_rows)
+            mention_writer.record_user_names(conn, derived_rows)
+            rollups.record(conn, derived_rows)
+            hll.record(conn, derived_rows)
+        message_rows.clear()
+        mention_rows.clear()
+        derived_rows.clear()
+
+    for hour in sorted(counts):
+        hour_start = (start_hour + hour) * 3600 * 1000
+        # 同一小時內的訊息集中在前段（爆量對話）
+        offsets = sorted(int(rng.random() ** 3 * 3_600_000) for _ in range(counts[hour]))
+        group_picks = rng.choices(range(groups), cum_weights=group_weights, k=len(offsets))
+        for offset, group_index in zip(offsets, group_picks):
+            created_at = hour_start + offset
+            group_id = f'C{group_index:032x}'
+            sender_id = f'U{sender_order[rng.choices(range(users), cum_weights=user_weights)[0]]:032x}'
+            mentioned = set()
+            while True:
+                mentioned.add(rng.choices(range(users), cum_weights=user_weights)[0])
+                if len(mentioned) >= MAX_MENTIONS_PER_MESSAGE or rng.random() >= EXTRA_MENTION_PROBABILITY:
+                    break
+            text = ' '.join(f'@使用者{index}' for index in mentioned) + ' 請看一下這個'
+            message_id = str(460000000000000000 + next_id)
+            message_rows.append((next_id, message_id, group_id, sender_id, text, created_at))
+            for index in mentioned:
+                user_id, user_name = f'U{index:032x}', f'使用者{index}'
+                mention_rows.append((next_id, user_id, user_name))
+                derived_rows.append((user_id, user_name, group_id, text, message_id, created_at))
+            next_id += 1
+            message_count += 1
+            mention_count += len(mentioned)
+            if len(message_rows) >= batch_messages:
+                flush()
+                if progress:
+                    progress(mention_count, mentions)
+    if message_rows:
+        flush()
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.execute('ANALYZE')
+    conn.close()
+    if progress:
+        progress(mention_count, mentions)
+    return message_count, mention_count
+
+
+def _print_progress(done, total):
+    print(f"\r已產生 {done:,} / {total:,} 筆提及", end='', file=sys.stderr, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='合成提及資料產生器')
+    parser.add_argument('--mentions', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, help='使用者數（預設依規模決定）')
+    parser.add_argument('--groups', type=int, help='群組數（預設依規模決定）')
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--zipf', type=float, default=1.1, help='Zipf 分布指數')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', default='bench.db')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    messages, mentions = generate(args.out, args.mentions, args.users, args.groups, args.days,
+                                  args.zipf, args.seed, progress=_print_progress)
+    elapsed = time.perf_counter() - started
+    print(file=sys.stderr)
+    print(f"{args.out}: {messages:,} 則訊息、{mentions:,} 筆提及，"
+          f"{os.path.getsize(args.out) / 1e6:,.1f} MB，耗時 {elapsed:.1f} 秒（{mentions / elapsed:,.0f} 筆/秒）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+"""
+群組內指令
+成員在群組中輸入指令查詢提及統計，由預先彙總的資料回答，不掃描全部提及記錄：
+
+- /mentions me [today|week|month]：自己被提及的次數，以及今天提及自己的成員
+- /top [today|week|month]：最常被提及的成員（預設最近 7 天）
+- /stats：本群組今天、最近 7 天與累計的提及次數，以及被提及的相異成員數
+- /digest [daily [HH:MM] [時區] | hourly [時區] | off]：設定本群組的定期提及摘要（digests）
+- /notify [on | off | quiet HH:MM-HH:MM [時區] | quiet off]：設定自己的提及通知（notifier）
+- /help：指令說明
+
+次數來自時間序列彙總的日時間桶、相異人數來自 hll 摘要、顯示名稱來自 users 資料表；
+「提及我的成員」只查詢當日的訊息（提及時間索引範圍）。
+每個群組的指令以權杖桶限制頻率，答案短暫快取，避免指令成為資料庫負載來源。
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+import hll
+import rollups
+import timeutil
+from notifier import is_line_user_id
+from reply_policy import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+COMMANDS = ('mentions', 'top', 'stats', 'digest', 'notify', 'help')
+
+# 期間名稱 → 含今天在內的天數
+PERIODS = {'today': 1, 'week': 7, 'month': 30}
+PERIOD_LABELS = {'today': '今天', 'week': '最近 7 天', 'month': '最近 30 天'}
+
+TOP_LIMIT = 5
+MENTIONER_LIMIT = 5
+
+HELP_TEXT = '\n'.join([
+    '📖 可用指令',
+    '/mentions me [today|week|month]：我被提及的次數與提及我的人',
+    '/top [today|week|month]：最常被提及的成員',
+    '/stats：本群組的提及統計',
+    '/digest daily 09:00 | hourly | off：定期提及摘要',
+    '/notify on | off | quiet 22:00-07:00：我的提及通知',
+])
+THROTTLED_TEXT = '⏳ 指令太頻繁，請稍後再試'
+DIGEST_DISABLED_TEXT = '📮 此服務未啟用提及摘要'
+NOTIFY_DISABLED_TEXT = '🔔 此服務未啟用提及通知'
+
+
+def parse_command(text):
+    """解析指令，回傳 (指令, 參數列表)；不是指令時回傳 None"""
+    parts = (text or '').strip().split()
+    if not parts or not parts[0].startswith('/'):
+        return None
+    name = parts[0][1:].lower()
+    if name not in COMMANDS:
+        return None
+    return name, [part.lower() for part in parts[1:]]
+
+
+def period_start(period, now=None):
+    """期間第一天的起點（顯示時區的 datetime）"""
+    today = rollups.bucket_start(now or timeutil.now(), 'day')
+    return today - timedelta(days=PERIODS[period] - 1)
+
+
+def _placeholders(values):
+    return ','.join('?' * len(values))
+
+
+def display_names(conn, user_ids):
+    """由 users 資料表取得顯示名稱 {使用者 ID: 名稱}"""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+    return dict(conn.execute(
+        f'SELECT user_id, display_name FROM users WHERE user_id IN ({_placeholders(user_ids)})', user_ids
+    ).fetchall())
+
+
+def count_mentions(conn, group_id, user_ids, since):
+    """期間內（since 起的日時間桶）被提及的次數"""
+    return conn.execute(f'''
+        SELECT COALESCE(SUM(count), 0) FROM {rollups.table_name('day')}
+        WHERE group_id = ? AND user_id IN ({_placeholders(user_ids)}) AND bucket_start >= ?
+    ''', (group_id, *user_ids, rollups.to_epoch(since))).fetchone()[0]
+
+
+def mentioners(conn, group_id, user_ids, since, limit=MENTIONER_LIMIT):
+    """期間內提及這些使用者的發言者 [(發言者 ID, 次數)]（只記錄了發言者的訊息）"""
+    return conn.execute(f'''
+        SELECT messages.sender_id, COUNT(*) AS total
+        FROM messages JOIN mentions ON mentions.message_ref = messages.id
+        WHERE messages.created_at >= ? AND messages.group_id = ?
+          AND mentions.user_id IN ({_placeholders(user_ids)}) AND messages.sender_id IS NOT NULL
+        GROUP BY messages.sender_id
+        ORDER BY total DESC
+        LIMIT ?
+    ''', (timeutil.to_ms(since), group_id, *user_ids, limit)).fetchall()
+
+
+def top_mentioned(conn, group_id, since, limit=TOP_LIMIT):
+    """期間內最常被提及的使用者 [(使用者 ID, 次數)]"""
+    return conn.execute(f'''
+        SELECT user_id, SUM(count) AS total FROM {rollups.table_name('day')}
+        WHERE group_id = ? AND user_id != ? AND bucket_start >= ?
+        GROUP BY user_id
+        ORDER BY total DESC
+        LIMIT ?
+    ''', (group_id, rollups.ALL, rollups.to_epoch(since), limit)).fetchall()
+
+
+def query_my_mentions(conn, group_id, user_ids, period, now=None):
+    today = period_start('today', now)
+    senders = mentioners(conn, group_id, user_ids, today)
+    return {
+        'count': count_mentions(conn, group_id, user_ids, period_start(period, now)),
+        'today_count': count_mentions(conn, group_id, user_ids, today),
+        'mentioners': senders,
+        'names': display_names(conn, [sender for sender, _ in senders]),
+    }
+
+
+def query_top(conn, group_id, period, now=None):
+    top = top_mentioned(conn, group_id, period_start(period, now))
+    return {'top': top, 'names': display_names(conn, [user_id for user_id, _ in top])}
+
+
+def query_group_stats(conn, group_id, now=None):
+    week_start = period_start('week', now)
+    totals = dict(conn.execute(f'''
+        SELECT bucket_start, count FROM {rollups.table_name('day')}
+        WHERE group_id = ? AND user_id = ? AND bucket_start >= ?
+    ''', (group_id, rollups.ALL, rollups.to_epoch(week_start))).fetchall())
+    return {
+        'today': totals.get(rollups.to_epoch(period_start('today', now)), 0),
+        'week': sum(totals.values()),
+        'total': conn.execute(f'''
+            SELECT COALESCE(SUM(count), 0) FROM {rollups.table_name('day')}
+            WHERE group_id = ? AND user_id = ?
+        ''', (group_id, rollups.ALL)).fetchone()[0],
+        'week_users': hll.estimate(conn, hll.USERS, group_id, week_start, now or timeutil.now()),
+    }
+
+
+class ChatCommands:
+    """群組內指令的解析、頻率限制與回答
+
+    run_query(group_id, func, *args) 在群組所屬的資料庫執行 func(conn, *args) 並回傳結果；
+    name_of(group_id, user_id) 為選用的名稱來源（例如群組成員名冊）；
+    digests 為選用的摘要排程器（digests.DigestScheduler），回答 /digest；
+    notifications 為選用的通知佇列（notifier.NotificationQueue），回答 /notify。
+    """
+
+    def __init__(self, run_query, name_of=None, digests=None, notifications=None, rate_per_minute=6, burst=3,
+                 cache_ttl=30, max_groups=1000):
+        self.run_query = run_query
+        self.name_of = name_of
+        self.digests = digests
+        self.notifications = notifications
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.cache_ttl = cache_ttl
+        self.max_groups = max_groups
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+        self._throttled = set()
+        self._cache = OrderedDict()
+        self._counters = {'answered': 0, 'cached': 0, 'throttled': 0, 'failed': 0}
+
+    @classmethod
+    def from_env(cls, run_query, name_of=None, digests=None, notifications=None):
+        return cls(
+            run_query,
+            name_of,
+            digests,
+            notifications,
+            rate_per_minute=float(os.getenv('CHAT_COMMAND_RATE_PER_MINUTE', 6)),
+            burst=int(os.getenv('CHAT_COMMAND_BURST', 3)),
+            cache_ttl=float(os.getenv('CHAT_COMMAND_CACHE_SECONDS', 30)),
+        )
+
+    def _admit(self, group_id):
+        """依群組的權杖桶決定是否回答；回傳 True、'notice'（第一次被限制，回覆提示）或 False"""
+        with self._lock:
+            bucket = self._buckets.get(group_id)
+            if bucket is None:
+                bucket = self._buckets[group_id] = TokenBucket(self.rate_per_minute, self.burst)
+                if len(self._buckets) > self.max_groups:
+                    evicted, _ = self._buckets.popitem(last=False)
+                    self._throttled.discard(evicted)
+            else:
+                self._buckets.move_to_end(group_id)
+            if bucket.try_acquire():
+                self._throttled.discard(group_id)
+                return True
+            self._counters['throttled'] += 1
+            if group_id in self._throttled:
+                return False
+            self._throttled.add(group_id)
+            return 'notice'
+
+    def _cached(self, key, compute):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] > now:
+                self._counters['cached'] += 1
+                return entry[1]
+        text = compute()
+        with self._lock:
+            self._cache[key] = (now + self.cache_ttl, text)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_groups * 4:
+                self._cache.popitem(last=False)
+        return text
+
+    def answer(self, group_id, sender_id, text):
+        """回答群組內指令；不是指令、被頻率限制或查詢失敗時回傳 None 或提示文字"""
+        command = parse_command(text)
+        if command is None or not group_id:
+            return None
+        name, args = command
+        admitted = self._admit(group_id)
+        if not admitted:
+            return None
+        if admitted == 'notice':
+            return THROTTLED_TEXT
+
+        try:
+            if name == 'help':
+                reply = HELP_TEXT
+            elif name == 'mentions':
+                reply = self._answer_mentions(group_id, sender_id, args)
+            elif name == 'top':
+                period = self._period(args[0] if args else 'week')
+                reply = self._cached((group_id, 'top', period), lambda: self._answer_top(group_id, period))
+            elif name == 'digest':
+                # 設定會寫入資料庫，不使用快取
+                reply = self.digests.configure(group_id, args) if self.digests is not None else DIGEST_DISABLED_TEXT
+            elif name == 'notify':
+                reply = (self.notifications.configure(sender_id, args) if self.notifications is not None
+                         else NOTIFY_DISABLED_TEXT)
+            else:
+                reply = self._cached((group_id, 'stats'), lambda: self._answer_stats(group_id))
+        except ValueError:
+            # 參數無法解析時回覆指令說明
+            reply = HELP_TEXT
+        except Exception as e:
+            logger.error(f"回答指令 {name} 時發生錯誤: {e}")
+            with self._lock:
+                self._counters['failed'] += 1
+            return None
+        with self._lock:
+            self._counters['answered'] += 1
+        return reply
+
+    @staticmethod
+    def _period(value):
+        if value not in PERIODS:
+            raise ValueError(f"未知的期間: {value}")
+        return value
+
+    def _name(self, group_id, user_id, names):
+        name = names.get(user_id)
+        if name is None and self.name_of is not None:
+            name = self.name_of(group_id, user_id)
+        # 以名稱作為 ID 的提及（沒有對應到 LINE 使用者）直接顯示 ID；查不到名稱時回傳 None
+        return name or (user_id if not is_line_user_id(user_id) else None)
+
+    def _answer_mentions(self, group_id, sender_id, args):
+        if not args or args[0] != 'me' or not sender_id:
+            return HELP_TEXT
+        period = self._period(args[1] if len(args) > 1 else 'week')
+
+        def compute():
+            my_name = self.name_of(group_id, sender_id) if self.name_of is not None else None
+            # 以顯示名稱記錄的提及（沒有對應到 LINE 使用者 ID）也計入
+            user_ids = [sender_id] + ([my_name] if my_name else [])
+            result = self.run_query(group_id, query_my_mentions, group_id, user_ids, period)
+            lines = [f"📬 你{PERIOD_LABELS[period]}被提及 {result['count']} 次"]
+            if period != 'today':
+                lines[0] += f"（今天 {result['today_count']} 次）"
+            if result['mentioners']:
+                known, unknown = [], 0
+                for sender, count in result['mentioners']:
+                    name = self._name(group_id, sender, result['names'])
+                    if name:
+                        known.append(f'{name}（{count}）')
+                    else:
+                        unknown += count
+                if unknown:
+                    known.append(f'其他成員（{unknown}）')
+                lines.append('今天提及你的人：' + '、'.join(known))
+            return '\n'.join(lines)
+        return self._cached((group_id, 'mentions', sender_id, period), compute)
+
+    def _answer_top(self, group_id, period):
+        result = self.run_query(group_id, query_top, group_id, period)
+        if not result['top']:
+            return f"🏆 {PERIOD_LABELS[period]}沒有提及記錄"
+        lines = [f"🏆 {PERIOD_LABELS[period]}最常被提及"]
+        for rank, (user_id, count) in enumerate(result['top'], 1):
+            lines.append(f"{rank}. {self._name(group_id, user_id, result['names']) or '（未知成員）'} — {count} 次")
+        return '\n'.join(lines)
+
+    def _answer_stats(self, group_id):
+        stats = self.run_query(group_id, query_group_stats, group_id)
+        return '\n'.join([
+            '📊 本群組提及統計',
+            f"今天：{stats['today']} 次",
+            f"最近 7 天：{stats['week']} 次（約 {stats['week_users']} 位成員被提及）",
+            f"累計：{stats['total']} 次",
+        ])
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'rate_per_minute': self.rate_per_minute,
+                'burst': self.burst,
+                'cache_ttl': self.cache_ttl,
+                'throttled_groups': len(self._throttled),
+                'counters': dict(self._counters),
+            }
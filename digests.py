@@ -0,0 +1,487 @@
+"""
+定期提及摘要
+群組可設定每小時或每天（指定時間與時區）送出一則提及摘要，取代每則提及一次回覆：
+
+- 待送計數：寫入路徑在提及記錄的同一交易中，為已設定摘要的群組累加
+  (群組, 被提及者, 發言者) 的次數；送出摘要時只讀取這些計數，不掃描提及記錄
+- 關閉期間：到期時以 next_run 比較後更新（compare-and-set）排程，並在同一交易中
+  將待送計數移入摘要佇列；多個 worker 同時執行時每個期間只會被一個 worker 關閉，
+  重啟後由資料庫中的排程接續，停機期間的提及合併為一則摘要
+- 送出：每則摘要以一次 push 送到群組（最多 5 則文字訊息），附帶固定的 X-Line-Retry-Key；
+  認領後當機的摘要逾時後由其他 worker 以同一重試金鑰重送，LINE 不會重複送出（回應 409）
+
+摘要資料表與提及記錄放在同一個資料庫（分片部署時為群組所屬的分片）。
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import schema
+import timeutil
+from chat_commands import display_names
+from line_api import QuotaExceededError
+from notifier import is_line_user_id
+
+logger = logging.getLogger(__name__)
+
+FREQUENCIES = ('hourly', 'daily')
+FREQUENCY_LABELS = {'hourly': '每小時', 'daily': '每天'}
+DEFAULT_SEND_AT = '09:00'
+
+# 群組所屬資料庫中的摘要資料表（重新分片時依群組搬移）
+TABLES = ('digest_schedules', 'digest_pending', 'digest_outbox')
+
+# LINE 單次 push 最多 5 則訊息、每則文字最多 5000 字
+MAX_MESSAGES = 5
+TEXT_LIMIT = 5000
+
+# 每位被提及者列出的發言者數
+SENDER_LIMIT = 3
+MAX_ATTEMPTS = 3
+QUOTA_RECHECK = 3600
+
+STATUS_PENDING = 'pending'
+STATUS_SENDING = 'sending'
+STATUS_SENT = 'sent'
+STATUS_FAILED = 'failed'
+
+UPSERT_PENDING_SQL = '''
+    INSERT INTO digest_pending (group_id, user_id, sender_id, count) VALUES (?, ?, ?, ?)
+    ON CONFLICT(group_id, user_id, sender_id) DO UPDATE SET count = count + excluded.count
+'''
+
+USAGE_TEXT = '\n'.join([
+    '📮 提及摘要設定',
+    '/digest daily [HH:MM] [時區]：每天定時送出（預設 09:00）',
+    '/digest hourly [時區]：每小時送出',
+    '/digest off：停止摘要',
+    '/digest：查看目前設定',
+])
+
+
+def parse_schedule(args):
+    """解析 /digest 的參數，回傳 (頻率, 每日時間, 時區)"""
+    if not args or args[0] not in FREQUENCIES:
+        raise ValueError("未知的摘要頻率")
+    frequency, rest = args[0], list(args[1:])
+    send_at = None
+    if frequency == 'daily':
+        send_at = DEFAULT_SEND_AT
+        if rest and rest[0][:1].isdigit():
+            send_at = timeutil.parse_time_of_day(rest.pop(0))
+    timezone = timeutil.resolve_timezone(rest.pop(0)) if rest else timeutil.DISPLAY_TIMEZONE_NAME
+    if rest:
+        raise ValueError("多餘的參數")
+    return frequency, send_at, timezone
+
+
+def next_run(frequency, send_at, timezone, after_ms):
+    """after_ms 之後的下一次送出時間（epoch 毫秒）：每小時為整點、每天為當地的 send_at"""
+    local = datetime.fromtimestamp(after_ms / 1000, ZoneInfo(timezone))
+    if frequency == 'hourly':
+        # 以絕對時間加一小時，夏令時間切換時不會重複或跳過
+        top = local.replace(minute=0, second=0, microsecond=0)
+        return int(top.timestamp() * 1000) + 3_600_000
+    hour, minute = map(int, send_at.split(':'))
+    candidate = local.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if candidate <= local:
+        following = local + timedelta(days=1)
+        candidate = following.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    return int(candidate.timestamp() * 1000)
+
+
+def _placeholders(values):
+    return ','.join('?' * len(values))
+
+
+def record(conn, rows):
+    """在寫入交易中累加已設定摘要的群組的待送計數（呼叫端負責提交）"""
+    group_ids = list({row[2] for row in rows if row[2]})
+    if not group_ids:
+        return
+    scheduled = {row[0] for row in conn.execute(
+        f'SELECT group_id FROM digest_schedules WHERE group_id IN ({_placeholders(group_ids)})', group_ids)}
+    if not scheduled:
+        return
+    counts = Counter(
+        (row[2], row[0], (row[6] if len(row) > 6 else None) or '')
+        for row in rows if row[2] in scheduled
+    )
+    conn.executemany(UPSERT_PENDING_SQL, [key + (count,) for key, count in counts.items()])
+
+
+def close_due_periods(conn, now_ms, limit=100):
+    """關閉到期群組的摘要期間，回傳 (關閉的期間數, 排入佇列的摘要數)
+
+    待送計數移入摘要佇列、排程改為下一次，兩者在同一交易中完成；
+    沒有任何提及的期間只排定下一次，不送出摘要。
+    """
+    due = conn.execute('''
+        SELECT group_id, frequency, send_at, timezone, period_start, next_run
+        FROM digest_schedules WHERE next_run <= ?
+        ORDER BY next_run LIMIT ?
+    ''', (now_ms, limit)).fetchall()
+    closed = queued = 0
+    with conn:
+        for group_id, frequency, send_at, timezone, period_start, scheduled in due:
+            # 只有 next_run 仍是讀到的值時才更新：其他 worker 已關閉此期間時略過
+            updated = conn.execute('''
+                UPDATE digest_schedules SET period_start = ?, next_run = ?
+                WHERE group_id = ? AND next_run = ?
+            ''', (now_ms, next_run(frequency, send_at, timezone, now_ms), group_id, scheduled)).rowcount
+            if not updated:
+                continue
+            closed += 1
+            counts = conn.execute(
+                'SELECT user_id, sender_id, count FROM digest_pending WHERE group_id = ?', (group_id,)
+            ).fetchall()
+            if not counts:
+                continue
+            conn.execute('DELETE FROM digest_pending WHERE group_id = ?', (group_id,))
+            conn.execute('''
+                INSERT INTO digest_outbox
+                    (group_id, timezone, period_start, period_end, counts, retry_key, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (group_id, timezone, period_start, now_ms, json.dumps(counts), str(uuid.uuid4()), time.time()))
+            queued += 1
+    return closed, queued
+
+
+def claim(conn, worker_id, limit, stale_after=300):
+    """認領待送摘要；以原子 UPDATE 認領，多個 worker 同時派送也不會重複認領"""
+    now = time.time()
+    with conn:
+        # 認領後當機的摘要在逾時後釋出（重送時使用同一重試金鑰）
+        conn.execute('''
+            UPDATE digest_outbox SET status = 'pending', claimed_by = NULL
+            WHERE status = 'sending' AND updated_at < ?
+        ''', (now - stale_after,))
+        conn.execute('''
+            UPDATE digest_outbox SET status = 'sending', claimed_by = ?, updated_at = ?
+            WHERE id IN (
+                SELECT id FROM digest_outbox
+                WHERE status = 'pending' AND not_before <= ?
+                ORDER BY id LIMIT ?
+            )
+        ''', (worker_id, now, now, limit))
+    return conn.execute('''
+        SELECT id, group_id, timezone, period_start, period_end, counts, retry_key, attempts
+        FROM digest_outbox
+        WHERE status = 'sending' AND claimed_by = ?
+        ORDER BY id
+    ''', (worker_id,)).fetchall()
+
+
+def mark(conn, digest_id, status, error=None, count_attempt=False, delay=0):
+    """更新摘要狀態；delay 秒內不再被認領"""
+    now = time.time()
+    with conn:
+        conn.execute('''
+            UPDATE digest_outbox
+            SET status = ?, error = ?, claimed_by = NULL, updated_at = ?,
+                attempts = attempts + ?, not_before = ?
+            WHERE id = ?
+        ''', (status, error, now, int(count_attempt), now + delay, digest_id))
+
+
+def copy_rows(source, target_for):
+    """將摘要排程、待送計數與尚未送出的摘要複製到群組所屬的資料庫（重新分片時使用）
+
+    target_for(group_id) 回傳目標連線；呼叫端負責提交。
+    """
+    for table in TABLES:
+        cursor = source.execute(
+            f"SELECT * FROM {table} WHERE status != 'sent'" if table == 'digest_outbox'
+            else f'SELECT * FROM {table}')
+        columns = [column[0] for column in cursor.description]
+        # 摘要佇列的編號在目標資料庫重新配發
+        keep = [index for index, column in enumerate(columns) if column != 'id']
+        group_index = columns.index('group_id')
+        insert_sql = (f"INSERT INTO {table} ({', '.join(columns[i] for i in keep)}) "
+                      f"VALUES ({_placeholders(keep)})")
+        for row in cursor:
+            target_for(row[group_index]).execute(insert_sql, [row[i] for i in keep])
+
+
+def format_period(period_start, period_end, timezone):
+    tz = ZoneInfo(timezone)
+    start = datetime.fromtimestamp(period_start / 1000, tz)
+    end = datetime.fromtimestamp(period_end / 1000, tz)
+    end_format = '%H:%M' if start.date() == end.date() else '%m/%d %H:%M'
+    return f"{start:%m/%d %H:%M} – {end.strftime(end_format)}"
+
+
+def split_messages(lines, limit=TEXT_LIMIT, max_messages=MAX_MESSAGES):
+    """將文字行合併為最多 max_messages 則、每則不超過 limit 字的訊息"""
+    messages, current = [], ''
+    for line in lines:
+        candidate = f'{current}\n{line}' if current else line
+        if len(candidate) <= limit:
+            current = candidate
+            continue
+        if current:
+            messages.append(current)
+            if len(messages) == max_messages:
+                return messages
+        current = line[:limit]
+    if current:
+        messages.append(current)
+    return messages[:max_messages]
+
+
+class DigestScheduler:
+    """摘要排程器：管理群組的摘要設定，並在背景關閉到期的期間、以 push 送出摘要
+
+    paths 為存放摘要資料表的資料庫（各分片），path_for(group_id) 回傳群組所屬的資料庫；
+    name_of(group_id, user_id) 為選用的名稱來源（例如群組成員名冊）。
+    """
+
+    def __init__(self, paths, line_client, path_for=None, name_of=None, interval=30, batch_size=50,
+                 max_users=20, stale_after=300):
+        self.paths = list(paths)
+        self.path_for = path_for or (lambda group_id: self.paths[0])
+        self.line_client = line_client
+        self.name_of = name_of
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_users = max_users
+        self.stale_after = stale_after
+        self.worker_id = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self._lock = threading.Lock()
+        self._counters = Counter()
+        self._last_run = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, paths, line_client, path_for=None, name_of=None):
+        return cls(
+            paths, line_client, path_for, name_of,
+            interval=float(os.getenv('DIGEST_INTERVAL', 30)),
+            max_users=int(os.getenv('DIGEST_MAX_USERS', 20)),
+        )
+
+    @staticmethod
+    def connect(db_path):
+        schema.ensure_schema(db_path)
+        return sqlite3.connect(db_path, timeout=5)
+
+    def start(self):
+        """啟動背景執行緒；interval 為 0 時不啟動（摘要設定仍可使用，由其他程序送出）"""
+        if self._thread is None and self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name='digest-scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"送出提及摘要時發生錯誤: {e}")
+
+    # 摘要設定
+
+    def set_schedule(self, group_id, frequency, send_at=None, timezone=None):
+        """設定群組的摘要頻率；已有設定時保留目前累積的計數，回傳下一次送出時間（毫秒）"""
+        timezone = timezone or timeutil.DISPLAY_TIMEZONE_NAME
+        now_ms = timeutil.now_ms()
+        following = next_run(frequency, send_at, timezone, now_ms)
+        conn = self.connect(self.path_for(group_id))
+        try:
+            with conn:
+                conn.execute('''
+                    INSERT INTO digest_schedules (group_id, frequency, send_at, timezone, period_start, next_run)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(group_id) DO UPDATE SET
+                        frequency = excluded.frequency,
+                        send_at = excluded.send_at,
+                        timezone = excluded.timezone,
+                        next_run = excluded.next_run
+                ''', (group_id, frequency, send_at, timezone, now_ms, following))
+        finally:
+            conn.close()
+        return following
+
+    def remove_schedule(self, group_id):
+        """停止群組的摘要並捨棄累積的計數，回傳原本是否有設定"""
+        conn = self.connect(self.path_for(group_id))
+        try:
+            with conn:
+                removed = conn.execute('DELETE FROM digest_schedules WHERE group_id = ?', (group_id,)).rowcount
+                conn.execute('DELETE FROM digest_pending WHERE group_id = ?', (group_id,))
+        finally:
+            conn.close()
+        return bool(removed)
+
+    def get_schedule(self, group_id):
+        conn = self.connect(self.path_for(group_id))
+        try:
+            row = conn.execute('''
+                SELECT frequency, send_at, timezone, period_start, next_run,
+                       (SELECT COALESCE(SUM(count), 0) FROM digest_pending WHERE group_id = ?)
+                FROM digest_schedules WHERE group_id = ?
+            ''', (group_id, group_id)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return dict(zip(('frequency', 'send_at', 'timezone', 'period_start', 'next_run', 'pending'), row))
+
+    def configure(self, group_id, args):
+        """回答 /digest 指令：查看、設定或停止摘要（參數錯誤時回覆用法）"""
+        if not args:
+            schedule = self.get_schedule(group_id)
+            if schedule is None:
+                return '📮 本群組尚未設定提及摘要\n' + USAGE_TEXT
+            return self._describe(schedule['frequency'], schedule['send_at'], schedule['timezone'],
+                                  schedule['next_run']) + f"\n目前累積 {schedule['pending']} 次提及"
+        if args == ['off']:
+            return '📮 已停止本群組的提及摘要' if self.remove_schedule(group_id) else '📮 本群組尚未設定提及摘要'
+        try:
+            frequency, send_at, timezone = parse_schedule(args)
+        except ValueError as e:
+            return f'⚠️ {e}\n{USAGE_TEXT}'
+        following = self.set_schedule(group_id, frequency, send_at, timezone)
+        return self._describe(frequency, send_at, timezone, following)
+
+    @staticmethod
+    def _describe(frequency, send_at, timezone, following):
+        when = f"{FREQUENCY_LABELS[frequency]} {send_at}" if send_at else FREQUENCY_LABELS[frequency]
+        upcoming = datetime.fromtimestamp(following / 1000, ZoneInfo(timezone))
+        return f"📮 本群組將{when} 送出提及摘要（{timezone}）\n下一次：{upcoming:%m/%d %H:%M}"
+
+    # 背景工作
+
+    def run_once(self, now_ms=None):
+        """關閉到期的期間並送出待送摘要，回傳送出的摘要數"""
+        now_ms = now_ms or timeutil.now_ms()
+        sent = 0
+        for path in self.paths:
+            conn = self.connect(path)
+            try:
+                closed, queued = close_due_periods(conn, now_ms)
+                rows = claim(conn, self.worker_id, self.batch_size, self.stale_after)
+                for row in rows:
+                    sent += self._send(conn, row)
+            finally:
+                conn.close()
+            with self._lock:
+                self._counters['closed'] += closed
+                self._counters['queued'] += queued
+        with self._lock:
+            self._last_run = now_ms
+        return sent
+
+    def _name(self, group_id, user_id, names):
+        name = names.get(user_id)
+        if name is None and self.name_of is not None:
+            name = self.name_of(group_id, user_id)
+        # 以名稱作為 ID 的提及（沒有對應到 LINE 使用者）直接顯示 ID
+        return name or (user_id if not is_line_user_id(user_id) else None)
+
+    def build_messages(self, conn, group_id, timezone, period_start, period_end, counts):
+        """組合摘要文字：每位被提及者的次數與提及他的成員（依次數排序）"""
+        by_user = {}
+        for user_id, sender_id, count in counts:
+            by_user.setdefault(user_id, Counter())[sender_id] += count
+        ranked = sorted(by_user.items(), key=lambda item: -sum(item[1].values()))
+        shown = ranked[:self.max_users]
+        names = display_names(conn, {user_id for user_id, _ in shown}
+                              | {sender for _, senders in shown for sender in senders if sender})
+
+        total = sum(count for _, _, count in counts)
+        lines = [f"📮 提及摘要（{format_period(period_start, period_end, timezone)}）",
+                 f"共 {total} 次提及，{len(by_user)} 位成員被提及"]
+        for user_id, senders in shown:
+            line = f"• {self._name(group_id, user_id, names) or '（未知成員）'} 被提及 {sum(senders.values())} 次"
+            known, unknown = [], senders.pop('', 0)
+            for sender, count in senders.most_common():
+                name = self._name(group_id, sender, names)
+                if name and len(known) < SENDER_LIMIT:
+                    known.append(f'{name}（{count}）')
+                else:
+                    unknown += count
+            if known:
+                if unknown:
+                    known.append(f'其他成員（{unknown}）')
+                line += '，來自 ' + '、'.join(known)
+            lines.append(line)
+        if len(ranked) > len(shown):
+            rest = ranked[len(shown):]
+            lines.append(f"…另有 {len(rest)} 位成員被提及 {sum(sum(s.values()) for _, s in rest)} 次")
+        return split_messages(lines)
+
+    def _send(self, conn, row):
+        digest_id, group_id, timezone, period_start, period_end, counts, retry_key, attempts = row
+        try:
+            texts = self.build_messages(conn, group_id, timezone, period_start, period_end, json.loads(counts))
+            response = self.line_client.push(group_id, self.line_client.text_messages(*texts), retry_key=retry_key)
+        except QuotaExceededError as e:
+            logger.warning(f"{e}，摘要保留至額度恢復")
+            mark(conn, digest_id, STATUS_PENDING, delay=QUOTA_RECHECK)
+            return 0
+        except Exception as e:
+            return self._retry_or_fail(conn, digest_id, attempts, str(e))
+
+        # 409：同一重試金鑰的請求已被接受（先前的嘗試已送達），視為已送出
+        if response.status_code in (200, 409):
+            mark(conn, digest_id, STATUS_SENT, count_attempt=True)
+            with self._lock:
+                self._counters['sent' if response.status_code == 200 else 'already_accepted'] += 1
+            return 1
+        if response.status_code == 429 or response.status_code >= 500:
+            return self._retry_or_fail(conn, digest_id, attempts, f'HTTP {response.status_code}')
+        # 其他 4xx（例如機器人已不在群組中）重試也不會成功
+        logger.error(f"送出群組 {group_id} 的提及摘要失敗: HTTP {response.status_code}")
+        mark(conn, digest_id, STATUS_FAILED, f'HTTP {response.status_code}', count_attempt=True)
+        with self._lock:
+            self._counters['failed'] += 1
+        return 0
+
+    def _retry_or_fail(self, conn, digest_id, attempts, error):
+        if attempts + 1 < MAX_ATTEMPTS:
+            logger.warning(f"送出提及摘要失敗 ({error})，稍後重試")
+            mark(conn, digest_id, STATUS_PENDING, error, count_attempt=True, delay=self.interval * 2)
+            key = 'retried'
+        else:
+            logger.error(f"送出提及摘要失敗 ({error})，已達重試上限")
+            mark(conn, digest_id, STATUS_FAILED, error, count_attempt=True)
+            key = 'failed'
+        with self._lock:
+            self._counters[key] += 1
+        return 0
+
+    def snapshot(self):
+        databases = {}
+        for path in self.paths:
+            conn = self.connect(path)
+            try:
+                databases[path] = {
+                    'schedules': conn.execute('SELECT COUNT(*) FROM digest_schedules').fetchone()[0],
+                    'pending_mentions': conn.execute(
+                        'SELECT COALESCE(SUM(count), 0) FROM digest_pending').fetchone()[0],
+                    'outbox': dict(conn.execute(
+                        'SELECT status, COUNT(*) FROM digest_outbox GROUP BY status').fetchall()),
+                }
+            finally:
+                conn.close()
+        with self._lock:
+            return {
+                'worker_id': self.worker_id,
+                'interval': self.interval,
+                'running': self._thread is not None,
+                'last_run': timeutil.isoformat(self._last_run),
+                'counters': dict(self._counters),
+                'databases': databases,
+            }
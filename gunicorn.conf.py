@@ -0,0 +1,26 @@
+"""
+gunicorn 設定
+DB_WRITER_MODE=process 時由 master 啟動單一提及寫入程序，各 worker 經由 Unix socket 送出寫入
+"""
+
+import os
+
+import mention_writer
+
+
+def on_starting(server):
+    """master 啟動時建立寫入程序（在 fork worker 之前）"""
+    if os.getenv('DB_WRITER_MODE') != 'process':
+        return
+
+    socket_path = os.environ.setdefault('MENTION_WRITER_SOCKET', mention_writer.DEFAULT_SOCKET_PATH)
+    server.mention_writer_process = mention_writer.start_writer_process(socket_path)
+    server.log.info(f"提及寫入程序已啟動 (pid {server.mention_writer_process.pid})")
+
+
+def on_exit(server):
+    """master 結束時一併停止寫入程序"""
+    process = getattr(server, 'mention_writer_process', None)
+    if process is not None and process.is_alive():
+        process.terminate()
+        process.join(timeout=5)
@@ -0,0 +1,305 @@
+"""
+HyperLogLog 近似相異計數
+依日與群組維護被提及使用者與群組的 HyperLogLog 摘要，由寫入路徑在同一交易內更新；
+任意日期範圍的相異數以合併摘要估算，不需掃描提及記錄
+
+精確度 PRECISION = 12（4096 個暫存器），
+相對標準誤差約 1.04 / √4096 ≈ 1.6%（約 95% 的估計值誤差在 3.3% 以內）
+
+儲存格式：非零暫存器不超過 SPARSE_MAX_ENTRIES 個時為稀疏格式，依索引排序的 (索引, 值) 每筆 3 bytes；
+超過時改為 4096 bytes 的密集格式。以長度區分兩種格式（密集格式長度不是 3 的倍數）。
+大多數「群組 × 日」的摘要只有幾位使用者，稀疏格式只需數十 bytes。
+"""
+
+import hashlib
+import sqlite3
+import struct
+from datetime import timedelta
+from math import log
+
+import rollups
+import timeutil
+
+PRECISION = 12
+REGISTERS = 1 << PRECISION
+RELATIVE_ERROR = 1.04 / REGISTERS ** 0.5
+
+# 摘要種類：被提及的使用者（可依群組）、有提及的群組（只有全部）
+USERS = 'users'
+GROUPS = 'groups'
+
+# 代表「全部群組」與「全部期間」的維度值
+ALL = rollups.ALL
+ALL_TIME = -(1 << 62)
+
+# 單次範圍查詢最多合併的日數
+MAX_DAYS = 3660
+
+# 稀疏格式最多的項目數（3 KB），超過時改存密集格式
+SPARSE_MAX_ENTRIES = 1024
+_SPARSE_ENTRY = struct.Struct('>HB')
+
+_HASH_BITS = 64
+_RANK_BITS = _HASH_BITS - PRECISION
+_RANK_MASK = (1 << _RANK_BITS) - 1
+_ALPHA = 0.7213 / (1 + 1.079 / REGISTERS)
+_INVERSE_POWERS = [2.0 ** -rank for rank in range(_RANK_BITS + 2)]
+
+# 合併時以整數一次比較所有暫存器（SWAR）：暫存器值小於 128，每個位元組的最高位元可作為比較結果
+_HIGH_BITS = int.from_bytes(b'\x80' * REGISTERS, 'big')
+_ALL_BITS = (1 << (8 * REGISTERS)) - 1
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def decode(data):
+    """將儲存格式（稀疏或密集）轉為密集暫存器 bytearray"""
+    if len(data) == REGISTERS:
+        return bytearray(data)
+    if len(data) % _SPARSE_ENTRY.size or len(data) > SPARSE_MAX_ENTRIES * _SPARSE_ENTRY.size:
+        raise ValueError(f"無效的摘要長度 {len(data)}")
+    registers = bytearray(REGISTERS)
+    for index, rank in _SPARSE_ENTRY.iter_unpack(data):
+        registers[index] = rank
+    return registers
+
+
+def encode(registers):
+    """將密集暫存器轉為儲存格式：非零暫存器不多時為稀疏格式"""
+    registers = bytes(registers)
+    if REGISTERS - registers.count(0) > SPARSE_MAX_ENTRIES:
+        return registers
+    return b''.join(_SPARSE_ENTRY.pack(index, rank) for index, rank in enumerate(registers) if rank)
+
+
+def is_sparse(data):
+    return len(data) != REGISTERS
+
+
+class HyperLogLog:
+    """HyperLogLog 摘要；可與其他摘要合併（取各暫存器最大值）"""
+
+    __slots__ = ('registers',)
+
+    def __init__(self, registers=None):
+        # 記憶體中一律為密集格式，接受稀疏或密集的儲存格式
+        self.registers = decode(registers) if registers is not None else bytearray(REGISTERS)
+
+    def add(self, value):
+        x = _hash(value)
+        index = x >> _RANK_BITS
+        rank = _RANK_BITS - (x & _RANK_MASK).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(merge_registers([self.registers, other.registers]))
+        return self
+
+    def count(self):
+        registers = bytes(self.registers)
+        # 依暫存器值分別計數（bytes.count 以 C 執行），避免逐一走訪 4096 個暫存器
+        harmonic = sum(registers.count(rank) * inverse for rank, inverse in enumerate(_INVERSE_POWERS))
+        estimate = _ALPHA * REGISTERS * REGISTERS / harmonic
+        zeros = registers.count(0)
+        # 小基數時改用線性計數（64 位元雜湊不需要大基數修正）
+        if estimate <= 2.5 * REGISTERS and zeros:
+            return round(REGISTERS * log(REGISTERS / zeros))
+        return round(estimate)
+
+    def to_bytes(self):
+        """儲存格式（稀疏或密集）"""
+        return encode(self.registers)
+
+
+def _merge_dense(merged, registers):
+    value = int.from_bytes(registers, 'big')
+    # 每個位元組 merged >= value 時最高位元為 1，展開為整個位元組的遮罩
+    greater = (((merged | _HIGH_BITS) - value) & _HIGH_BITS) >> 7
+    mask = greater * 0xFF
+    return (merged & mask) | (value & (_ALL_BITS ^ mask))
+
+
+def merge_registers(sketches):
+    """合併多個摘要（稀疏或密集格式，逐暫存器取最大值），回傳密集格式的 bytes
+
+    稀疏摘要的項目先逐一合併到同一個暫存器陣列，最後與密集摘要一起以整數比較（SWAR）合併。
+    """
+    merged = 0
+    sparse = None
+    for registers in sketches:
+        if not is_sparse(registers):
+            merged = _merge_dense(merged, registers)
+            continue
+        if len(registers) % _SPARSE_ENTRY.size or len(registers) > SPARSE_MAX_ENTRIES * _SPARSE_ENTRY.size:
+            raise ValueError(f"無效的摘要長度 {len(registers)}")
+        if sparse is None:
+            sparse = bytearray(REGISTERS)
+        for index, rank in _SPARSE_ENTRY.iter_unpack(registers):
+            if rank > sparse[index]:
+                sparse[index] = rank
+    if sparse is not None:
+        merged = _merge_dense(merged, sparse)
+    return merged.to_bytes(REGISTERS, 'big')
+
+
+def sketch_values(rows):
+    """將寫入的資料列整理成 {(種類, 群組, 時間桶): {值}}"""
+    values = {}
+    for user_id, _user_name, group_id, _message, _message_id, mentioned_at, *_ in rows:
+        mentioned_ms = timeutil.parse_stored(mentioned_at)
+        if mentioned_ms is None:
+            continue
+        group_id = group_id or ''
+        day = rollups.to_epoch(rollups.bucket_start(timeutil.from_ms(mentioned_ms), 'day'))
+        for bucket in (day, ALL_TIME):
+            values.setdefault((USERS, group_id, bucket), set()).add(user_id)
+            values.setdefault((USERS, ALL, bucket), set()).add(user_id)
+            values.setdefault((GROUPS, ALL, bucket), set()).add(group_id)
+    return values
+
+
+def record(conn, rows):
+    """在寫入交易中更新摘要（呼叫端負責提交）"""
+    for (kind, group_id, bucket), members in sketch_values(rows).items():
+        row = conn.execute(
+            'SELECT registers FROM mention_hll WHERE kind = ? AND group_id = ? AND bucket_start = ?',
+            (kind, group_id, bucket)
+        ).fetchone()
+        sketch = HyperLogLog(row[0] if row else None)
+        for member in members:
+            sketch.add(member)
+        registers = sketch.to_bytes()
+        if row is None or registers != row[0]:
+            conn.execute('''
+                INSERT OR REPLACE INTO mention_hll (kind, group_id, bucket_start, registers)
+                VALUES (?, ?, ?, ?)
+            ''', (kind, group_id, bucket, registers))
+
+
+def backfill(conn, batch_size=50000):
+    """由既有提及記錄重建所有摘要（結構升級時呼叫）"""
+    conn.execute('DELETE FROM mention_hll')
+    cursor = conn.execute('''
+        SELECT user_id, user_name, group_id, message, message_id, mentioned_at
+        FROM mentioned_users
+        WHERE mentioned_at IS NOT NULL
+    ''')
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        record(conn, rows)
+
+
+def compact(conn):
+    """將可用稀疏格式表示的密集摘要改寫為稀疏格式（結構升級時呼叫）"""
+    rows = conn.execute(
+        'SELECT kind, group_id, bucket_start, registers FROM mention_hll WHERE length(registers) = ?',
+        (REGISTERS,)
+    ).fetchall()
+    for kind, group_id, bucket, registers in rows:
+        encoded = encode(registers)
+        if is_sparse(encoded):
+            conn.execute('''
+                UPDATE mention_hll SET registers = ? WHERE kind = ? AND group_id = ? AND bucket_start = ?
+            ''', (encoded, kind, group_id, bucket))
+
+
+def day_range(start=None, end=None, default_days=30):
+    """將查詢範圍正規化為 (起始日, 結束日)（顯示時區，皆含當日）"""
+    start, end = [timeutil.to_display(moment) if moment else None for moment in (start, end)]
+    end = rollups.bucket_start(end or timeutil.now(), 'day')
+    start = rollups.bucket_start(start or end - timedelta(days=default_days - 1), 'day')
+    if start > end:
+        raise ValueError("start 不可晚於 end")
+    if (end - start).days >= MAX_DAYS:
+        raise ValueError(f"時間範圍過大（最多 {MAX_DAYS} 天）")
+    return start, end
+
+
+def _sketches(conn, kind, group_id, start, end):
+    return conn.execute('''
+        SELECT registers FROM mention_hll
+        WHERE kind = ? AND group_id = ? AND bucket_start BETWEEN ? AND ?
+    ''', (kind, group_id, start, end)).fetchall()
+
+
+def registers(conn, kind=USERS, group_id=None, start=None, end=None):
+    """取得範圍內各摘要的暫存器；未指定 start / end 時為全部期間的摘要
+
+    分片部署時由各資料庫取得後以 count_registers 合併估算。
+    start、end 為 datetime（含當日），以顯示時區的日期計算。
+    """
+    group_id = group_id or ALL
+    if start is None and end is None:
+        rows = _sketches(conn, kind, group_id, ALL_TIME, ALL_TIME)
+    else:
+        start, end = day_range(start, end)
+        rows = _sketches(conn, kind, group_id, rollups.to_epoch(start), rollups.to_epoch(end))
+    return [sketch for (sketch,) in rows]
+
+
+def count_registers(sketches):
+    """合併多個摘要並估算相異數"""
+    sketches = list(sketches)
+    if not sketches:
+        return 0
+    return HyperLogLog(merge_registers(sketches)).count()
+
+
+def estimate(conn, kind=USERS, group_id=None, start=None, end=None):
+    """估算相異數；未指定 start / end 時使用全部期間的摘要"""
+    return count_registers(registers(conn, kind, group_id, start, end))
+
+
+def _exact_query(select, kind, group_id, start, end):
+    column = 'user_id' if kind == USERS else 'group_id'
+    clauses, params = [], []
+    if group_id and group_id != ALL:
+        clauses.append('group_id = ?')
+        params.append(group_id)
+    if start is not None or end is not None:
+        start, end = day_range(start, end)
+        # 提及時間為毫秒，日界線預先算好後以索引範圍查詢
+        clauses.append('mentioned_at >= ? AND mentioned_at < ?')
+        params.extend([timeutil.day_bounds(start.date())[0], timeutil.day_bounds(end.date())[1]])
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    # 只需要使用者欄位時直接讀取 mentions，不必與訊息表 JOIN
+    table = 'mentioned_users' if clauses or kind != USERS else 'mentions'
+    return f'SELECT {select.format(column=column)} FROM {table} {where}', params
+
+
+def exact(conn, kind=USERS, group_id=None, start=None, end=None):
+    """以提及記錄精確計算相異數（全表或範圍掃描，較慢）"""
+    sql, params = _exact_query('COUNT(DISTINCT {column})', kind, group_id, start, end)
+    return conn.execute(sql, params).fetchone()[0]
+
+
+def exact_members(conn, kind=USERS, group_id=None, start=None, end=None):
+    """回傳相異值的集合（分片部署時跨資料庫聯集後精確計數）"""
+    sql, params = _exact_query('DISTINCT {column}', kind, group_id, start, end)
+    return {value for (value,) in conn.execute(sql, params) if value is not None}
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='HyperLogLog 相異計數摘要維護')
+    parser.add_argument('command', choices=['backfill'])
+    parser.add_argument('--db', default='line_data.db')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    try:
+        with conn:
+            backfill(conn)
+        print("✅ 已由提及記錄重建相異計數摘要")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,530 @@
+"""
+webhook 預寫日誌
+驗證過的 webhook 內容在處理與回應之前先附加到分段的日誌檔，處理完成後提交位移；
+程序在回應後、寫入資料庫前結束時，重新啟動會重播尚未提交的內容。
+
+- 每個程序寫入自己的日誌目錄（<JOURNAL_DIR>/<pid>-<啟動毫秒>），以 flock 鎖定；
+  啟動時鎖得到的目錄即屬於已結束的程序，重播其中未提交的記錄
+- 同時附加的請求共用一次 fsync（群組提交）
+- 記錄格式：位移、時間（毫秒）、鍵長度、內容長度、CRC32 + 鍵 + 內容；
+  讀取時遇到不完整或校驗失敗的記錄即停止（寫到一半的結尾）
+- 處理失敗與過載時延後（defer）的記錄由背景執行緒以 replay 處理，失敗 max_attempts 次後附加到根目錄的
+  dead-letter.log 並視為已處理，提交位移得以繼續前進（不會卡住保留期限與重啟後的重播）
+- 保留期限：已提交且超過 retention 秒的分段刪除；
+  壓縮：已提交的分段改寫為只保留 keep(內容) 為真的記錄，作為修正解析後重新處理的來源
+
+使用方式:
+    python journal.py list
+    python journal.py replay --since 2024-01-01T00:00 [--replace]
+"""
+
+import argparse
+import fcntl
+import logging
+import os
+import shutil
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('<QqHII')
+SEGMENT_SUFFIX = '.log'
+COMPACTED_SUFFIX = '.compacted.log'
+LOCK_FILE = 'lock'
+COMMITTED_FILE = 'committed'
+ATTEMPTS_FILE = 'attempts'
+DEAD_LETTER_FILE = 'dead-letter.log'
+
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+DEFAULT_RETENTION = 72 * 3600
+DEFAULT_MAINTENANCE_INTERVAL = 600
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_RETRY_INTERVAL = 30
+
+
+def _segment_base(name):
+    return int(name.split('.', 1)[0])
+
+
+def list_segments(directory):
+    """目錄中的分段檔（依起始位移排序）"""
+    try:
+        names = [name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX)]
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, name) for name in sorted(names, key=_segment_base)]
+
+
+def read_segment(path):
+    """逐筆讀取分段中的記錄 (offset, timestamp_ms, key, payload)"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    position = 0
+    while position + HEADER.size <= len(data):
+        offset, timestamp, key_length, length, checksum = HEADER.unpack_from(data, position)
+        start = position + HEADER.size
+        end = start + key_length + length
+        if end > len(data) or zlib.crc32(data[start:end]) != checksum:
+            logger.warning(f"日誌 {path} 在位置 {position} 之後不完整，略過其餘內容")
+            return
+        yield offset, timestamp, data[start:start + key_length], data[start + key_length:end]
+        position = end
+
+
+def read_records(directory, after=0):
+    """讀取目錄中位移大於 after 的所有記錄"""
+    for path in list_segments(directory):
+        for record in read_segment(path):
+            if record[0] > after:
+                yield record
+
+
+def read_committed(directory):
+    try:
+        with open(os.path.join(directory, COMMITTED_FILE), 'r') as f:
+            return int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def write_committed(directory, offset):
+    path = os.path.join(directory, COMMITTED_FILE)
+    with open(f'{path}.tmp', 'w') as f:
+        f.write(str(offset))
+    os.replace(f'{path}.tmp', path)
+
+
+def _pack(offset, timestamp, key, payload):
+    body = key + payload
+    return HEADER.pack(offset, timestamp, len(key), len(payload), zlib.crc32(body)) + body
+
+
+def write_dead_letter(root, offset, timestamp, key, payload):
+    """將無法處理的記錄附加到根目錄的 dead-letter.log（各程序共用，單次 write 附加）"""
+    fd = os.open(os.path.join(root, DEAD_LETTER_FILE), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, _pack(offset, timestamp, key, payload))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _read_attempts(directory):
+    try:
+        with open(os.path.join(directory, ATTEMPTS_FILE), 'r') as f:
+            offset, attempts = f.read().split()
+            return int(offset), int(attempts)
+    except (FileNotFoundError, ValueError):
+        return 0, 0
+
+
+def _write_attempts(directory, offset, attempts):
+    path = os.path.join(directory, ATTEMPTS_FILE)
+    with open(f'{path}.tmp', 'w') as f:
+        f.write(f'{offset} {attempts}')
+    os.replace(f'{path}.tmp', path)
+
+
+def _try_lock(directory):
+    """鎖定日誌目錄，已被執行中的程序鎖定時回傳 None"""
+    fd = os.open(os.path.join(directory, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _unlock(fd):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+class Journal:
+    """單一程序的 webhook 日誌（多執行緒共用）"""
+
+    def __init__(self, root, segment_bytes=DEFAULT_SEGMENT_BYTES, fsync=True,
+                 retention=DEFAULT_RETENTION, keep=None, maintenance_interval=DEFAULT_MAINTENANCE_INTERVAL,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, retry_interval=DEFAULT_RETRY_INTERVAL):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.retention = retention
+        self.keep = keep
+        self.maintenance_interval = maintenance_interval
+        self.max_attempts = max_attempts
+        self.retry_interval = retry_interval
+        self.directory = None
+        self._lock = threading.Lock()
+        self._lock_fd = None
+        self._fd = None
+        self._segment_size = 0
+        self._next_offset = 1
+        self._written = 0
+        self._synced = 0
+        self._committed = 0
+        self._done = set()
+        # 尚未提交的記錄 → 附加時間（移到 dead-letter 時保留原本的時間）
+        self._timestamps = {}
+        self._retry = {}
+        self._dead_lettered = 0
+        self._replay = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, root=None, keep=None):
+        """由環境變數建立日誌；JOURNAL_DIR 設為空字串時停用（回傳 None）"""
+        root = root if root is not None else os.getenv('JOURNAL_DIR', 'journal')
+        if not root:
+            return None
+        return cls(root,
+                   segment_bytes=int(float(os.getenv('JOURNAL_SEGMENT_MB', 16)) * 1024 * 1024),
+                   fsync=os.getenv('JOURNAL_FSYNC', '1') == '1',
+                   retention=int(float(os.getenv('JOURNAL_RETENTION_HOURS', 72)) * 3600),
+                   keep=keep,
+                   max_attempts=int(os.getenv('JOURNAL_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)))
+
+    def open(self):
+        """建立並鎖定本程序的日誌目錄
+
+        先以暫存名稱（. 開頭，其他程序的維護與重播不會處理）建立並鎖定，再改名為正式名稱，
+        避免其他程序在鎖定前將剛建立的空目錄視為已結束程序的目錄刪除。
+        """
+        if self.directory is not None:
+            return self
+        os.makedirs(self.root, exist_ok=True)
+        name = f'{os.getpid()}-{int(time.time() * 1000)}'
+        staging = os.path.join(self.root, f'.{name}.tmp')
+        os.makedirs(staging)
+        lock_fd = _try_lock(staging)
+        if lock_fd is None:
+            raise RuntimeError(f"無法鎖定日誌目錄 {staging}")
+        directory = os.path.join(self.root, name)
+        os.rename(staging, directory)
+        self._lock_fd = lock_fd
+        self.directory = directory
+        self._open_segment()
+        return self
+
+    def _open_segment(self):
+        path = os.path.join(self.directory, f'{self._next_offset:020d}{SEGMENT_SUFFIX}')
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._segment_size = 0
+
+    def append(self, payload, key=b''):
+        """附加一筆記錄並（啟用 fsync 時）等待寫入磁碟，回傳位移"""
+        with self._lock:
+            offset = self._next_offset
+            self._next_offset += 1
+            timestamp = int(time.time() * 1000)
+            self._timestamps[offset] = timestamp
+            record = _pack(offset, timestamp, key, payload)
+            os.write(self._fd, record)
+            self._segment_size += len(record)
+            self._written = offset
+            if self._segment_size >= self.segment_bytes:
+                # 換新分段前確保舊分段已寫入磁碟
+                if self.fsync:
+                    os.fsync(self._fd)
+                    self._synced = offset
+                os.close(self._fd)
+                self._open_segment()
+        if self.fsync:
+            self._sync(offset)
+        return offset
+
+    def _sync(self, offset):
+        # 等待鎖的期間其他執行緒可能已完成涵蓋此記錄的 fsync；否則一次 fsync 涵蓋目前所有已寫入的記錄
+        with self._lock:
+            if self._synced >= offset:
+                return
+            os.fsync(self._fd)
+            self._synced = self._written
+
+    def commit(self, offset):
+        """標記記錄已處理；提交位移只在連續完成時前進"""
+        with self._lock:
+            self._retry.pop(offset, None)
+            self._timestamps.pop(offset, None)
+            self._done.add(offset)
+            committed = self._committed
+            while committed + 1 in self._done:
+                committed += 1
+                self._done.discard(committed)
+            if committed != self._committed:
+                self._committed = committed
+                write_committed(self.directory, committed)
+
+    def fail(self, offset, payload, key=b''):
+        """標記記錄處理失敗：由背景執行緒重試，失敗 max_attempts 次後移到 dead-letter 並視為已處理"""
+        with self._lock:
+            attempts = self._retry.pop(offset, (None, None, 0))[2] + 1
+            if attempts < self.max_attempts:
+                self._retry[offset] = (payload, key, attempts)
+                return
+        self._dead_letter(offset, payload, key, attempts)
+
+    def defer(self, offset, payload, key=b''):
+        """將記錄交給背景執行緒處理（過載時只寫入日誌的 webhook），不計入失敗次數"""
+        with self._lock:
+            self._retry[offset] = (payload, key, 0)
+
+    def _dead_letter(self, offset, payload, key, attempts):
+        logger.error(f"日誌記錄 {offset} 處理失敗 {attempts} 次，移到 {DEAD_LETTER_FILE}")
+        with self._lock:
+            timestamp = self._timestamps.get(offset) or int(time.time() * 1000)
+        write_dead_letter(self.root, offset, timestamp, key, payload)
+        with self._lock:
+            self._dead_lettered += 1
+        self.commit(offset)
+
+    def retry_pending(self):
+        """以 replay 處理失敗或延後（defer）的記錄，回傳成功筆數"""
+        with self._lock:
+            failed = sorted(self._retry.items())
+        retried = 0
+        for offset, (payload, key, attempts) in failed:
+            if self._replay is None:
+                self.fail(offset, payload, key)
+                continue
+            try:
+                self._replay(payload, key)
+            except Exception as e:
+                logger.warning(f"重試日誌記錄 {offset} 失敗（第 {attempts + 1} 次）: {e}")
+                self.fail(offset, payload, key)
+                continue
+            self.commit(offset)
+            retried += 1
+        return retried
+
+    def recover(self, replay):
+        """重播已結束程序的日誌中未提交的記錄：replay(payload, key)，回傳重播筆數
+
+        重播失敗時保留該目錄，下次啟動再試；同一筆記錄累計失敗 max_attempts 次後移到 dead-letter 並略過。
+        """
+        replayed = 0
+        for directory in self._orphans():
+            fd = _try_lock(directory)
+            if fd is None:
+                continue
+            try:
+                committed = read_committed(directory)
+                for offset, timestamp, key, payload in read_records(directory, committed):
+                    try:
+                        replay(payload, key)
+                    except Exception as e:
+                        failed_offset, attempts = _read_attempts(directory)
+                        attempts = attempts + 1 if failed_offset == offset else 1
+                        if attempts < self.max_attempts:
+                            _write_attempts(directory, offset, attempts)
+                            raise
+                        logger.error(f"重播日誌 {directory} 的記錄 {offset} 失敗 {attempts} 次，"
+                                     f"移到 {DEAD_LETTER_FILE}: {e}")
+                        write_dead_letter(self.root, offset, timestamp, key, payload)
+                    else:
+                        replayed += 1
+                    write_committed(directory, offset)
+            except Exception as e:
+                logger.error(f"重播日誌 {directory} 時發生錯誤: {e}")
+            finally:
+                _unlock(fd)
+        if replayed:
+            logger.info(f"已重播 {replayed} 筆未處理的 webhook")
+        return replayed
+
+    def _orphans(self):
+        try:
+            names = sorted(os.listdir(self.root))
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.root, name) for name in names
+                if not name.startswith('.') and os.path.join(self.root, name) != self.directory
+                and os.path.isdir(os.path.join(self.root, name))]
+
+    def maintain(self, now=None):
+        """對已提交的分段執行保留期限與壓縮，回傳 (刪除的分段數, 壓縮的分段數)"""
+        now = time.time() if now is None else now
+        deleted = compacted = 0
+        with self._lock:
+            current = self._current_segment()
+            committed = self._committed
+        if self.directory is not None:
+            d, c = self._maintain_directory(self.directory, committed, now, exclude=current)
+            deleted, compacted = deleted + d, compacted + c
+        for directory in self._orphans():
+            fd = _try_lock(directory)
+            if fd is None:
+                continue
+            try:
+                d, c = self._maintain_directory(directory, read_committed(directory), now)
+                deleted, compacted = deleted + d, compacted + c
+                if not list_segments(directory):
+                    shutil.rmtree(directory, ignore_errors=True)
+            finally:
+                _unlock(fd)
+        return deleted, compacted
+
+    def _current_segment(self):
+        if self.directory is None:
+            return None
+        segments = list_segments(self.directory)
+        return segments[-1] if segments else None
+
+    def _maintain_directory(self, directory, committed, now, exclude=None):
+        deleted = compacted = 0
+        for path in list_segments(directory):
+            if path == exclude:
+                continue
+            records = list(read_segment(path))
+            if records and records[-1][0] > committed:
+                # 含有未提交的記錄，之後的分段也尚未處理完
+                break
+            if not records or records[-1][1] < (now - self.retention) * 1000:
+                os.remove(path)
+                deleted += 1
+            elif self.keep is not None and not path.endswith(COMPACTED_SUFFIX):
+                self._compact(path, records)
+                compacted += 1
+        return deleted, compacted
+
+    def _compact(self, path, records):
+        base = path[:-len(SEGMENT_SUFFIX)]
+        target = base + COMPACTED_SUFFIX
+        with open(f'{target}.tmp', 'wb') as f:
+            for offset, timestamp, key, payload in records:
+                if self.keep(payload):
+                    f.write(_pack(offset, timestamp, key, payload))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{target}.tmp', target)
+        os.remove(path)
+
+    def start(self, replay=None):
+        """開啟日誌並啟動背景維護；replay(payload, key) 用於重試處理失敗的記錄"""
+        self._replay = replay
+        self.open()
+        if self._thread is None and (self.maintenance_interval > 0 or self.retry_interval > 0):
+            self._thread = threading.Thread(target=self._run, name='journal-maintenance', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        intervals = [interval for interval in (self.retry_interval, self.maintenance_interval) if interval > 0]
+        last_maintenance = time.monotonic()
+        while not self._stop.wait(min(intervals)):
+            try:
+                if self.retry_interval > 0:
+                    self.retry_pending()
+                if self.maintenance_interval > 0 and time.monotonic() - last_maintenance >= self.maintenance_interval:
+                    last_maintenance = time.monotonic()
+                    self.maintain()
+            except Exception as e:
+                logger.error(f"日誌維護時發生錯誤: {e}")
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            if self._fd is not None:
+                if self.fsync:
+                    os.fsync(self._fd)
+                os.close(self._fd)
+                self._fd = None
+            if self._lock_fd is not None:
+                _unlock(self._lock_fd)
+                self._lock_fd = None
+
+    def status(self):
+        with self._lock:
+            return {
+                'directory': self.directory,
+                'written': self._written,
+                'synced': self._synced,
+                'committed': self._committed,
+                'pending': self._written - self._committed,
+                'retry_pending': len(self._retry),
+                'dead_lettered': self._dead_lettered,
+            }
+
+
+def iter_all(root, since_ms=None, until_ms=None):
+    """依時間讀取日誌根目錄下所有程序的記錄 (timestamp_ms, key, payload)"""
+    records = []
+    for name in sorted(os.listdir(root)):
+        directory = os.path.join(root, name)
+        if not os.path.isdir(directory):
+            continue
+        for _, timestamp, key, payload in read_records(directory):
+            if (since_ms is None or timestamp >= since_ms) and (until_ms is None or timestamp < until_ms):
+                records.append((timestamp, key, payload))
+    records.sort(key=lambda record: record[0])
+    return records
+
+
+# 離線重播時匯入 app_simple 的環境變數：不啟動背景工作（通知、摘要、分區 worker、日誌重播），
+# 不開啟本程序的日誌目錄，只建立解析與寫入提及記錄需要的部分
+REPLAY_ENV = {
+    'FAST_STARTUP': '1',
+    'JOURNAL_DIR': '',
+    'PROCESSING_WORKERS': '0',
+    'NOTIFY_MENTIONS': '0',
+    'DIGEST_INTERVAL': '0',
+    'SNAPSHOT_INTERVAL': '0',
+    'ROLLUP_COMPACT_INTERVAL': '0',
+}
+
+
+def replay(root, since_ms=None, until_ms=None, replace=False):
+    """以目前的解析程式重新處理日誌根目錄中的 webhook（離線工具），回傳 (webhook 數, 寫入的訊息數)
+
+    只儲存提及記錄，不回覆、不通知，也不會重播或寫入執行中服務的日誌。
+    """
+    records = iter_all(root, since_ms, until_ms)
+    os.environ.update(REPLAY_ENV)
+    import app_simple
+    app_simple.init_db()
+    return len(records), app_simple.replay_webhooks([payload for _, _, payload in records], replace=replace)
+
+
+def main():
+    import timeutil
+    from datetime import datetime
+
+    parser = argparse.ArgumentParser(description='webhook 日誌')
+    parser.add_argument('--dir', default=os.getenv('JOURNAL_DIR', 'journal'))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list', help='列出日誌目錄與分段')
+    replay_parser = subparsers.add_parser('replay', help='以目前的解析程式重新處理日誌中的 webhook')
+    replay_parser.add_argument('--since', help='起始時間（ISO 8601，顯示時區）')
+    replay_parser.add_argument('--until', help='結束時間（ISO 8601，顯示時區）')
+    replay_parser.add_argument('--replace', action='store_true',
+                               help='先刪除已儲存的同一訊息再重新寫入，並重建彙總（請先停止服務）')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        for name in sorted(os.listdir(args.dir)):
+            directory = os.path.join(args.dir, name)
+            if not os.path.isdir(directory):
+                continue
+            print(f"{name}（已提交至 {read_committed(directory)}）")
+            for path in list_segments(directory):
+                records = list(read_segment(path))
+                span = f"{records[0][0]}–{records[-1][0]}" if records else '空'
+                print(f"  {os.path.basename(path)}  {os.path.getsize(path):>10,} bytes  位移 {span}")
+        dead_letter = os.path.join(args.dir, DEAD_LETTER_FILE)
+        if os.path.exists(dead_letter):
+            print(f"{DEAD_LETTER_FILE}（{len(list(read_segment(dead_letter)))} 筆無法處理的記錄）")
+        return
+
+    since = timeutil.to_ms(datetime.fromisoformat(args.since)) if args.since else None
+    until = timeutil.to_ms(datetime.fromisoformat(args.until)) if args.until else None
+    replayed, count = replay(args.dir, since, until, args.replace)
+    print(f"已重新處理 {replayed} 個 webhook，寫入 {count} 則訊息")
+
+
+if __name__ == "__main__":
+    main()
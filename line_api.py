@@ -0,0 +1,265 @@
+"""
+LINE Messaging API 對外客戶端
+共用連線池的 requests.Session，並統計每月訊息用量
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import schema
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = 'https://api.line.me'
+
+# 免費方案每月可發送的推播訊息數；回覆訊息（reply）不計入
+DEFAULT_MONTHLY_QUOTA = 200
+
+# 需計入每月額度的發送種類
+QUOTA_KINDS = ('push', 'multicast')
+
+# 推播到群組或聊天室時依成員數計入額度；成員數快取的秒數
+MEMBER_COUNT_TTL = 3600
+
+
+class QuotaExceededError(Exception):
+    """本月推播額度已用完"""
+
+
+class MessageQuota:
+    """每月訊息用量追蹤
+
+    推播（push / multicast）依收件人數計入額度並寫入資料庫，重啟後仍可延續；
+    回覆僅在記憶體中統計次數，供觀察用。
+    """
+
+    def __init__(self, db_path='line_data.db', monthly_limit=DEFAULT_MONTHLY_QUOTA):
+        self.db_path = db_path
+        self.monthly_limit = monthly_limit
+        self._lock = threading.Lock()
+        self._replies = 0
+        self._cached_month = None
+        self._cached_used = 0
+
+    @staticmethod
+    def current_month():
+        return datetime.now().strftime('%Y-%m')
+
+    def _connect(self):
+        schema.ensure_schema(self.db_path)
+        return sqlite3.connect(self.db_path, timeout=5)
+
+    def used(self):
+        """本月已使用的推播訊息數"""
+        month = self.current_month()
+        with self._lock:
+            if self._cached_month != month:
+                conn = self._connect()
+                try:
+                    row = conn.execute(
+                        'SELECT COALESCE(SUM(sent), 0) FROM line_message_usage WHERE month = ?',
+                        (month,)
+                    ).fetchone()
+                finally:
+                    conn.close()
+                self._cached_month = month
+                self._cached_used = row[0]
+            return self._cached_used
+
+    def remaining(self):
+        return max(0, self.monthly_limit - self.used())
+
+    def record(self, kind, count=1):
+        """記錄一次發送；推播種類會寫入資料庫"""
+        if kind not in QUOTA_KINDS:
+            with self._lock:
+                self._replies += count
+            return
+
+        month = self.current_month()
+        self.used()  # 確保快取為本月
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('''
+                    INSERT INTO line_message_usage (month, kind, sent) VALUES (?, ?, ?)
+                    ON CONFLICT(month, kind) DO UPDATE SET sent = sent + excluded.sent
+                ''', (month, kind, count))
+        finally:
+            conn.close()
+        with self._lock:
+            if self._cached_month == month:
+                self._cached_used += count
+
+    def snapshot(self):
+        used = self.used()
+        with self._lock:
+            replies = self._replies
+        return {
+            'month': self.current_month(),
+            'monthly_limit': self.monthly_limit,
+            'push_used': used,
+            'push_remaining': max(0, self.monthly_limit - used),
+            'replies_sent': replies,
+        }
+
+
+class LineApiClient:
+    """LINE Messaging API 客戶端"""
+
+    def __init__(self, channel_access_token, base_url=None, quota=None, pool_size=10, timeout=10):
+        self.channel_access_token = channel_access_token
+        self.base_url = (base_url or os.getenv('LINE_API_BASE_URL') or DEFAULT_BASE_URL).rstrip('/')
+        self.quota = quota
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._member_counts = {}
+
+    @property
+    def session(self):
+        """第一次對外呼叫時才建立 Session（requests 匯入較慢，延後以加快冷啟動）"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+
+                    # 以連線池重用 TLS 連線，避免每次呼叫重新握手
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    session.headers.update({
+                        'Content-Type': 'application/json',
+                        'Authorization': f'Bearer {self.channel_access_token}',
+                    })
+                    self._session = session
+        return self._session
+
+    def _post(self, path, data, headers=None):
+        return self.session.post(f'{self.base_url}{path}', json=data, headers=headers, timeout=self.timeout)
+
+    def _get(self, path, params=None):
+        return self.session.get(f'{self.base_url}{path}', params=params, timeout=self.timeout)
+
+    @staticmethod
+    def text_messages(*texts):
+        return [{'type': 'text', 'text': text} for text in texts]
+
+    def reply(self, reply_token, messages):
+        """以 reply token 回覆訊息"""
+        response = self._post('/v2/bot/message/reply', {
+            'replyToken': reply_token,
+            'messages': messages,
+        })
+        if response.status_code == 200 and self.quota is not None:
+            self.quota.record('reply')
+        return response
+
+    def reply_text(self, reply_token, text):
+        return self.reply(reply_token, self.text_messages(text))
+
+    def _check_quota(self, recipients):
+        if self.quota is not None and self.quota.remaining() < recipients:
+            raise QuotaExceededError(f"本月推播額度不足（剩餘 {self.quota.remaining()}，需要 {recipients}）")
+
+    def recipient_count(self, to):
+        """推播對象計入額度的人數：使用者為 1，群組與聊天室為成員數（快取 MEMBER_COUNT_TTL 秒）
+
+        無法取得成員數時以 1 計算並記錄警告。
+        """
+        if to.startswith('U'):
+            return 1
+        cached = self._member_counts.get(to)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+        kind = 'room' if to.startswith('R') else 'group'
+        count = None
+        try:
+            response = self._get(f'/v2/bot/{kind}/{to}/members/count')
+            if response.status_code == 200:
+                count = response.json().get('count')
+        except Exception as e:
+            logger.warning(f"獲取 {to} 成員數時發生錯誤: {e}")
+        if not count:
+            logger.warning(f"無法取得 {to} 的成員數，推播以 1 人計入額度")
+            return 1
+        self._member_counts[to] = (count, time.monotonic() + MEMBER_COUNT_TTL)
+        return count
+
+    def push(self, to, messages, retry_key=None, recipients=None):
+        """推播訊息給單一使用者或群組（計入每月額度）
+
+        推播到群組或聊天室時 LINE 依成員數計費，recipients 未指定時以 recipient_count 取得。
+        retry_key 為 UUID：以同一金鑰重送時 LINE 不會重複送出，改回應 409。
+        """
+        recipients = recipients if recipients is not None else self.recipient_count(to)
+        self._check_quota(recipients)
+        response = self._post('/v2/bot/message/push', {'to': to, 'messages': messages},
+                              {'X-Line-Retry-Key': retry_key} if retry_key else None)
+        if response.status_code == 200 and self.quota is not None:
+            self.quota.record('push', recipients)
+        return response
+
+    def multicast(self, to, messages):
+        """一次推播給多位使用者（最多 500 人，依人數計入每月額度）"""
+        self._check_quota(len(to))
+        response = self._post('/v2/bot/message/multicast', {'to': list(to), 'messages': messages})
+        if response.status_code == 200 and self.quota is not None:
+            self.quota.record('multicast', len(to))
+        return response
+
+    def get_profile(self, user_id):
+        """獲取使用者資料，失敗時回傳 None"""
+        response = self._get(f'/v2/bot/profile/{user_id}')
+        return response.json() if response.status_code == 200 else None
+
+    def get_group_member_profile(self, group_id, user_id):
+        """獲取群組成員資料，失敗時回傳 None"""
+        response = self._get(f'/v2/bot/group/{group_id}/member/{user_id}')
+        return response.json() if response.status_code == 200 else None
+
+    def get_group_member_ids(self, group_id):
+        """獲取群組所有成員 ID（自動處理分頁），任何一頁失敗時拋出 RuntimeError（不回傳部分列表）"""
+        member_ids = []
+        params = None
+        while True:
+            response = self._get(f'/v2/bot/group/{group_id}/members/ids', params)
+            if response.status_code != 200:
+                raise RuntimeError(f"無法取得群組 {group_id} 的成員列表: HTTP {response.status_code}")
+            data = response.json()
+            member_ids.extend(data.get('memberIds', []))
+            if not data.get('next'):
+                return member_ids
+            params = {'start': data['next']}
+
+    def get_group_member_names(self, group_id):
+        """獲取群組所有成員的 (使用者 ID, 顯示名稱)
+
+        回傳的是完整名冊：成員列表或任何一位成員的資料取得失敗（例如 429、5xx）時拋出 RuntimeError；
+        只有 404（取得列表後已離開群組）的成員略過。
+        """
+        member_ids = self.get_group_member_ids(group_id)
+        if not member_ids:
+            raise RuntimeError(f"無法取得群組 {group_id} 的成員列表")
+        members = []
+        for user_id in member_ids:
+            response = self._get(f'/v2/bot/group/{group_id}/member/{user_id}')
+            if response.status_code == 404:
+                continue
+            if response.status_code != 200:
+                raise RuntimeError(f"無法取得群組 {group_id} 成員 {user_id} 的資料: HTTP {response.status_code}")
+            display_name = response.json().get('displayName')
+            if display_name:
+                members.append((user_id, display_name))
+        return members
+
+    def get_group_member_name(self, group_id, user_id):
+        profile = self.get_group_member_profile(group_id, user_id)
+        return profile.get('displayName') if profile else None
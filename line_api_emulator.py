@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+"""
+本機 LINE Messaging API 替身
+承接 reply / push / multicast、使用者資料與群組成員 API，記錄收到的請求，
+並可注入延遲、錯誤（500）與速率限制（429），供離線測試對外呼叫的吞吐量與容錯
+
+- 延遲分布：fixed:毫秒、uniform:下限:上限、normal:平均:標準差、lognormal:中位數:sigma、exponential:平均
+  可依端點種類（reply / push / multicast / profile / member_profile / member_ids / member_count）分別設定
+- 回覆權杖：只能使用一次，超過有效時間（預設 60 秒）後回應 400；
+  以 issue_reply_token() 或 POST /emulator/reply-tokens 取得的權杖才有發出時間，
+  其他權杖視為第一次使用時發出（--strict-reply-tokens 時一律拒絕）
+- 重試金鑰：push / multicast 帶有已接受過的 X-Line-Retry-Key 時不再記錄，回應 409
+- 請求紀錄：只保留最近 --max-recorded 筆（預設 1000），長時間壓測時記憶體不會持續成長
+- 群組成員：未以 add_group() 設定的群組自動產生固定的 --members-per-group 位成員
+- GET /emulator/stats 回傳各端點的回應狀態統計，POST /emulator/config 在執行中調整延遲與錯誤設定
+
+使用方式:
+    python line_api_emulator.py --port 8081
+    python line_api_emulator.py --latency lognormal:80:0.5 --latency profile=fixed:20 --error-rate 0.01 --rate-limit 200
+    LINE_API_BASE_URL=http://127.0.0.1:8081 python app_simple.py
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import secrets
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+MULTICAST_LIMIT = 500
+MAX_MESSAGES = 5
+# 群組成員 ID 每頁筆數（與 LINE API 相同）
+MEMBER_IDS_PAGE_SIZE = 1000
+DEFAULT_REPLY_TOKEN_TTL = 60
+DEFAULT_MEMBERS_PER_GROUP = 20
+DEFAULT_MAX_RECORDED = 1000
+
+KINDS = ('reply', 'push', 'multicast', 'profile', 'member_profile', 'member_ids', 'member_count')
+
+POST_ROUTES = {
+    '/v2/bot/message/reply': 'reply',
+    '/v2/bot/message/push': 'push',
+    '/v2/bot/message/multicast': 'multicast',
+}
+GET_ROUTES = [
+    (re.compile(r'^/v2/bot/profile/(?P<user_id>[^/]+)$'), 'profile'),
+    (re.compile(r'^/v2/bot/group/(?P<group_id>[^/]+)/member/(?P<user_id>[^/]+)$'), 'member_profile'),
+    (re.compile(r'^/v2/bot/group/(?P<group_id>[^/]+)/members/ids$'), 'member_ids'),
+    (re.compile(r'^/v2/bot/group/(?P<group_id>[^/]+)/members/count$'), 'member_count'),
+]
+
+RATE_LIMIT_MESSAGE = 'The API rate limit has been exceeded. Try again later.'
+
+
+class LatencyModel:
+    """回應延遲分布（毫秒）"""
+
+    def __init__(self, kind='fixed', params=(0,)):
+        self.kind = kind
+        self.params = tuple(params)
+
+    @classmethod
+    def parse(cls, spec):
+        """解析「分布:參數...」，例如 lognormal:80:0.5；只有數字時視為固定延遲"""
+        name, *params = str(spec).split(':')
+        if not params:
+            return cls('fixed', (float(name),))
+        expected = {'fixed': 1, 'uniform': 2, 'normal': 2, 'lognormal': 2, 'exponential': 1}
+        if expected.get(name) != len(params):
+            raise ValueError(f"無法解析延遲設定: {spec!r}")
+        return cls(name, tuple(float(p) for p in params))
+
+    def sample(self, rng):
+        """抽樣一次延遲，回傳秒數"""
+        if self.kind == 'fixed':
+            ms = self.params[0]
+        elif self.kind == 'uniform':
+            ms = rng.uniform(*self.params)
+        elif self.kind == 'normal':
+            ms = rng.gauss(*self.params)
+        elif self.kind == 'lognormal':
+            median, sigma = self.params
+            ms = median * rng.lognormvariate(0, sigma) if median > 0 else 0
+        else:
+            ms = rng.expovariate(1 / self.params[0]) if self.params[0] > 0 else 0
+        return max(0.0, ms) / 1000
+
+    def __str__(self):
+        return ':'.join([self.kind, *(f'{p:g}' for p in self.params)])
+
+
+class TokenBucket:
+    """每秒 rate 個請求、可累積 burst 個的速率限制"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class LineApiEmulator:
+    """LINE API 替身伺服器，可在測試中直接啟動並檢查收到的請求"""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=None, error_rate=0.0, throttle_rate=0.0,
+                 rate_limit=0, reply_token_ttl=DEFAULT_REPLY_TOKEN_TTL, strict_reply_tokens=False,
+                 members_per_group=DEFAULT_MEMBERS_PER_GROUP, seed=None, max_recorded=DEFAULT_MAX_RECORDED):
+        # 只保留最近的請求；壓測時大量請求不會讓記憶體無限成長
+        self.requests = deque(maxlen=max_recorded)
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self._latency = {}
+        self._rate_limiter = None
+        self._reply_tokens = {}
+        self._retry_keys = set()
+        self._groups = {}
+        self._stats = Counter()
+        self.error_rate = 0.0
+        self.throttle_rate = 0.0
+        self.reply_token_ttl = reply_token_ttl
+        self.strict_reply_tokens = strict_reply_tokens
+        self.members_per_group = members_per_group
+        self.configure(latency=latency or {}, error_rate=error_rate, throttle_rate=throttle_rate,
+                       rate_limit=rate_limit)
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def configure(self, latency=None, error_rate=None, throttle_rate=None, rate_limit=None,
+                  reply_token_ttl=None, strict_reply_tokens=None):
+        """調整延遲與錯誤設定；latency 為 {端點種類或 '*': 分布}，只更新有給的項目"""
+        with self._lock:
+            for kind, spec in (latency or {}).items():
+                if kind != '*' and kind not in KINDS:
+                    raise ValueError(f"未知的端點種類: {kind}")
+                self._latency[kind] = spec if isinstance(spec, LatencyModel) else LatencyModel.parse(spec)
+            if error_rate is not None:
+                self.error_rate = float(error_rate)
+            if throttle_rate is not None:
+                self.throttle_rate = float(throttle_rate)
+            if rate_limit is not None:
+                self._rate_limiter = TokenBucket(float(rate_limit)) if float(rate_limit) > 0 else None
+            if reply_token_ttl is not None:
+                self.reply_token_ttl = float(reply_token_ttl)
+            if strict_reply_tokens is not None:
+                self.strict_reply_tokens = bool(strict_reply_tokens)
+
+    def config(self):
+        with self._lock:
+            return {
+                'latency': {kind: str(model) for kind, model in self._latency.items()},
+                'error_rate': self.error_rate,
+                'throttle_rate': self.throttle_rate,
+                'rate_limit': self._rate_limiter.rate if self._rate_limiter else 0,
+                'reply_token_ttl': self.reply_token_ttl,
+                'strict_reply_tokens': self.strict_reply_tokens,
+                'members_per_group': self.members_per_group,
+            }
+
+    def issue_reply_token(self, age=0.0):
+        """發出回覆權杖；age 秒表示權杖已發出多久（用於測試過期）"""
+        token = secrets.token_hex(16)
+        with self._lock:
+            self._reply_tokens[token] = time.monotonic() - age
+        return token
+
+    def add_group(self, group_id, members):
+        """設定群組成員 [(使用者 ID, 顯示名稱)]"""
+        with self._lock:
+            self._groups[group_id] = list(members)
+
+    def group_members(self, group_id):
+        with self._lock:
+            members = self._groups.get(group_id)
+        if members is not None:
+            return members
+        # 未設定的群組：依群組 ID 產生固定的成員
+        return [(f"U{hashlib.md5(f'{group_id}:{i}'.encode()).hexdigest()}", f'成員{i}')
+                for i in range(self.members_per_group)]
+
+    def received(self, path=None):
+        with self._lock:
+            return [r for r in self.requests if path is None or r['path'] == path]
+
+    def stats(self):
+        """各端點種類的回應狀態次數 {種類: {狀態碼: 次數}}"""
+        with self._lock:
+            result = {}
+            for (kind, status), count in sorted(self._stats.items()):
+                result.setdefault(kind, {})[str(status)] = count
+            return result
+
+    def _record(self, path, body):
+        with self._lock:
+            self.requests.append({'path': path, 'body': body})
+
+    def _count(self, kind, status):
+        with self._lock:
+            self._stats[kind, status] += 1
+
+    def _inject(self, kind):
+        """抽樣延遲與注入的錯誤，回傳 (延遲秒數, 錯誤回應或 None)"""
+        with self._lock:
+            model = self._latency.get(kind) or self._latency.get('*')
+            delay = model.sample(self._rng) if model else 0.0
+            if self._rate_limiter is not None and not self._rate_limiter.take():
+                return delay, (429, {'message': RATE_LIMIT_MESSAGE})
+            roll = self._rng.random()
+        if roll < self.throttle_rate:
+            return delay, (429, {'message': RATE_LIMIT_MESSAGE})
+        if roll < self.throttle_rate + self.error_rate:
+            return delay, (500, {'message': 'Internal server error'})
+        return delay, None
+
+    def _use_reply_token(self, token):
+        """檢查並用掉回覆權杖，無效時回傳錯誤訊息"""
+        now = time.monotonic()
+        with self._lock:
+            issued = self._reply_tokens.get(token)
+            if issued is None:
+                if self.strict_reply_tokens or not token:
+                    return 'Invalid reply token'
+                issued = now
+            elif issued < 0:
+                return 'Invalid reply token'
+            if now - issued > self.reply_token_ttl:
+                self._reply_tokens[token] = -1
+                return 'Invalid reply token'
+            # 已使用的權杖以 -1 標記
+            self._reply_tokens[token] = -1
+        return None
+
+    def _handle_post(self, kind, body, retry_key=None):
+        messages = body.get('messages') or []
+        if not 1 <= len(messages) <= MAX_MESSAGES:
+            return 400, {'message': f'Size must be between 1 and {MAX_MESSAGES}'}
+        if kind == 'multicast' and not 1 <= len(body.get('to', [])) <= MULTICAST_LIMIT:
+            return 400, {'message': f'Size must be between 1 and {MULTICAST_LIMIT}'}
+        if kind == 'reply':
+            error = self._use_reply_token(body.get('replyToken'))
+            if error:
+                return 400, {'message': error}
+        elif retry_key:
+            with self._lock:
+                if retry_key in self._retry_keys:
+                    return 409, {'message': 'The retry key is already accepted'}
+                self._retry_keys.add(retry_key)
+        return 200, {}
+
+    def _handle_get(self, kind, params, query):
+        if kind == 'profile':
+            user_id = params['user_id']
+            if not user_id.startswith('U'):
+                return 404, {'message': 'Not found'}
+            return 200, {'userId': user_id, 'displayName': f'使用者{user_id[-6:]}', 'language': 'zh-TW'}
+
+        members = self.group_members(params['group_id'])
+        if kind == 'member_count':
+            return 200, {'count': len(members)}
+        if kind == 'member_ids':
+            start = int(query.get('start', ['0'])[0] or 0)
+            page = members[start:start + MEMBER_IDS_PAGE_SIZE]
+            payload = {'memberIds': [user_id for user_id, _ in page]}
+            if start + MEMBER_IDS_PAGE_SIZE < len(members):
+                payload['next'] = str(start + MEMBER_IDS_PAGE_SIZE)
+            return 200, payload
+        for user_id, name in members:
+            if user_id == params['user_id']:
+                return 200, {'userId': user_id, 'displayName': name}
+        return 404, {'message': 'Not found'}
+
+    def _handler_class(self):
+        emulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self, status, payload):
+                data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _read_body(self):
+                length = int(self.headers.get('Content-Length', 0))
+                return json.loads(self.rfile.read(length) or b'{}')
+
+            def _serve(self, kind, handle):
+                if not self.headers.get('Authorization', '').startswith('Bearer '):
+                    status, payload = 401, {'message': 'Authentication failed'}
+                else:
+                    delay, error = emulator._inject(kind)
+                    if delay:
+                        time.sleep(delay)
+                    status, payload = error or handle()
+                emulator._count(kind, status)
+                self._respond(status, payload)
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path == '/emulator/stats':
+                    return self._respond(200, emulator.stats())
+                if url.path == '/emulator/config':
+                    return self._respond(200, emulator.config())
+                for pattern, kind in GET_ROUTES:
+                    match = pattern.match(url.path)
+                    if match:
+                        return self._serve(kind, lambda: emulator._handle_get(
+                            kind, match.groupdict(), parse_qs(url.query)))
+                self._respond(404, {'message': 'Not found'})
+
+            def do_POST(self):
+                try:
+                    body = self._read_body()
+                except ValueError:
+                    return self._respond(400, {'message': 'The request body has 1 error(s)'})
+
+                if self.path == '/emulator/config':
+                    try:
+                        emulator.configure(**body)
+                    except (TypeError, ValueError) as e:
+                        return self._respond(400, {'message': str(e)})
+                    return self._respond(200, emulator.config())
+                if self.path == '/emulator/reply-tokens':
+                    count = int(body.get('count', 1))
+                    age = float(body.get('age', 0))
+                    return self._respond(200, {'replyTokens': [emulator.issue_reply_token(age) for _ in range(count)]})
+
+                kind = POST_ROUTES.get(self.path)
+                if kind is None:
+                    return self._respond(404, {'message': 'Not found'})
+
+                def handle():
+                    status, payload = emulator._handle_post(kind, body, self.headers.get('X-Line-Retry-Key'))
+                    if status == 200:
+                        emulator._record(self.path, body)
+                    return status, payload
+                self._serve(kind, handle)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def parse_latency_args(values):
+    """把 --latency [種類=]分布 轉成 {種類: 分布}，未指定種類時套用到所有端點（'*'）"""
+    latency = {}
+    for value in values or []:
+        kind, _, spec = value.rpartition('=')
+        latency[kind or '*'] = LatencyModel.parse(spec)
+    return latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本機 LINE Messaging API 替身')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', action='append', metavar='[KIND=]DIST',
+                        help='延遲分布，例如 lognormal:80:0.5 或 reply=fixed:50（可重複）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='回應 500 的比例')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='隨機回應 429 的比例')
+    parser.add_argument('--rate-limit', type=float, default=0, help='每秒請求上限，超過時回應 429（0 為不限）')
+    parser.add_argument('--reply-token-ttl', type=float, default=DEFAULT_REPLY_TOKEN_TTL, help='回覆權杖有效秒數')
+    parser.add_argument('--strict-reply-tokens', action='store_true', help='拒絕非替身發出的回覆權杖')
+    parser.add_argument('--members-per-group', type=int, default=DEFAULT_MEMBERS_PER_GROUP)
+    parser.add_argument('--seed', type=int, help='延遲與錯誤抽樣的亂數種子')
+    parser.add_argument('--max-recorded', type=int, default=DEFAULT_MAX_RECORDED, help='保留最近幾筆請求紀錄')
+    args = parser.parse_args()
+
+    emulator = LineApiEmulator(
+        args.host, args.port,
+        latency=parse_latency_args(args.latency),
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        rate_limit=args.rate_limit,
+        reply_token_ttl=args.reply_token_ttl,
+        strict_reply_tokens=args.strict_reply_tokens,
+        members_per_group=args.members_per_group,
+        seed=args.seed,
+        max_recorded=args.max_recorded,
+    )
+    print(f"LINE API 替身已啟動: {emulator.base_url}")
+    print(f"設定: {json.dumps(emulator.config(), ensure_ascii=False)}")
+    try:
+        emulator.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
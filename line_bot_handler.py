@@ -8,56 +8,233 @@ from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage,
     GroupSource, UserSource, MentionEvent
 )
-import sqlite3
-import json
+import hashlib
 import re
-from datetime import datetime
 import logging
+import admission
+import digests
+import hll
+import journal
+import mention_writer
+import recent_feed
+import rollups
+import roster
+import schema
+import timeutil
+from chat_commands import ChatCommands, parse_command
+from reply_policy import ReplyPolicy, merge_by_group
+import line_api
+import notifier
+import os
 
-# 設定日誌
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class LineBotMentionHandler:
-    def __init__(self, channel_access_token, channel_secret):
-        self.line_bot_api = LineBotApi(channel_access_token)
+    def __init__(self, channel_access_token, channel_secret, db_path=mention_writer.DB_PATH, channel_name=None):
+        self.db_path = db_path
+        # LINE_API_BASE_URL 可指向本機 LINE API 替身（line_api_emulator.py）
+        self.line_bot_api = LineBotApi(channel_access_token,
+                                       endpoint=os.getenv('LINE_API_BASE_URL') or line_api.DEFAULT_BASE_URL)
         self.handler = WebhookHandler(channel_secret)
+        self.reply_policy = ReplyPolicy.from_env(self.send_reply, self.generate_reply_message)
+        
+        # 推播（通知 multicast、摘要 push）使用共用連線池的客戶端
+        self.push_client = line_api.LineApiClient(channel_access_token, quota=line_api.MessageQuota(db_path))
+        
+        # 提及通知（NOTIFY_MENTIONS=1 時啟用）
+        self.notify_mentions = os.getenv('NOTIFY_MENTIONS') == '1'
+        if self.notify_mentions:
+            self.notification_queue = notifier.NotificationQueue(
+                db_path, dedup_window=int(os.getenv('NOTIFY_DEDUP_SECONDS', 600)))
+            self.notification_dispatcher = notifier.NotificationDispatcher(self.notification_queue, self.push_client)
+            self.notification_dispatcher.start()
+        
+        # 群組成員名冊：把「@顯示名稱」對應到使用者 ID
+        self.roster = roster.RosterCache.from_env(self.fetch_group_member_names, self.fetch_group_member_name)
+        # 定期提及摘要（群組以 /digest 設定）
+        self.digest_scheduler = digests.DigestScheduler.from_env([db_path], self.push_client,
+                                                                 name_of=self.roster.name_of)
+        self.digest_scheduler.start()
+        # 群組內指令（/mentions me、/top week、/stats、/digest、/notify）
+        self.chat_commands = ChatCommands.from_env(self.run_query, self.roster.name_of, self.digest_scheduler,
+                                                   self.notification_queue if self.notify_mentions else None)
         self.setup_handlers()
+        
+        # webhook 預寫日誌（每個頻道一個日誌目錄），啟動時重播未處理完的請求
+        journal_root = os.getenv('JOURNAL_DIR', 'journal')
+        self.journal = journal.Journal.from_env(
+            os.path.join(journal_root, self.journal_name(db_path, channel_name)) if journal_root else '')
+        if self.journal is not None:
+            self.journal.start(self.replay_webhook)
+            self.journal.recover(self.replay_webhook)
     
+    @staticmethod
+    def journal_name(db_path, channel_name=None):
+        """日誌目錄名稱：頻道名稱（tenants 保證唯一）；未指定時以資料庫完整路徑的雜湊區分
+
+        不可只用檔名：不同目錄下同名的資料庫會共用日誌，重播時把一個頻道的 webhook 寫入另一個頻道。
+        """
+        if channel_name:
+            return channel_name
+        digest = hashlib.sha1(os.path.abspath(db_path).encode('utf-8')).hexdigest()[:12]
+        return f"{os.path.splitext(os.path.basename(db_path))[0]}-{digest}"
+
     def setup_handlers(self):
         """設定事件處理器"""
         self.handler.add(MessageEvent, message=TextMessage)(self.handle_text_message)
     
-    def handle_text_message(self, event):
-        """處理文字訊息事件"""
+    def handle_webhook(self, body, signature, level=admission.NORMAL, deferred=False):
+        """驗證簽名並批次處理 webhook 中的所有事件（簽名錯誤時拋出 InvalidSignatureError）
+
+        驗證後先寫入日誌，提及記錄全部儲存成功後才提交位移；寫入失敗時由日誌重試。
+        deferred（過載時超過排隊時間預算）且啟用日誌時只寫入日誌，由日誌的背景執行緒處理。
+        """
+        events = self.handler.parser.parse(body, signature)
+        offset = self.journal.append(body.encode('utf-8'), signature.encode('utf-8')) if self.journal else None
+        if deferred and offset is not None:
+            self.journal.defer(offset, body.encode('utf-8'), signature.encode('utf-8'))
+            return
         try:
-            # 檢查是否為群組訊息
-            if isinstance(event.source, GroupSource):
-                group_id = event.source.group_id
-                user_id = event.source.user_id
-                message_text = event.message.text
-                
-                logger.info(f"收到群組訊息: {message_text}")
-                
-                # 檢查是否包含 @ 提及
-                if self.contains_mention(message_text):
-                    mentioned_users = self.parse_mentions(message_text, group_id)
-                    
-                    if mentioned_users:
-                        # 儲存提及記錄
-                        self.save_mentions(mentioned_users, group_id, message_text, event.message.id, user_id)
-                        
-                        # 回覆確認訊息
-                        reply_text = self.generate_reply_message(mentioned_users)
-                        self.line_bot_api.reply_message(
-                            event.reply_token,
-                            TextSendMessage(text=reply_text)
-                        )
-                        
-                        logger.info(f"已記錄 {len(mentioned_users)} 個提及")
-                
-        except Exception as e:
-            logger.error(f"處理訊息時發生錯誤: {e}")
+            complete = self.handle_events(events, level)
+        except Exception:
+            if offset is not None:
+                self.journal.fail(offset, body.encode('utf-8'), signature.encode('utf-8'))
+            raise
+        if offset is not None:
+            if complete:
+                self.journal.commit(offset)
+            else:
+                self.journal.fail(offset, body.encode('utf-8'), signature.encode('utf-8'))
+    
+    def replay_webhook(self, payload, key):
+        """重播日誌中的 webhook（略過已儲存的訊息，不回覆、不通知）"""
+        events = self.handler.parser.parse(payload.decode('utf-8'), key.decode('utf-8'))
+        message_ids = [event.message.id for event in events if isinstance(event, MessageEvent)]
+        if message_ids:
+            conn = mention_writer.connect_reader(self.db_path)
+            try:
+                placeholders = ','.join('?' * len(message_ids))
+                stored = {row[0] for row in conn.execute(
+                    f'SELECT message_id FROM messages WHERE message_id IN ({placeholders})', message_ids)}
+            finally:
+                conn.close()
+            events = [event for event in events
+                      if not isinstance(event, MessageEvent) or event.message.id not in stored]
+        if not self.handle_events(events, admission.PERSIST_ONLY):
+            raise RuntimeError("重播的提及記錄未能全部寫入")
+    
+    def handle_events(self, events, level=admission.NORMAL):
+        """批次處理一個 webhook 請求中的事件
+
+        所有事件的提及記錄以一次寫入儲存、通知以一次交易排入，確認訊息依群組合併；
+        單一事件解析或寫入失敗不影響其他事件。
+        level 為准入控制的降級等級：SKIP_REPLIES 以上略過回覆，PERSIST_ONLY 另略過通知。
+        回傳提及記錄是否全部儲存成功。
+        """
+        parsed = []
+        for event in events:
+            try:
+                mentioned_users = self.parse_event(event)
+            except Exception as e:
+                logger.error(f"處理訊息時發生錯誤: {e}")
+                continue
+            if mentioned_users:
+                parsed.append((event, mentioned_users))
+        if not parsed:
+            if level < admission.SKIP_REPLIES:
+                self.answer_commands(events)
+            return True
+        
+        # 儲存提及記錄
+        written = self.save_mention_batch(parsed)
+        recorded = [item for item, ok in zip(parsed, written) if ok]
+        
+        # 通知被提及者
+        if self.notify_mentions and recorded and level < admission.PERSIST_ONLY:
+            try:
+                self.notification_queue.enqueue_many([
+                    (mentioned_users, event.source.group_id, event.message.text,
+                     event.message.id, event.source.user_id)
+                    for event, mentioned_users in recorded
+                ])
+            except Exception as e:
+                logger.error(f"排入提及通知時發生錯誤: {e}")
+        
+        logger.info(f"已記錄 {sum(len(users) for _, users in recorded)} 個提及（{len(recorded)} 則訊息）")
+        if level >= admission.SKIP_REPLIES:
+            # 降級時略過確認回覆，只保留提及記錄
+            return all(written)
+        
+        # 回覆確認訊息（依群組回覆策略決定立即回覆、合併或不回覆）
+        for group_id, reply_token, mentioned_users in merge_by_group([
+            (event.source.group_id, event.reply_token, mentioned_users)
+            for event, mentioned_users in recorded
+        ]):
+            try:
+                reply_text = self.reply_policy.acknowledge(group_id, reply_token, mentioned_users)
+                if reply_text:
+                    try:
+                        self.send_reply(reply_token, reply_text)
+                    except Exception:
+                        self.reply_policy.record_reply(False)
+                        raise
+                    self.reply_policy.record_reply(True)
+            except Exception as e:
+                logger.error(f"回覆訊息時發生錯誤: {e}")
+        self.answer_commands(events)
+        return all(written)
+    
+    def answer_commands(self, events):
+        """回答群組內指令"""
+        for event in events:
+            if not isinstance(event, MessageEvent) or not isinstance(event.message, TextMessage):
+                continue
+            if not isinstance(event.source, GroupSource):
+                continue
+            reply_text = self.chat_commands.answer(event.source.group_id, event.source.user_id, event.message.text)
+            if reply_text:
+                try:
+                    self.send_reply(event.reply_token, reply_text)
+                except Exception as e:
+                    logger.error(f"回覆指令時發生錯誤: {e}")
+    
+    def run_query(self, group_id, func, *args):
+        """在資料庫執行 func(conn, *args)"""
+        conn = mention_writer.connect_reader(self.db_path)
+        try:
+            return func(conn, *args)
+        finally:
+            conn.close()
+    
+    def handle_text_message(self, event):
+        """處理單一文字訊息事件"""
+        self.handle_events([event])
+    
+    def parse_event(self, event):
+        """解析單一事件中的 @ 提及（非群組文字訊息或沒有提及時回傳空列表）"""
+        if not isinstance(event, MessageEvent) or not isinstance(event.message, TextMessage):
+            return []
+        
+        # 檢查是否為群組訊息
+        if not isinstance(event.source, GroupSource):
+            return []
+        
+        message_text = event.message.text
+        logger.info(f"收到群組訊息: {message_text}")
+        
+        # 更新群組成員名冊（LINE 提供的提及位置，以及背景補齊名冊）
+        mention = getattr(event.message, 'mention', None)
+        self.roster.learn_mentionees(event.source.group_id, message_text, [
+            (mentionee.index, mentionee.length, mentionee.user_id)
+            for mentionee in (mention.mentionees if mention else [])
+            if getattr(mentionee, 'user_id', None)
+        ])
+        self.roster.observe(event.source.group_id, event.source.user_id)
+        
+        # 檢查是否包含 @ 提及（群組內指令不記錄為提及）
+        if not self.contains_mention(message_text) or parse_command(message_text):
+            return []
+        return self.parse_mentions(message_text, event.source.group_id)
     
     def contains_mention(self, text):
         """檢查文字是否包含 @ 提及"""
@@ -74,9 +251,26 @@ class LineBotMentionHandler:
         return False
     
     def parse_mentions(self, text, group_id):
-        """解析訊息中的 @ 提及"""
+        """解析訊息中的 @ 提及
+
+        先以群組成員名冊比對（名稱可含空白，對應到真正的使用者 ID）；
+        名冊不完整時，其餘的 @ 文字以正則表達式解析。
+        """
         mentioned_users = []
         
+        for start, end, user_id, user_name in self.roster.find(group_id, text):
+            if not any(user['user_id'] == user_id for user in mentioned_users):
+                mentioned_users.append({
+                    'user_name': user_name,
+                    'user_id': user_id,
+                    'group_id': group_id
+                })
+            # 已對應到成員的部分不再以正則表達式解析
+            text = text[:start] + ' ' * (end - start) + text[end:]
+        if self.roster.is_complete(group_id):
+            # 完整名冊中沒有的 @ 文字不是群組成員
+            return mentioned_users
+        
         # 多種提及格式的正則表達式
         mention_patterns = [
             r'@(\w+)',  # @英文名稱
@@ -97,31 +291,21 @@ class LineBotMentionHandler:
         
         return mentioned_users
     
-    def save_mentions(self, mentioned_users, group_id, message, message_id, sender_id):
-        """儲存提及記錄到資料庫"""
-        try:
-            conn = sqlite3.connect('line_data.db')
-            cursor = conn.cursor()
-            
-            for user in mentioned_users:
-                cursor.execute('''
-                    INSERT INTO mentioned_users 
-                    (user_id, user_name, group_id, message, message_id, mentioned_at)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (
-                    user['user_id'],
-                    user['user_name'],
-                    group_id,
-                    message,
-                    message_id,
-                    datetime.now().isoformat()
-                ))
-            
-            conn.commit()
-            conn.close()
-            
-        except Exception as e:
-            logger.error(f"儲存提及記錄時發生錯誤: {e}")
+    def save_mention_batch(self, parsed):
+        """以一次寫入儲存一批事件的提及記錄，回傳每個事件是否儲存成功"""
+        return mention_writer.submit_mention_batches([
+            mention_writer.build_mention_rows(mentioned_users, event.source.group_id,
+                                              event.message.text, event.message.id, event.timestamp,
+                                              event.source.user_id)
+            for event, mentioned_users in parsed
+        ], self.db_path)
+    
+    def send_reply(self, reply_token, reply_text):
+        """送出回覆訊息"""
+        self.line_bot_api.reply_message(
+            reply_token,
+            TextSendMessage(text=reply_text)
+        )
     
     def generate_reply_message(self, mentioned_users):
         """生成回覆訊息"""
@@ -140,6 +324,22 @@ class LineBotMentionHandler:
             logger.error(f"獲取群組成員時發生錯誤: {e}")
             return []
     
+    def fetch_group_member_names(self, group_id):
+        """以 LINE API 取得群組所有成員的 (使用者 ID, 顯示名稱)"""
+        members = []
+        start = None
+        while True:
+            page = self.line_bot_api.get_group_member_ids(group_id, start=start)
+            for user_id in page.member_ids:
+                profile = self.line_bot_api.get_group_member_profile(group_id, user_id)
+                members.append((user_id, profile.display_name))
+            start = page.next
+            if not start:
+                return members
+    
+    def fetch_group_member_name(self, group_id, user_id):
+        return self.line_bot_api.get_group_member_profile(group_id, user_id).display_name
+    
     def get_user_profile(self, user_id):
         """獲取使用者資料"""
         try:
@@ -155,83 +355,47 @@ class DatabaseManager:
     def __init__(self, db_path='line_data.db'):
         self.db_path = db_path
         self.init_database()
+        # 最近提及記錄的環形緩衝，由寫入路徑附加新記錄
+        self.recent_mentions = recent_feed.RecentMentions(db_path)
+        mention_writer.add_listener(self._record_recent)
+    
+    def _record_recent(self, rows, db_path):
+        if db_path == self.db_path:
+            self.recent_mentions.record_rows(rows)
     
     def init_database(self):
-        """初始化資料庫"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # 建立提及記錄表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS mentioned_users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                user_name TEXT,
-                group_id TEXT,
-                message TEXT,
-                mentioned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                message_id TEXT,
-                sender_id TEXT
-            )
-        ''')
-        
-        # 建立群組資訊表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS groups (
-                group_id TEXT PRIMARY KEY,
-                group_name TEXT,
-                member_count INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # 建立使用者資訊表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id TEXT PRIMARY KEY,
-                display_name TEXT,
-                picture_url TEXT,
-                status_message TEXT,
-                first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        """初始化資料庫（結構已是最新版本時不執行 DDL）"""
+        schema.ensure_schema(self.db_path)
     
-    def get_mention_statistics(self):
-        """獲取提及統計資料"""
-        conn = sqlite3.connect(self.db_path)
+    def get_mention_statistics(self, exact=False):
+        """獲取提及統計資料（使用者與群組數量預設為 HyperLogLog 估計值，exact=True 時精確計算）"""
+        conn = mention_writer.connect_reader(self.db_path)
         cursor = conn.cursor()
         
         # 總提及次數
-        cursor.execute('SELECT COUNT(*) FROM mentioned_users')
+        cursor.execute('SELECT COUNT(*) FROM mentions')
         total_mentions = cursor.fetchone()[0]
         
-        # 被提及的使用者數量
-        cursor.execute('SELECT COUNT(DISTINCT user_id) FROM mentioned_users')
-        unique_users = cursor.fetchone()[0]
-        
-        # 群組數量
-        cursor.execute('SELECT COUNT(DISTINCT group_id) FROM mentioned_users')
-        group_count = cursor.fetchone()[0]
+        # 被提及的使用者數量與群組數量
+        count_distinct = hll.exact if exact else hll.estimate
+        unique_users = count_distinct(conn, hll.USERS)
+        group_count = count_distinct(conn, hll.GROUPS)
         
         # 最常被提及的使用者
         cursor.execute('''
             SELECT user_name, COUNT(*) as mention_count
-            FROM mentioned_users
+            FROM mentions
             GROUP BY user_id, user_name
             ORDER BY mention_count DESC
             LIMIT 10
         ''')
         top_users = [{'user_name': row[0], 'count': row[1]} for row in cursor.fetchall()]
         
-        # 今日提及次數
+        # 今日（顯示時區）提及次數
         cursor.execute('''
             SELECT COUNT(*) FROM mentioned_users 
-            WHERE DATE(mentioned_at) = DATE('now')
-        ''')
+            WHERE mentioned_at >= ? AND mentioned_at < ?
+        ''', timeutil.today_bounds())
         today_mentions = cursor.fetchone()[0]
         
         conn.close()
@@ -244,28 +408,22 @@ class DatabaseManager:
             'today_mentions': today_mentions
         }
     
+    def get_unique_users(self, group_id=None, start=None, end=None, exact=False):
+        """期間內被提及的相異使用者數（以日為單位）"""
+        conn = mention_writer.connect_reader(self.db_path)
+        try:
+            return (hll.exact if exact else hll.estimate)(conn, hll.USERS, group_id, start, end)
+        finally:
+            conn.close()
+    
     def get_recent_mentions(self, limit=20):
-        """獲取最近的提及記錄"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT user_id, user_name, group_id, message, mentioned_at, message_id
-            FROM mentioned_users
-            ORDER BY mentioned_at DESC
-            LIMIT ?
-        ''', (limit,))
-        
-        mentions = []
-        for row in cursor.fetchall():
-            mentions.append({
-                'user_id': row[0],
-                'user_name': row[1],
-                'group_id': row[2],
-                'message': row[3],
-                'mentioned_at': row[4],
-                'message_id': row[5]
-            })
-        
-        conn.close()
-        return mentions 
\ No newline at end of file
+        """獲取最近的提及記錄（由記憶體內的環形緩衝提供）"""
+        return [record.to_dict() for record in self.recent_mentions.latest(limit)]
+    
+    def get_timeseries(self, resolution='hour', start=None, end=None, group_id=None, user_id=None):
+        """獲取提及次數時間序列（由預先彙總的時間桶查詢）"""
+        conn = mention_writer.connect_reader(self.db_path)
+        try:
+            return rollups.query(conn, resolution, start, end, group_id, user_id)
+        finally:
+            conn.close()
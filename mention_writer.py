@@ -0,0 +1,448 @@
+"""
+提及記錄寫入器
+統一 SQLite 的寫入路徑；多 worker 部署時由單一寫入程序獨佔資料庫
+"""
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import queue
+from itertools import groupby
+
+import digests
+import hll
+import rollups
+import schema
+import timeutil
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = 'line_data.db'
+DEFAULT_SOCKET_PATH = '/tmp/line_mention_writer.sock'
+
+# 直接寫入模式下等待寫入鎖的時間與重試次數
+BUSY_TIMEOUT_MS = 5000
+DIRECT_WRITE_RETRIES = 3
+
+# 寫入程序單次交易最多合併的批次數
+MAX_BATCHES_PER_COMMIT = 256
+
+# 寫入程序等待批次提交的上限（秒），需小於客戶端的 socket 逾時
+BATCH_WAIT_TIMEOUT = 8
+
+INSERT_MESSAGE_SQL = '''
+    INSERT INTO messages (message_id, group_id, sender_id, message, created_at)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+INSERT_MENTION_SQL = '''
+    INSERT INTO mentions (message_ref, user_id, user_name)
+    VALUES (?, ?, ?)
+'''
+
+# 使用者 ID 對應的最新顯示名稱（群組內指令以此顯示名稱，不必掃描提及記錄）
+UPSERT_USER_NAME_SQL = '''
+    INSERT INTO users (user_id, display_name) VALUES (?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET display_name = excluded.display_name, last_seen = CURRENT_TIMESTAMP
+'''
+
+
+def writer_socket_path():
+    """取得寫入程序的 Unix socket 路徑（未設定時為直接寫入模式）"""
+    # 每次呼叫才讀取環境變數：gunicorn master 在 fork worker 前才會設定
+    return os.getenv('MENTION_WRITER_SOCKET')
+
+
+def build_mention_rows(mentioned_users, group_id, message, message_id, mentioned_at=None, sender_id=None):
+    """將解析結果轉換為寫入用的資料列（提及時間為 UTC epoch 毫秒，預設為目前時間）
+
+    資料列為 (user_id, user_name, group_id, message, message_id, mentioned_at, sender_id)；
+    sender_id 為選用的第 7 欄，只寫入訊息資料表。
+    """
+    mentioned_at = mentioned_at or timeutil.now_ms()
+    return [
+        (
+            user['user_id'],
+            user['user_name'],
+            group_id,
+            message,
+            message_id,
+            mentioned_at,
+            sender_id
+        )
+        for user in mentioned_users
+    ]
+
+
+def connect(db_path=DB_PATH):
+    """建立寫入用連線（WAL 模式，遇到寫入鎖時等待而非立即失敗）"""
+    schema.ensure_schema(db_path)
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def connect_reader(db_path=DB_PATH):
+    """建立讀取用連線；寫入程序模式下以唯讀方式開啟"""
+    if writer_socket_path() and os.path.exists(db_path):
+        return sqlite3.connect(f'file:{db_path}?mode=ro', uri=True,
+                               timeout=BUSY_TIMEOUT_MS / 1000)
+    return sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000)
+
+
+def insert_rows(conn, rows, skip_stored=False):
+    """寫入資料列並更新衍生的彙總資料（呼叫端負責交易），回傳實際寫入的資料列
+
+    同一則訊息的資料列（相鄰且訊息編號、群組、內容與時間相同）只寫入一列訊息。
+    skip_stored 為 True 時略過訊息編號已儲存的資料列（webhook 重送、寫入程序逾時後退回直接寫入）。
+    """
+    if skip_stored:
+        rows = _unstored_rows(conn, rows)
+        if not rows:
+            return []
+    for (group_id, message, message_id, mentioned_at), mentions in groupby(
+            rows, key=lambda row: (row[2], row[3], row[4], row[5])):
+        mentions = list(mentions)
+        sender_id = mentions[0][6] if len(mentions[0]) > 6 else None
+        message_ref = conn.execute(INSERT_MESSAGE_SQL, (message_id, group_id, sender_id, message, mentioned_at)).lastrowid
+        conn.executemany(INSERT_MENTION_SQL, [(message_ref, row[0], row[1]) for row in mentions])
+    record_user_names(conn, rows)
+    rollups.record(conn, rows)
+    hll.record(conn, rows)
+    digests.record(conn, rows)
+    return rows
+
+
+def _unstored_rows(conn, rows):
+    message_ids = list({row[4] for row in rows if row[4] is not None})
+    if not message_ids:
+        return rows
+    placeholders = ','.join('?' * len(message_ids))
+    stored = {row[0] for row in conn.execute(
+        f'SELECT message_id FROM messages WHERE message_id IN ({placeholders})', message_ids)}
+    return [row for row in rows if row[4] not in stored]
+
+
+def record_user_names(conn, rows):
+    """更新被提及者的顯示名稱（以名稱作為 ID 的提及不需要對應）"""
+    names = {row[0]: row[1] for row in rows if row[1] and row[1] != row[0]}
+    conn.executemany(UPSERT_USER_NAME_SQL, names.items())
+
+
+def write_rows(conn, rows, skip_stored=False):
+    """在單一交易中寫入資料列，回傳實際寫入的資料列
+
+    skip_stored 為 True 時先取得寫入鎖（BEGIN IMMEDIATE），已儲存訊息的檢查與寫入在同一交易中完成。
+    """
+    if skip_stored:
+        conn.execute('BEGIN IMMEDIATE')
+    with conn:
+        return insert_rows(conn, rows, skip_stored)
+
+
+def write_direct(rows, db_path=DB_PATH, skip_stored=False):
+    """直接寫入資料庫，遇到 database is locked 時退避重試；回傳實際寫入的資料列"""
+    for attempt in range(DIRECT_WRITE_RETRIES):
+        conn = connect(db_path)
+        try:
+            return write_rows(conn, rows, skip_stored)
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) or attempt == DIRECT_WRITE_RETRIES - 1:
+                raise
+            logger.warning(f"資料庫鎖定，重試寫入 ({attempt + 1}/{DIRECT_WRITE_RETRIES})")
+            time.sleep(0.05 * (2 ** attempt))
+        finally:
+            conn.close()
+
+
+_listeners = []
+
+
+def add_listener(listener):
+    """註冊寫入成功後的監聽器，listener(rows, db_path) 在送出記錄的程序內呼叫"""
+    _listeners.append(listener)
+
+
+def notify_listeners(rows, db_path):
+    """呼叫寫入監聽器（分區處理模式下由 webhook 程序以 worker 回傳的資料列呼叫）"""
+    for listener in _listeners:
+        try:
+            listener(rows, db_path)
+        except Exception as e:
+            logger.error(f"提及記錄監聽器發生錯誤: {e}")
+
+
+def submit_mentions(rows, db_path=DB_PATH):
+    """送出提及記錄；有寫入程序時經由 socket，否則直接寫入
+
+    兩種路徑都略過訊息編號已儲存的資料列：寫入程序逾時或斷線時批次可能已經提交，
+    退回直接寫入不會重複寫入同一則訊息。監聽器只收到這次實際寫入的資料列
+    （webhook 重送、日誌重播與逐一事件重試的訊息不會重複計入熱門與最近提及）。
+    """
+    if not rows:
+        return
+    socket_path = writer_socket_path()
+    written = None
+    if socket_path:
+        try:
+            skipped = get_client(socket_path).submit(rows, db_path)
+            written = [row for row in rows if row[4] not in skipped] if skipped else rows
+        except (OSError, WriterError) as e:
+            # 寫入程序不可用時退回直接寫入，避免遺失記錄
+            logger.error(f"寫入程序無法使用，改為直接寫入: {e}")
+    if written is None:
+        written = write_direct(rows, db_path, skip_stored=True)
+    if written:
+        notify_listeners(written, db_path)
+
+
+def submit_mention_batches(batches, db_path=DB_PATH):
+    """將同一個 webhook 請求中各事件的提及記錄合併為一次寫入
+
+    batches 為每個事件的資料列列表；整批寫入失敗時改為逐一事件寫入，
+    讓單一事件的問題不影響其他事件。回傳每個事件是否寫入成功。
+    """
+    rows = [row for batch in batches for row in batch]
+    try:
+        submit_mentions(rows, db_path)
+        return [True] * len(batches)
+    except Exception as e:
+        logger.error(f"批次寫入 {len(batches)} 個事件失敗，改為逐一寫入: {e}")
+
+    results = []
+    for batch in batches:
+        try:
+            submit_mentions(batch, db_path)
+            results.append(True)
+        except Exception as e:
+            logger.error(f"寫入提及記錄時發生錯誤: {e}")
+            results.append(False)
+    return results
+
+
+class WriterError(Exception):
+    """寫入程序回報的錯誤"""
+
+
+class MentionWriterClient:
+    """寫入程序的客戶端，每個執行緒保有一條持久連線"""
+
+    def __init__(self, socket_path, timeout=10):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            conn = (sock, sock.makefile('rb'))
+            self._local.conn = conn
+        return conn
+
+    def _close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn[1].close()
+            conn[0].close()
+            self._local.conn = None
+
+    def submit(self, rows, db_path=DB_PATH):
+        """送出一批資料列，等待寫入程序確認已提交；回傳因已儲存而略過的訊息編號集合"""
+        payload = (json.dumps({'db_path': db_path, 'rows': rows},
+                              ensure_ascii=False) + '\n').encode('utf-8')
+        # 持久連線可能已被對方關閉，失敗時重新連線一次
+        for attempt in range(2):
+            try:
+                sock, reader = self._connection()
+                sock.sendall(payload)
+                line = reader.readline()
+                if not line:
+                    raise ConnectionError('寫入程序已關閉連線')
+                break
+            except OSError:
+                self._close()
+                if attempt == 1:
+                    raise
+        response = json.loads(line)
+        if not response.get('ok'):
+            raise WriterError(response.get('error', 'unknown error'))
+        return set(response.get('skipped', ()))
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(socket_path):
+    """取得（並快取）指定 socket 的客戶端"""
+    with _clients_lock:
+        client = _clients.get(socket_path)
+        if client is None:
+            client = _clients[socket_path] = MentionWriterClient(socket_path)
+        return client
+
+
+class _PendingBatch:
+    __slots__ = ('db_path', 'rows', 'inserted', 'done', 'error')
+
+    def __init__(self, db_path, rows):
+        self.db_path = db_path
+        self.rows = rows
+        self.inserted = []
+        self.done = threading.Event()
+        self.error = None
+
+    def skipped(self):
+        """因已儲存而略過的訊息編號"""
+        inserted = {row[4] for row in self.inserted}
+        return sorted({row[4] for row in self.rows if row[4] is not None} - inserted)
+
+
+class MentionWriterServer:
+    """單一寫入程序：接收各 worker 的批次並以群組提交寫入資料庫"""
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH):
+        self.socket_path = socket_path
+        # 每個資料庫檔案（分片）各有一個佇列與寫入執行緒，彼此的提交互不阻塞
+        self._queues = {}
+        self._queues_lock = threading.Lock()
+        self._running = threading.Event()
+
+    def serve_forever(self):
+        """啟動寫入執行緒並開始接受連線"""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(128)
+        self._running.set()
+        logger.info(f"提及寫入程序已啟動: {self.socket_path}")
+
+        try:
+            while self._running.is_set():
+                client, _ = server.accept()
+                threading.Thread(target=self._serve_client, args=(client,), daemon=True).start()
+        finally:
+            server.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def _serve_client(self, client):
+        """處理單一 worker 連線：逐行讀取批次並回覆結果"""
+        with client, client.makefile('rb') as reader:
+            for line in reader:
+                try:
+                    request = json.loads(line)
+                    batch = _PendingBatch(request.get('db_path', DB_PATH),
+                                          [tuple(row) for row in request['rows']])
+                except Exception as e:
+                    response = {'ok': False, 'error': f'invalid request: {e}'}
+                else:
+                    self._queue_for(batch.db_path).put(batch)
+                    if not batch.done.wait(BATCH_WAIT_TIMEOUT):
+                        # 客戶端收到錯誤後退回直接寫入，已儲存的訊息會被略過
+                        batch.error = f'寫入逾時（{BATCH_WAIT_TIMEOUT} 秒）'
+                    response = {'ok': batch.error is None}
+                    if batch.error is not None:
+                        response['error'] = batch.error
+                    elif len(batch.inserted) != len(batch.rows):
+                        response['skipped'] = batch.skipped()
+                client.sendall((json.dumps(response) + '\n').encode('utf-8'))
+
+    def _queue_for(self, db_path):
+        """取得資料庫的寫入佇列，第一次使用時啟動該資料庫的寫入執行緒"""
+        pending = self._queues.get(db_path)
+        if pending is None:
+            with self._queues_lock:
+                pending = self._queues.get(db_path)
+                if pending is None:
+                    pending = self._queues[db_path] = queue.Queue()
+                    threading.Thread(target=self._writer_loop, args=(db_path, pending),
+                                     name=f'mention-writer:{db_path}', daemon=True).start()
+        return pending
+
+    def _writer_loop(self, db_path, pending):
+        """資料庫唯一的寫入執行緒：合併佇列中的批次，一次交易提交"""
+        conn = None
+        while True:
+            batches = [pending.get()]
+            while len(batches) < MAX_BATCHES_PER_COMMIT:
+                try:
+                    batches.append(pending.get_nowait())
+                except queue.Empty:
+                    break
+            if conn is None:
+                try:
+                    conn = connect(db_path)
+                except Exception as e:
+                    logger.error(f"無法開啟資料庫 {db_path}: {e}")
+                    self._fail(batches, e)
+                    continue
+            try:
+                self._commit(conn, batches)
+            except Exception as e:
+                # 任何未預期的錯誤都不結束寫入執行緒，等待中的批次回報失敗
+                logger.error(f"寫入執行緒發生錯誤: {e}")
+                self._fail([batch for batch in batches if not batch.done.is_set()], e)
+
+    @staticmethod
+    def _fail(batches, error):
+        for batch in batches:
+            batch.error = str(error)
+            batch.done.set()
+
+    def _commit(self, conn, batches):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            with conn:
+                for batch in batches:
+                    batch.inserted = insert_rows(conn, batch.rows, skip_stored=True)
+        except Exception as e:
+            if len(batches) == 1:
+                logger.error(f"寫入提及記錄時發生錯誤: {e}")
+                batches[0].error = str(e)
+            else:
+                # 合併交易失敗時逐批重試，讓錯誤只影響有問題的批次
+                for batch in batches:
+                    self._commit(conn, [batch])
+                return
+        for batch in batches:
+            batch.done.set()
+
+
+def run_writer(socket_path=DEFAULT_SOCKET_PATH):
+    """寫入程序進入點"""
+    logging.basicConfig(level=logging.INFO)
+    MentionWriterServer(socket_path).serve_forever()
+
+
+def start_writer_process(socket_path=DEFAULT_SOCKET_PATH, startup_timeout=5):
+    """以子程序啟動寫入程序，等待 socket 就緒後回傳 Process 物件"""
+    import multiprocessing
+
+    # 清除上次未正常結束留下的 socket 檔，避免誤判為已就緒
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    process = multiprocessing.Process(target=run_writer, args=(socket_path,),
+                                      name='mention-writer', daemon=True)
+    process.start()
+
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if os.path.exists(socket_path):
+            return process
+        time.sleep(0.05)
+    raise RuntimeError(f"提及寫入程序未能在 {startup_timeout} 秒內啟動")
+
+
+if __name__ == "__main__":
+    run_writer(os.getenv('MENTION_WRITER_SOCKET', DEFAULT_SOCKET_PATH))
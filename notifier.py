@@ -0,0 +1,382 @@
+"""
+提及通知
+將「你被提及了」通知排入資料庫佇列，由背景派送器依內容分組後以 multicast 批次送出
+
+同一群組、同一收件人在合併視窗（dedup_window 秒）內的提及併入同一則通知，內容附上次數與最新的訊息；
+前一則已送出時，下一則延到視窗結束才送，期間的提及繼續併入，不會遺漏。
+使用者在群組中以 /notify 指令設定通知開關與勿擾時段（NotificationQueue.configure）。
+"""
+
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import schema
+import timeutil
+from line_api import QuotaExceededError
+
+logger = logging.getLogger(__name__)
+
+# LINE multicast 單次最多收件人數
+MULTICAST_LIMIT = 500
+
+# 只有真正的 LINE 使用者 ID 才能收到推播
+LINE_USER_ID_PATTERN = re.compile(r'^U[0-9a-f]{32}$')
+
+DEFAULT_TIMEZONE = timeutil.DISPLAY_TIMEZONE_NAME
+MESSAGE_PREVIEW_LENGTH = 100
+MAX_ATTEMPTS = 3
+
+# 勿擾時段內與額度用完時，延後多久再嘗試派送（秒）
+QUIET_HOURS_RECHECK = 900
+QUOTA_RECHECK = 3600
+
+STATUS_PENDING = 'pending'
+STATUS_SENDING = 'sending'
+STATUS_SENT = 'sent'
+STATUS_FAILED = 'failed'
+STATUS_SKIPPED = 'skipped'
+
+
+def is_line_user_id(user_id):
+    return bool(user_id) and bool(LINE_USER_ID_PATTERN.match(user_id))
+
+
+NOTIFY_USAGE_TEXT = '\n'.join([
+    '🔔 提及通知設定',
+    '/notify on | off：開啟或關閉被提及時的私訊通知',
+    '/notify quiet 22:00-07:00 [時區]：勿擾時段（時段內的通知延後送出）',
+    '/notify quiet off：取消勿擾時段',
+    '/notify：查看目前設定',
+])
+NOTIFY_UNKNOWN_USER_TEXT = '🔔 無法辨識你的 LINE 帳號，無法設定通知'
+
+
+def build_notification_text(message_text, mention_count=1):
+    """通知內容只與訊息和次數有關、與收件人無關，內容相同的通知才能合併為一次 multicast"""
+    preview = message_text if len(message_text) <= MESSAGE_PREVIEW_LENGTH \
+        else message_text[:MESSAGE_PREVIEW_LENGTH] + '…'
+    if mention_count > 1:
+        return f"🔔 你在群組中被提及了 {mention_count} 次\n最新：{preview}"
+    return f"🔔 你在群組中被提及了\n{preview}"
+
+
+def in_quiet_hours(quiet_start, quiet_end, timezone, now=None):
+    """檢查現在是否落在使用者的勿擾時段（HH:MM，可跨午夜）"""
+    if not quiet_start or not quiet_end:
+        return False
+    local = (now or datetime.now(ZoneInfo(timezone or DEFAULT_TIMEZONE))).strftime('%H:%M')
+    if quiet_start <= quiet_end:
+        return quiet_start <= local < quiet_end
+    return local >= quiet_start or local < quiet_end
+
+
+def parse_quiet_hours(value):
+    """'HH:MM-HH:MM' 轉為 (開始, 結束)，格式錯誤或開始等於結束時拋出 ValueError"""
+    start, separator, end = value.partition('-')
+    if not separator:
+        raise ValueError(f"勿擾時段格式錯誤: {value}")
+    start, end = timeutil.parse_time_of_day(start), timeutil.parse_time_of_day(end)
+    if start == end:
+        raise ValueError("勿擾時段的開始與結束不可相同")
+    return start, end
+
+
+class NotificationQueue:
+    """通知佇列（儲存於 SQLite，保存每則通知的派送狀態）"""
+
+    def __init__(self, db_path='line_data.db', dedup_window=600):
+        self.db_path = db_path
+        self.dedup_window = dedup_window
+
+    def connect(self):
+        schema.ensure_schema(self.db_path)
+        return sqlite3.connect(self.db_path, timeout=5)
+
+    def enqueue(self, mentioned_users, group_id, message_text, message_id, sender_id=None):
+        """將被提及者的通知排入佇列，回傳排入或併入的數量
+
+        同一群組、同一收件人在合併視窗內的提及併入同一則通知；
+        webhook 重送同一則訊息也不會重複計入。
+        """
+        return self.enqueue_many([(mentioned_users, group_id, message_text, message_id, sender_id)])
+
+    def enqueue_many(self, items):
+        """以單一交易排入多則訊息的通知
+
+        items 為 (mentioned_users, group_id, message_text, message_id, sender_id) 的列表，
+        回傳排入或併入的數量。
+        """
+        now = time.time()
+        pending = []
+        for mentioned_users, group_id, message_text, message_id, sender_id in items:
+            recipients = {
+                user['user_id'] for user in mentioned_users
+                if is_line_user_id(user['user_id']) and user['user_id'] != sender_id
+            }
+            if recipients:
+                pending.append((sorted(recipients), group_id, message_text, message_id))
+        if not pending:
+            return 0
+
+        conn = self.connect()
+        try:
+            with conn:
+                cursor = conn.cursor()
+                queued = 0
+                for recipients, group_id, message_text, message_id in pending:
+                    dedup_key = f'group:{group_id}'
+                    for user_id in recipients:
+                        queued += self._enqueue_one(cursor, user_id, group_id, dedup_key,
+                                                    message_text, message_id, now)
+                return queued
+        finally:
+            conn.close()
+
+    def _enqueue_one(self, cursor, user_id, group_id, dedup_key, message_text, message_id, now):
+        """排入一則通知或併入尚未送出的通知，回傳 1；同一則訊息已計入時回傳 0
+
+        計入的訊息記錄在 notification_messages（通知的 message_id 保留第一則），
+        併入多則訊息後，重送其中任何一則都不會再次計入。
+        """
+        if message_id is not None:
+            cursor.execute('''
+                SELECT 1 FROM notification_messages WHERE user_id = ? AND dedup_key = ? AND message_id = ?
+            ''', (user_id, dedup_key, message_id))
+            if cursor.fetchone():
+                return 0
+        cursor.execute('''
+            SELECT id, mention_count FROM notifications
+            WHERE user_id = ? AND dedup_key = ? AND status = 'pending'
+            ORDER BY id DESC LIMIT 1
+        ''', (user_id, dedup_key))
+        row = cursor.fetchone()
+        if row is not None:
+            notification_id, mention_count = row[0], row[1] + 1
+            cursor.execute('''
+                UPDATE notifications SET mention_count = ?, content = ?, updated_at = ? WHERE id = ?
+            ''', (mention_count, build_notification_text(message_text, mention_count), now, notification_id))
+            self._record_message(cursor, user_id, dedup_key, message_id, notification_id)
+            return 1
+        # 視窗內已有送出（或派送中）的通知：新的通知延到視窗結束才送，期間的提及繼續併入
+        cursor.execute('''
+            SELECT MAX(created_at) FROM notifications
+            WHERE user_id = ? AND dedup_key = ? AND created_at >= ?
+        ''', (user_id, dedup_key, now - self.dedup_window))
+        previous = cursor.fetchone()[0]
+        cursor.execute('''
+            INSERT INTO notifications
+            (user_id, group_id, message_id, dedup_key, content, created_at, updated_at, not_before)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, group_id, message_id, dedup_key, build_notification_text(message_text),
+              now, now, previous + self.dedup_window if previous is not None else 0))
+        self._record_message(cursor, user_id, dedup_key, message_id, cursor.lastrowid)
+        return 1
+
+    @staticmethod
+    def _record_message(cursor, user_id, dedup_key, message_id, notification_id):
+        if message_id is not None:
+            cursor.execute('''
+                INSERT INTO notification_messages (user_id, dedup_key, message_id, notification_id)
+                VALUES (?, ?, ?, ?)
+            ''', (user_id, dedup_key, message_id, notification_id))
+
+    def set_preferences(self, user_id, enabled=True, quiet_start=None, quiet_end=None, timezone=None):
+        """設定使用者的通知開關與勿擾時段"""
+        conn = self.connect()
+        with conn:
+            conn.execute('''
+                INSERT INTO notification_preferences (user_id, enabled, quiet_start, quiet_end, timezone)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    enabled = excluded.enabled,
+                    quiet_start = excluded.quiet_start,
+                    quiet_end = excluded.quiet_end,
+                    timezone = excluded.timezone
+            ''', (user_id, int(enabled), quiet_start, quiet_end, timezone))
+        conn.close()
+
+    def get_preferences(self, user_id):
+        """使用者的通知設定（未設定時為預設值：開啟、沒有勿擾時段）"""
+        conn = self.connect()
+        try:
+            row = conn.execute('''
+                SELECT enabled, quiet_start, quiet_end, timezone FROM notification_preferences WHERE user_id = ?
+            ''', (user_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return {'enabled': True, 'quiet_start': None, 'quiet_end': None, 'timezone': None}
+        return {'enabled': bool(row[0]), 'quiet_start': row[1], 'quiet_end': row[2], 'timezone': row[3]}
+
+    def configure(self, user_id, args):
+        """回答 /notify 指令：查看或設定通知開關與勿擾時段（參數錯誤時回覆用法）"""
+        if not is_line_user_id(user_id):
+            return NOTIFY_UNKNOWN_USER_TEXT
+        preferences = self.get_preferences(user_id)
+        if not args:
+            return self._describe(preferences)
+        try:
+            if args in (['on'], ['off']):
+                preferences['enabled'] = args[0] == 'on'
+            elif args == ['quiet', 'off']:
+                preferences.update(quiet_start=None, quiet_end=None, timezone=None)
+            elif args[0] == 'quiet' and len(args) in (2, 3):
+                quiet_start, quiet_end = parse_quiet_hours(args[1])
+                timezone = timeutil.resolve_timezone(args[2]) if len(args) == 3 else DEFAULT_TIMEZONE
+                preferences.update(quiet_start=quiet_start, quiet_end=quiet_end, timezone=timezone)
+            else:
+                return NOTIFY_USAGE_TEXT
+        except ValueError as e:
+            return f'⚠️ {e}\n{NOTIFY_USAGE_TEXT}'
+        self.set_preferences(user_id, **preferences)
+        return self._describe(preferences)
+
+    @staticmethod
+    def _describe(preferences):
+        lines = [f"🔔 提及通知：{'開啟' if preferences['enabled'] else '關閉'}"]
+        if preferences['quiet_start']:
+            lines.append(f"勿擾時段：{preferences['quiet_start']}-{preferences['quiet_end']}"
+                         f"（{preferences['timezone'] or DEFAULT_TIMEZONE}）")
+        return '\n'.join(lines)
+
+    def claim(self, worker_id, limit, stale_after=300):
+        """認領待送通知；以原子 UPDATE 認領，多個 worker 同時派送也不會重複發送"""
+        now = time.time()
+        conn = self.connect()
+        try:
+            with conn:
+                # 認領後當機的通知在逾時後釋出
+                conn.execute('''
+                    UPDATE notifications SET status = 'pending', claimed_by = NULL
+                    WHERE status = 'sending' AND updated_at < ?
+                ''', (now - stale_after,))
+                conn.execute('''
+                    UPDATE notifications SET status = 'sending', claimed_by = ?, updated_at = ?
+                    WHERE id IN (
+                        SELECT id FROM notifications
+                        WHERE status = 'pending' AND not_before <= ?
+                        ORDER BY id LIMIT ?
+                    )
+                ''', (worker_id, now, now, limit))
+            return conn.execute('''
+                SELECT n.id, n.user_id, n.content, n.attempts,
+                       p.enabled, p.quiet_start, p.quiet_end, p.timezone
+                FROM notifications n
+                LEFT JOIN notification_preferences p ON p.user_id = n.user_id
+                WHERE n.status = 'sending' AND n.claimed_by = ?
+                ORDER BY n.id
+            ''', (worker_id,)).fetchall()
+        finally:
+            conn.close()
+
+    def mark(self, ids, status, error=None, count_attempt=False, delay=0):
+        """更新通知狀態；delay 秒內不再被認領"""
+        if not ids:
+            return
+        now = time.time()
+        conn = self.connect()
+        with conn:
+            conn.executemany('''
+                UPDATE notifications
+                SET status = ?, error = ?, claimed_by = NULL, updated_at = ?,
+                    attempts = attempts + ?, not_before = ?
+                WHERE id = ?
+            ''', [(status, error, now, int(count_attempt), now + delay, i) for i in ids])
+        conn.close()
+
+    def status_counts(self):
+        conn = self.connect()
+        try:
+            return dict(conn.execute('SELECT status, COUNT(*) FROM notifications GROUP BY status').fetchall())
+        finally:
+            conn.close()
+
+
+class NotificationDispatcher:
+    """背景派送器：依通知內容分組，以 multicast 每批最多 500 人送出"""
+
+    def __init__(self, queue, line_client, interval=5, batch_size=2000):
+        self.queue = queue
+        self.line_client = line_client
+        self.interval = interval
+        self.batch_size = batch_size
+        self.worker_id = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='notification-dispatcher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.dispatch_once()
+            except Exception as e:
+                logger.error(f"派送通知時發生錯誤: {e}")
+
+    def dispatch_once(self):
+        """派送一輪，回傳已送出的通知數"""
+        rows = self.queue.claim(self.worker_id, self.batch_size)
+        if not rows:
+            return 0
+
+        by_content = {}
+        deferred, skipped = [], []
+        for notification_id, user_id, content, attempts, enabled, quiet_start, quiet_end, timezone in rows:
+            if enabled == 0:
+                skipped.append(notification_id)
+            elif in_quiet_hours(quiet_start, quiet_end, timezone):
+                # 勿擾時段內保留在佇列中，時段結束後再送
+                deferred.append(notification_id)
+            else:
+                by_content.setdefault(content, {}).setdefault(user_id, []).append(notification_id)
+
+        self.queue.mark(skipped, STATUS_SKIPPED)
+        self.queue.mark(deferred, STATUS_PENDING, delay=QUIET_HOURS_RECHECK)
+
+        sent = 0
+        for content, recipients in by_content.items():
+            user_ids = list(recipients)
+            for start in range(0, len(user_ids), MULTICAST_LIMIT):
+                chunk = user_ids[start:start + MULTICAST_LIMIT]
+                ids = [i for user_id in chunk for i in recipients[user_id]]
+                sent += self._send_chunk(content, chunk, ids, rows)
+        return sent
+
+    def _send_chunk(self, content, user_ids, ids, rows):
+        try:
+            response = self.line_client.multicast(user_ids, self.line_client.text_messages(content))
+        except QuotaExceededError as e:
+            logger.warning(f"{e}，通知保留至下月或額度增加")
+            self.queue.mark(ids, STATUS_PENDING, delay=QUOTA_RECHECK)
+            return 0
+        except Exception as e:
+            self._mark_failed(ids, rows, str(e))
+            return 0
+
+        if response.status_code == 200:
+            self.queue.mark(ids, STATUS_SENT, count_attempt=True)
+            return len(ids)
+        self._mark_failed(ids, rows, f'HTTP {response.status_code}')
+        return 0
+
+    def _mark_failed(self, ids, rows, error):
+        """失敗的通知在重試次數用完前回到佇列"""
+        attempts = {row[0]: row[3] for row in rows}
+        retry = [i for i in ids if attempts.get(i, 0) + 1 < MAX_ATTEMPTS]
+        exhausted = [i for i in ids if attempts.get(i, 0) + 1 >= MAX_ATTEMPTS]
+        logger.error(f"multicast 失敗 ({error})，{len(retry)} 則將重試")
+        self.queue.mark(retry, STATUS_PENDING, error, count_attempt=True, delay=self.interval * 2)
+        self.queue.mark(exhausted, STATUS_FAILED, error, count_attempt=True)
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""
+依群組分區的多程序事件處理
+單一 Python 程序同時負責解析、名冊比對與序列化時受 GIL 限制；PROCESSING_WORKERS > 0 時，
+webhook 程序只寫入日誌並依 group_id 將事件分派給固定數量的 worker 程序：
+
+- group_id 以穩定雜湊對應到固定數量的分區（PROCESSING_PARTITIONS），每個分區同時只屬於一個 worker；
+  worker 依序處理收到的批次，同一群組的提及記錄與回覆維持原本的順序，不同群組在多個核心上並行
+- worker 為獨立的 Python 程序（python partitions.py --worker），以 stdin / stdout 的 JSON 行
+  接收批次與回報結果；寫入成功的資料列隨結果回傳，由 webhook 程序呼叫寫入監聽器
+- 監督：worker 結束時重新啟動，尚未完成的批次依原順序重送（標記為重送，略過已儲存的訊息）；
+  restart_window 秒內重啟超過 max_restarts 次的 worker 暫停使用，分區改由其他 worker 接手，
+  冷卻後重新啟動，分區在沒有處理中的批次時移回；超過 stall_timeout 秒沒有進度的 worker 強制結束
+- 指標：各分區已送出、已完成、失敗、重送與處理中的批次數，最舊批次的等待秒數（延遲）與最近一次處理耗時
+
+使用方式:
+    PROCESSING_WORKERS=4 gunicorn -w 1 --threads 8 wsgi:app
+    PROCESSING_WORKERS=4 uvicorn asgi:app
+"""
+
+import argparse
+import importlib
+import json
+import logging
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+
+import shards
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HANDLER = 'app_simple:process_partition_batch'
+
+# 每個 worker 預設負責的分區數（分區越多，worker 暫停時分區越能平均分給其他 worker）
+PARTITIONS_PER_WORKER = 8
+
+# 同一批次最多送出的次數；處理該批次時 worker 反覆結束，視為無法處理並放棄
+MAX_DELIVERIES = 3
+
+# worker 程序的環境變數：不再分區、不寫日誌（由 webhook 程序負責），也不執行只需要一份的背景工作
+WORKER_ENV = {
+    'PROCESSING_WORKERS': '0',
+    'JOURNAL_DIR': '',
+    'DIGEST_INTERVAL': '0',
+    'SNAPSHOT_INTERVAL': '0',
+    'ROLLUP_COMPACT_INTERVAL': '0',
+}
+
+
+def partition_of(group_id, partitions):
+    """group_id 對應的分區（與分片相同的穩定雜湊）"""
+    return shards.shard_index(group_id, partitions)
+
+
+def event_group_id(event):
+    return (event.get('source') or {}).get('groupId')
+
+
+class _Batch:
+    __slots__ = ('seq', 'partition', 'events', 'level', 'submission', 'submitted_at', 'dispatched_at', 'deliveries')
+
+    def __init__(self, seq, partition, events, level, submission):
+        self.seq = seq
+        self.partition = partition
+        self.events = events
+        self.level = level
+        self.submission = submission
+        self.submitted_at = time.monotonic()
+        self.dispatched_at = None
+        self.deliveries = 0
+
+
+class _Submission:
+    """同一個 webhook 請求拆成的各分區批次，全部完成後呼叫 on_done(是否全部儲存成功)"""
+
+    __slots__ = ('remaining', 'complete', 'on_done')
+
+    def __init__(self, remaining, on_done):
+        self.remaining = remaining
+        self.complete = True
+        self.on_done = on_done
+
+
+class _Worker:
+    __slots__ = ('index', 'process', 'outbox', 'in_flight', 'ready', 'restarts', 'paused_at',
+                 'last_progress', 'processed')
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.outbox = None
+        # 已指派給此 worker、尚未回報完成的批次（依送出順序）
+        self.in_flight = OrderedDict()
+        self.ready = False
+        self.restarts = deque()
+        self.paused_at = None
+        self.last_progress = time.monotonic()
+        self.processed = 0
+
+    @property
+    def alive(self):
+        return self.process is not None
+
+
+class PartitionPool:
+    """固定數量的分區 worker 程序：依群組分派批次、監督 worker 並統計各分區的延遲
+
+    on_rows(rows, db_path) 在 worker 回報寫入成功的資料列時呼叫（例如 mention_writer.notify_listeners）。
+    """
+
+    def __init__(self, workers, partitions=None, handler=DEFAULT_HANDLER, on_rows=None, env=None,
+                 max_restarts=5, restart_window=60, stall_timeout=120, supervise_interval=1.0):
+        if workers < 1:
+            raise ValueError("worker 數必須至少為 1")
+        self.worker_count = workers
+        self.partitions = partitions or workers * PARTITIONS_PER_WORKER
+        self.handler = handler
+        self.on_rows = on_rows
+        self.env = dict(WORKER_ENV, **(env or {}))
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self.stall_timeout = stall_timeout
+        self.supervise_interval = supervise_interval
+        self._lock = threading.Lock()
+        self._workers = [_Worker(index) for index in range(workers)]
+        self._owners = [self.home_of(partition) for partition in range(self.partitions)]
+        self._stats = [Counter() for _ in range(self.partitions)]
+        self._latency = [None] * self.partitions
+        self._counters = Counter()
+        self._seq = 0
+        self._stop = threading.Event()
+        self._supervisor = None
+
+    @classmethod
+    def from_env(cls, on_rows=None):
+        """PROCESSING_WORKERS 未設定或為 0 時回傳 None（在 webhook 程序內處理）"""
+        workers = int(os.getenv('PROCESSING_WORKERS', 0))
+        if workers <= 0:
+            return None
+        return cls(workers,
+                   int(os.getenv('PROCESSING_PARTITIONS', 0)) or None,
+                   on_rows=on_rows,
+                   max_restarts=int(os.getenv('PROCESSING_MAX_RESTARTS', 5)),
+                   stall_timeout=float(os.getenv('PROCESSING_STALL_TIMEOUT', 120)))
+
+    def home_of(self, partition):
+        """分區原本所屬的 worker"""
+        return partition % self.worker_count
+
+    def start(self):
+        with self._lock:
+            for worker in self._workers:
+                self._spawn(worker)
+        self._supervisor = threading.Thread(target=self._supervise, name='partition-supervisor', daemon=True)
+        self._supervisor.start()
+
+    def stop(self, timeout=10):
+        """停止分派：worker 處理完已送出的批次後結束"""
+        self._stop.set()
+        with self._lock:
+            processes = [worker.process for worker in self._workers if worker.alive]
+            for worker in self._workers:
+                if worker.alive:
+                    worker.outbox.put(None)
+        for process in processes:
+            try:
+                process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    def submit(self, events, level=0, on_done=None):
+        """依群組將事件拆成各分區的批次送給所屬 worker，不等待處理完成，回傳批次數
+
+        同一分區的批次依送出順序處理；全部完成後呼叫 on_done(是否全部儲存成功)。
+        """
+        by_partition = OrderedDict()
+        for event in events:
+            by_partition.setdefault(partition_of(event_group_id(event), self.partitions), []).append(event)
+        if not by_partition:
+            if on_done is not None:
+                on_done(True)
+            return 0
+        submission = _Submission(len(by_partition), on_done)
+        with self._lock:
+            for partition, partition_events in by_partition.items():
+                self._seq += 1
+                batch = _Batch(self._seq, partition, partition_events, level, submission)
+                self._stats[partition]['submitted'] += 1
+                self._dispatch(batch)
+        return len(by_partition)
+
+    # 以下方法需持有 self._lock
+
+    def _spawn(self, worker):
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--worker', '--handler', self.handler],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=dict(os.environ, **self.env))
+        worker.process = process
+        worker.outbox = queue.Queue()
+        worker.ready = False
+        worker.last_progress = time.monotonic()
+        threading.Thread(target=self._write_loop, args=(process, worker.outbox),
+                         name=f'partition-writer-{worker.index}', daemon=True).start()
+        threading.Thread(target=self._read_loop, args=(worker, process),
+                         name=f'partition-reader-{worker.index}', daemon=True).start()
+        logger.info(f"分區 worker {worker.index} 已啟動 (pid {process.pid})")
+
+    def _dispatch(self, batch):
+        worker = self._workers[self._owners[batch.partition]]
+        batch.deliveries += 1
+        batch.dispatched_at = time.monotonic()
+        if not worker.in_flight:
+            # 閒置的 worker 從收到批次起計算卡住時間
+            worker.last_progress = batch.dispatched_at
+        worker.in_flight[batch.seq] = batch
+        worker.outbox.put(batch)
+
+    def _settle(self, batch, ok):
+        """批次完成（或放棄），回傳需要在鎖外呼叫的 on_done"""
+        submission = batch.submission
+        submission.remaining -= 1
+        submission.complete = submission.complete and ok
+        if submission.remaining == 0 and submission.on_done is not None:
+            return lambda: submission.on_done(submission.complete)
+        return None
+
+    def _reassign(self, worker):
+        """暫停的 worker 的分區平均分給其他執行中的 worker"""
+        others = [other for other in self._workers if other is not worker and other.alive]
+        moved = [partition for partition, owner in enumerate(self._owners) if owner == worker.index]
+        for i, partition in enumerate(moved):
+            self._owners[partition] = others[i % len(others)].index
+        self._counters['reassigned_partitions'] += len(moved)
+        logger.error(f"分區 worker {worker.index} 短時間內重啟過多次，{len(moved)} 個分區改由其他 worker 處理")
+
+    # 背景執行緒
+
+    def _write_loop(self, process, outbox):
+        """依序把批次寫入 worker 的 stdin；None 表示停止（關閉 stdin，worker 處理完後結束）"""
+        while True:
+            batch = outbox.get()
+            if batch is None:
+                break
+            line = json.dumps({'seq': batch.seq, 'events': batch.events, 'level': batch.level,
+                               'redelivered': batch.deliveries > 1}, ensure_ascii=False) + '\n'
+            try:
+                process.stdin.write(line.encode('utf-8'))
+                process.stdin.flush()
+            except (OSError, ValueError):
+                # worker 已結束，尚未完成的批次由讀取執行緒重送
+                break
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+
+    def _read_loop(self, worker, process):
+        """讀取 worker 回報的結果；stdout 結束（worker 結束）後處理重啟與重送"""
+        for line in process.stdout:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                logger.warning(f"分區 worker {worker.index} 回傳無法解析的結果")
+                continue
+            if result.get('ready'):
+                with self._lock:
+                    worker.ready = True
+                    worker.last_progress = time.monotonic()
+                continue
+            self._complete(worker, result)
+        self._handle_exit(worker, process, process.wait())
+
+    def _complete(self, worker, result):
+        with self._lock:
+            batch = worker.in_flight.pop(result.get('seq'), None)
+            if batch is None:
+                return
+            now = time.monotonic()
+            worker.processed += 1
+            worker.last_progress = now
+            stats = self._stats[batch.partition]
+            stats['completed'] += 1
+            self._latency[batch.partition] = now - batch.submitted_at
+            ok = bool(result.get('ok') and result.get('complete'))
+            if not result.get('ok'):
+                stats['failed'] += 1
+                logger.error(f"分區 {batch.partition} 的批次處理失敗: {result.get('error')}")
+            callback = self._settle(batch, ok)
+        if self.on_rows is not None:
+            for db_path, rows in result.get('rows') or []:
+                try:
+                    self.on_rows([tuple(row) for row in rows], db_path)
+                except Exception as e:
+                    logger.error(f"處理 worker 回傳的資料列時發生錯誤: {e}")
+        if callback is not None:
+            callback()
+
+    def _handle_exit(self, worker, process, code):
+        callbacks = []
+        with self._lock:
+            if worker.process is not process:
+                return
+            pending = list(worker.in_flight.values())
+            worker.in_flight.clear()
+            worker.outbox.put(None)
+            worker.process = None
+            worker.ready = False
+            if self._stop.is_set():
+                # 停止時未完成的批次不提交日誌位移，下次啟動時重播
+                callbacks = [self._settle(batch, False) for batch in pending]
+            else:
+                logger.error(f"分區 worker {worker.index} 已結束（結束碼 {code}），{len(pending)} 個批次將重送")
+                now = time.monotonic()
+                worker.restarts.append(now)
+                while worker.restarts and now - worker.restarts[0] > self.restart_window:
+                    worker.restarts.popleft()
+                self._counters['restarts'] += 1
+                if len(worker.restarts) > self.max_restarts and any(
+                        other.alive for other in self._workers if other is not worker):
+                    worker.paused_at = now
+                    self._reassign(worker)
+                else:
+                    self._spawn(worker)
+                # 依原本的送出順序重送，新的批次在鎖釋放後才會排在後面
+                for batch in pending:
+                    if batch.deliveries >= MAX_DELIVERIES:
+                        logger.error(f"分區 {batch.partition} 的批次已送出 {batch.deliveries} 次仍未完成，放棄處理")
+                        self._stats[batch.partition]['dropped'] += 1
+                        callbacks.append(self._settle(batch, False))
+                    else:
+                        self._stats[batch.partition]['redelivered'] += 1
+                        self._dispatch(batch)
+        for callback in callbacks:
+            if callback is not None:
+                callback()
+
+    def _supervise(self):
+        while not self._stop.wait(self.supervise_interval):
+            try:
+                self.supervise_once()
+            except Exception as e:
+                logger.error(f"監督分區 worker 時發生錯誤: {e}")
+
+    def supervise_once(self):
+        """強制結束卡住的 worker、重新啟動冷卻完畢的 worker，並把分區移回原本的 worker"""
+        with self._lock:
+            now = time.monotonic()
+            for worker in self._workers:
+                if worker.paused_at is not None and not worker.alive:
+                    if now - worker.paused_at >= self.restart_window:
+                        worker.paused_at = None
+                        worker.restarts.clear()
+                        self._spawn(worker)
+                elif worker.alive and worker.in_flight and now - worker.last_progress > self.stall_timeout:
+                    logger.error(f"分區 worker {worker.index} 超過 {self.stall_timeout} 秒沒有進度，強制結束")
+                    self._counters['stalled'] += 1
+                    # 讀取執行緒在 worker 結束後重送批次
+                    worker.process.kill()
+            in_flight = Counter(batch.partition for worker in self._workers for batch in worker.in_flight.values())
+            for partition, owner in enumerate(self._owners):
+                home = self._workers[self.home_of(partition)]
+                # 分區沒有處理中的批次時才移動，移動前後的批次不會交錯
+                if owner != home.index and home.alive and home.paused_at is None and not in_flight[partition]:
+                    self._owners[partition] = home.index
+
+    def snapshot(self):
+        with self._lock:
+            now = time.monotonic()
+            oldest = {}
+            for worker in self._workers:
+                for batch in worker.in_flight.values():
+                    oldest[batch.partition] = min(oldest.get(batch.partition, batch.submitted_at), batch.submitted_at)
+            owned = Counter(self._owners)
+            return {
+                'partitions': self.partitions,
+                'counters': dict(self._counters),
+                'workers': [{
+                    'index': worker.index,
+                    'pid': worker.process.pid if worker.alive else None,
+                    'alive': worker.alive,
+                    'ready': worker.ready,
+                    'paused': worker.paused_at is not None,
+                    'recent_restarts': len(worker.restarts),
+                    'partitions': owned[worker.index],
+                    'processed': worker.processed,
+                    'in_flight': len(worker.in_flight),
+                } for worker in self._workers],
+                # 只列出收過事件的分區；lag_seconds 為最舊的未完成批次已等待的秒數
+                'partition_lag': [{
+                    'partition': partition,
+                    'worker': self._owners[partition],
+                    'submitted': stats['submitted'],
+                    'completed': stats['completed'],
+                    'failed': stats['failed'],
+                    'redelivered': stats['redelivered'],
+                    'dropped': stats['dropped'],
+                    'in_flight': stats['submitted'] - stats['completed'] - stats['dropped'],
+                    'lag_seconds': round(now - oldest[partition], 3) if partition in oldest else 0.0,
+                    'last_latency_ms': round(self._latency[partition] * 1000, 1)
+                    if self._latency[partition] is not None else None,
+                } for partition, stats in enumerate(self._stats) if stats['submitted']],
+            }
+
+
+def run_worker(handler=DEFAULT_HANDLER):
+    """worker 程序進入點：依序處理 stdin 的批次，每批回報一行結果"""
+    # stdout 保留給結果；處理過程中的 print 與記錄改寫到 stderr
+    output = os.fdopen(os.dup(sys.stdout.fileno()), 'w', encoding='utf-8')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    logging.basicConfig(level=logging.INFO)
+
+    import mention_writer
+
+    module_name, _, func_name = handler.partition(':')
+    process_batch = getattr(importlib.import_module(module_name), func_name)
+    written = []
+    mention_writer.add_listener(lambda rows, db_path: written.append([db_path, rows]))
+
+    def respond(payload):
+        output.write(json.dumps(payload, ensure_ascii=False) + '\n')
+        output.flush()
+
+    respond({'ready': True, 'pid': os.getpid()})
+    for line in sys.stdin.buffer:
+        request = json.loads(line)
+        written.clear()
+        try:
+            complete = process_batch(request['events'], request.get('level', 0), request.get('redelivered', False))
+            respond({'seq': request['seq'], 'ok': True, 'complete': bool(complete), 'rows': written})
+        except Exception as e:
+            logger.error(f"處理分區批次時發生錯誤: {e}")
+            respond({'seq': request['seq'], 'ok': False, 'error': str(e)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='依群組分區的事件處理 worker')
+    parser.add_argument('--worker', action='store_true', help='以 worker 程序執行（由 PartitionPool 啟動）')
+    parser.add_argument('--handler', default=DEFAULT_HANDLER, help='處理批次的函式（模組:函式）')
+    args = parser.parse_args()
+    if not args.worker:
+        parser.error('請以 PROCESSING_WORKERS 啟用分區處理；此程式只在 --worker 模式下由 webhook 程序啟動')
+    run_worker(args.handler)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+最近提及記錄的環形緩衝
+在記憶體中保存每個資料庫最新的數十筆提及記錄與其預先序列化的 JSON，
+首頁的「最新提及」列表不必每次排序查詢資料表
+
+寫入成功後由寫入路徑附加新記錄；其他程序（多 worker）也可能寫入同一資料庫，
+因此讀取前以 mentions 的 MAX(id)（主鍵索引，幾乎不花時間）確認緩衝與資料庫一致，不一致時重新載入。
+"""
+
+import json
+import logging
+import threading
+
+import mention_writer
+import timeutil
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CAPACITY = 50
+
+# 以插入順序（主鍵）取最新記錄，不需要排序整張資料表
+LOAD_SQL = '''
+    SELECT id, user_id, user_name, group_id, message, mentioned_at, message_id
+    FROM mentioned_users
+    ORDER BY id DESC
+    LIMIT ?
+'''
+
+
+class MentionRecord:
+    """一筆提及記錄與其 JSON 片段"""
+
+    __slots__ = ('user_id', 'user_name', 'group_id', 'message', 'mentioned_at', 'message_id',
+                 'sort_key', 'fragment')
+
+    def __init__(self, user_id, user_name, group_id, message, mentioned_at, message_id):
+        self.user_id = user_id
+        self.user_name = user_name
+        self.group_id = group_id
+        self.message = message
+        # 儲存為毫秒，顯示為顯示時區的 ISO 8601 字串
+        self.mentioned_at = timeutil.isoformat(mentioned_at)
+        self.message_id = message_id
+        self.sort_key = mentioned_at or 0
+        self.fragment = json.dumps(self.to_dict(), ensure_ascii=False, separators=(',', ':'))
+
+    def to_dict(self):
+        return {
+            'user_id': self.user_id,
+            'user_name': self.user_name,
+            'group_id': self.group_id,
+            'message': self.message,
+            'mentioned_at': self.mentioned_at,
+            'message_id': self.message_id,
+        }
+
+
+class RecentMentions:
+    """單一資料庫的最近提及記錄（固定大小、執行緒安全）
+
+    format_group 用於轉換顯示用的群組名稱，在記錄加入時套用一次。
+    """
+
+    def __init__(self, db_path=mention_writer.DB_PATH, capacity=DEFAULT_CAPACITY, format_group=None):
+        self.db_path = db_path
+        self.capacity = capacity
+        self.format_group = format_group
+        self._slots = [None] * capacity
+        self._next = 0
+        self._size = 0
+        # 緩衝對應的資料庫最大 id；None 表示尚未載入
+        self._last_id = None
+        self._lock = threading.Lock()
+
+    def _record(self, user_id, user_name, group_id, message, mentioned_at, message_id):
+        if self.format_group is not None:
+            group_id = self.format_group(group_id)
+        return MentionRecord(user_id, user_name, group_id, message, timeutil.parse_stored(mentioned_at), message_id)
+
+    def _append(self, record):
+        self._slots[self._next] = record
+        self._next = (self._next + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+
+    def _latest(self, limit):
+        count = min(limit, self._size)
+        return [self._slots[(self._next - 1 - i) % self.capacity] for i in range(count)]
+
+    def record_rows(self, rows):
+        """附加剛寫入的資料列（寫入路徑的資料列格式）"""
+        with self._lock:
+            if self._last_id is None:
+                return
+            # 重新載入時已讀到的記錄（寫入與載入交錯）不重複加入
+            seen = {(record.message_id, record.user_id) for record in self._latest(self._size)}
+            for user_id, user_name, group_id, message, message_id, mentioned_at, *_ in rows:
+                if message_id is not None and (message_id, user_id) in seen:
+                    continue
+                self._append(self._record(user_id, user_name, group_id, message, mentioned_at, message_id))
+                self._last_id += 1
+
+    def load(self, conn):
+        """由資料庫載入最新的記錄，取代緩衝內容"""
+        rows = conn.execute(LOAD_SQL, (self.capacity,)).fetchall()
+        records = [self._record(*row[1:]) for row in reversed(rows)]
+        with self._lock:
+            self._slots = [None] * self.capacity
+            self._next = self._size = 0
+            for record in records:
+                self._append(record)
+            self._last_id = rows[0][0] if rows else 0
+
+    def latest(self, limit=DEFAULT_CAPACITY):
+        """最新的 limit 筆記錄（新到舊）；緩衝與資料庫不一致時先重新載入"""
+        conn = mention_writer.connect_reader(self.db_path)
+        try:
+            last_id = conn.execute('SELECT MAX(id) FROM mentions').fetchone()[0] or 0
+            if last_id != self._last_id:
+                self.load(conn)
+        finally:
+            conn.close()
+        with self._lock:
+            return self._latest(limit)
+
+
+def merge_latest(feeds, limit):
+    """合併多個緩衝（分片）的最新記錄"""
+    if len(feeds) == 1:
+        return feeds[0].latest(limit)
+    records = [record for feed in feeds for record in feed.latest(limit)]
+    records.sort(key=lambda record: record.sort_key, reverse=True)
+    return records[:limit]
+
+
+def to_json(records):
+    """以預先序列化的片段組成 JSON 陣列"""
+    return '[' + ','.join(record.fragment for record in records) + ']'
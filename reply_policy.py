@@ -0,0 +1,239 @@
+"""
+回覆策略
+決定每則提及訊息是否、何時以及如何回覆確認訊息，減少熱路徑上的對外呼叫
+
+群組模式：
+- immediate：每則訊息立即回覆（預設，與原本行為相同）
+- coalesced：短時間內的確認合併為一則回覆
+- silent：只記錄不回覆
+- reaction：只回覆簡短的 ✅（同樣合併發送）
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MODE_IMMEDIATE = 'immediate'
+MODE_COALESCED = 'coalesced'
+MODE_SILENT = 'silent'
+MODE_REACTION = 'reaction'
+MODES = (MODE_IMMEDIATE, MODE_COALESCED, MODE_SILENT, MODE_REACTION)
+
+REACTION_TEXT = '✅'
+
+# reply token 約一分鐘內有效，合併視窗必須遠小於此
+MAX_COALESCE_WINDOW = 30
+# 超過速率上限而延後的合併回覆，reply token 超過此秒數後不再嘗試
+REPLY_TOKEN_TTL = 50
+
+
+def merge_by_group(acknowledgements):
+    """將同一批 webhook 事件的確認依群組合併
+
+    acknowledgements 為 (group_id, reply_token, mentioned_users) 的列表；
+    每個群組只保留第一個事件的 reply token，被提及者依 user_id 去重。
+    回傳同樣格式的列表，順序與各群組第一次出現的順序相同。
+    """
+    merged = {}
+    for group_id, reply_token, mentioned_users in acknowledgements:
+        if group_id not in merged:
+            merged[group_id] = (reply_token, [], set())
+        _token, users, seen = merged[group_id]
+        for user in mentioned_users:
+            if user['user_id'] not in seen:
+                seen.add(user['user_id'])
+                users.append(user)
+    return [(group_id, reply_token, users) for group_id, (reply_token, users, _seen) in merged.items()]
+
+
+class TokenBucket:
+    """權杖桶速率限制"""
+
+    def __init__(self, rate_per_minute, burst):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def try_acquire(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_seconds(self):
+        """距離下一個權杖可用的秒數"""
+        return max(0.0, (1 - self.tokens) / self.rate) if self.rate > 0 else float('inf')
+
+
+class _PendingAck:
+    __slots__ = ('reply_token', 'token_at', 'users', 'timer')
+
+    def __init__(self):
+        self.reply_token = None
+        self.token_at = None
+        self.users = {}
+        self.timer = None
+
+
+class ReplyPolicy:
+    """依群組設定決定確認訊息的回覆方式"""
+
+    def __init__(self, send_reply, format_reply, default_mode=MODE_IMMEDIATE,
+                 coalesce_window=3.0, rate_per_minute=20, burst=5, group_settings=None):
+        if default_mode not in MODES:
+            raise ValueError(f"未知的回覆模式: {default_mode}")
+        self.send_reply = send_reply
+        self.format_reply = format_reply
+        self.default_mode = default_mode
+        self.coalesce_window = min(coalesce_window, MAX_COALESCE_WINDOW)
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.group_settings = dict(group_settings or {})
+
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._pending = {}
+        self.stats = {
+            'acknowledged': 0,
+            'sent': 0,
+            'coalesced': 0,
+            'silenced': 0,
+            'rate_limited': 0,
+            'expired': 0,
+            'failed': 0,
+        }
+
+    @classmethod
+    def from_env(cls, send_reply, format_reply):
+        """由環境變數與設定檔（REPLY_POLICY_FILE）建立回覆策略"""
+        group_settings = {}
+        policy_file = os.getenv('REPLY_POLICY_FILE')
+        if policy_file and os.path.exists(policy_file):
+            with open(policy_file, 'r', encoding='utf-8') as f:
+                group_settings = json.load(f).get('groups', {})
+
+        return cls(
+            send_reply,
+            format_reply,
+            default_mode=os.getenv('REPLY_MODE', MODE_IMMEDIATE),
+            coalesce_window=float(os.getenv('REPLY_COALESCE_SECONDS', 3)),
+            rate_per_minute=float(os.getenv('REPLY_RATE_PER_MINUTE', 20)),
+            burst=int(os.getenv('REPLY_BURST', 5)),
+            group_settings=group_settings,
+        )
+
+    def mode_for(self, group_id):
+        return self.group_settings.get(group_id, {}).get('mode', self.default_mode)
+
+    def set_group_mode(self, group_id, mode):
+        if mode not in MODES:
+            raise ValueError(f"未知的回覆模式: {mode}")
+        with self._lock:
+            self.group_settings.setdefault(group_id, {})['mode'] = mode
+
+    def _bucket(self, group_id):
+        bucket = self._buckets.get(group_id)
+        if bucket is None:
+            settings = self.group_settings.get(group_id, {})
+            bucket = self._buckets[group_id] = TokenBucket(
+                settings.get('rate_per_minute', self.rate_per_minute),
+                settings.get('burst', self.burst),
+            )
+        return bucket
+
+    def acknowledge(self, group_id, reply_token, mentioned_users):
+        """處理一則提及訊息的確認
+
+        回傳應立即以此 reply token 發送的文字，呼叫端送出後以 record_reply 回報結果；
+        不需立即發送時回傳 None（合併的確認由計時器在視窗結束時送出）。
+        """
+        mode = self.mode_for(group_id)
+        with self._lock:
+            self.stats['acknowledged'] += 1
+            if mode == MODE_SILENT:
+                self.stats['silenced'] += 1
+                return None
+
+            if mode == MODE_IMMEDIATE and group_id not in self._pending:
+                if self._bucket(group_id).try_acquire():
+                    return self.format_reply(mentioned_users)
+                # 超過速率上限時不丟棄，改為併入下一則合併回覆
+                self.stats['rate_limited'] += 1
+
+            self._add_pending(group_id, reply_token, mentioned_users)
+            return None
+
+    def record_reply(self, ok):
+        """記錄呼叫端送出立即回覆的結果"""
+        with self._lock:
+            self.stats['sent' if ok else 'failed'] += 1
+
+    def _add_pending(self, group_id, reply_token, mentioned_users):
+        pending = self._pending.get(group_id)
+        if pending is None:
+            pending = self._pending[group_id] = _PendingAck()
+            self._arm(group_id, pending, self.coalesce_window)
+        else:
+            self.stats['coalesced'] += 1
+        # 使用最新的 reply token，降低合併期間過期的風險
+        pending.reply_token = reply_token
+        pending.token_at = time.monotonic()
+        for user in mentioned_users:
+            pending.users.setdefault(user['user_name'], user)
+
+    def _arm(self, group_id, pending, delay):
+        pending.timer = threading.Timer(delay, self._flush, args=(group_id,))
+        pending.timer.daemon = True
+        pending.timer.start()
+
+    def _flush(self, group_id, force=False):
+        with self._lock:
+            pending = self._pending.get(group_id)
+            if pending is None:
+                return
+            bucket = self._bucket(group_id)
+            if not bucket.try_acquire() and not force:
+                # 超過速率上限：保留等待中的確認（之後的確認繼續併入），等權杖可用時再送；
+                # reply token 屆時已過期則只能放棄
+                delay = max(bucket.wait_seconds(), 0.05)
+                if time.monotonic() + delay - pending.token_at < REPLY_TOKEN_TTL:
+                    self.stats['rate_limited'] += 1
+                    self._arm(group_id, pending, delay)
+                    return
+                self.stats['expired'] += 1
+                del self._pending[group_id]
+                return
+            del self._pending[group_id]
+
+        if self.mode_for(group_id) == MODE_REACTION:
+            text = REACTION_TEXT
+        else:
+            text = self.format_reply(list(pending.users.values()))
+        try:
+            self.send_reply(pending.reply_token, text)
+        except Exception as e:
+            self.record_reply(False)
+            logger.error(f"送出合併回覆時發生錯誤: {e}")
+            return
+        self.record_reply(True)
+
+    def flush_all(self):
+        """立即送出所有等待中的合併回覆（關閉前呼叫，不受速率上限限制）"""
+        with self._lock:
+            group_ids = list(self._pending)
+            for group_id in group_ids:
+                self._pending[group_id].timer.cancel()
+        for group_id in group_ids:
+            self._flush(group_id, force=True)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, pending_groups=len(self._pending), default_mode=self.default_mode)
@@ -0,0 +1,227 @@
+"""
+提及次數時間序列彙總
+依分鐘、小時、日三種解析度預先彙總，由寫入路徑在同一交易內更新；
+查詢時間只與時間桶數量有關，與原始記錄筆數無關
+"""
+
+import logging
+import sqlite3
+import threading
+from collections import Counter
+from datetime import timedelta, timezone
+
+import timeutil
+
+logger = logging.getLogger(__name__)
+
+# 代表「全部」的維度值：每筆提及同時計入 (群組, 使用者)、(群組, *)、(*, 使用者)、(*, *)
+ALL = '*'
+
+RESOLUTIONS = ('minute', 'hour', 'day')
+
+# 各解析度保留期限；較細的時間桶過期後刪除，資料已同時彙總在較粗的解析度中
+RETENTION = {
+    'minute': timedelta(days=2),
+    'hour': timedelta(days=90),
+    'day': None,
+}
+
+# 單次查詢最多回傳的時間桶數
+MAX_BUCKETS = 2000
+
+DEFAULT_RANGE = {
+    'minute': timedelta(hours=1),
+    'hour': timedelta(hours=24),
+    'day': timedelta(days=30),
+}
+
+
+def table_name(resolution):
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"未知的解析度: {resolution}")
+    return f'mention_rollup_{resolution}'
+
+
+def bucket_start(moment, resolution):
+    """回傳時間點所屬時間桶的起點（與 moment 相同時區，datetime）"""
+    if resolution == 'minute':
+        return moment.replace(second=0, microsecond=0)
+    if resolution == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_bucket_start(moment, resolution):
+    """下一個時間桶的起點
+
+    分鐘與小時以 UTC 前進固定秒數，跨日光節約時間切換時不會重複或缺漏時間桶；
+    日時間桶為當地的下一天（一天可能是 23 或 25 小時）。
+    """
+    if resolution == 'day':
+        return (moment.replace(tzinfo=None) + timedelta(days=1)).replace(tzinfo=moment.tzinfo)
+    step = timedelta(minutes=1) if resolution == 'minute' else timedelta(hours=1)
+    return (moment.astimezone(timezone.utc) + step).astimezone(moment.tzinfo)
+
+
+def retention_cutoff(resolution, now=None):
+    """解析度保留期限內最早的時間桶起點（datetime），永久保留時回傳 None"""
+    retention = RETENTION[resolution]
+    if retention is None:
+        return None
+    now = timeutil.to_display(now) if now else timeutil.now()
+    return bucket_start(now - retention, resolution)
+
+
+def to_epoch(moment):
+    return int(moment.timestamp())
+
+
+def bucket_counts(rows):
+    """將寫入的資料列彙總成 {(解析度, 時間桶, 群組, 使用者): 次數}"""
+    counts = Counter()
+    for user_id, _user_name, group_id, _message, _message_id, mentioned_at, *_ in rows:
+        mentioned_ms = timeutil.parse_stored(mentioned_at)
+        if mentioned_ms is None:
+            logger.warning(f"略過無法解析的時間: {mentioned_at!r}")
+            continue
+        # 時間桶依顯示時區切分（日時間桶為當地的一天）
+        moment = timeutil.from_ms(mentioned_ms)
+        group_id = group_id or ''
+        for resolution in RESOLUTIONS:
+            start = to_epoch(bucket_start(moment, resolution))
+            for dims in ((group_id, user_id), (group_id, ALL), (ALL, user_id), (ALL, ALL)):
+                counts[(resolution, start) + dims] += 1
+    return counts
+
+
+def record(conn, rows):
+    """在寫入交易中累加時間桶（呼叫端負責提交）"""
+    by_resolution = {}
+    for (resolution, start, group_id, user_id), count in bucket_counts(rows).items():
+        by_resolution.setdefault(resolution, []).append((group_id, user_id, start, count))
+    for resolution, values in by_resolution.items():
+        conn.executemany(f'''
+            INSERT INTO {table_name(resolution)} (group_id, user_id, bucket_start, count)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(group_id, user_id, bucket_start) DO UPDATE SET count = count + excluded.count
+        ''', values)
+
+
+def backfill(conn, batch_size=50000):
+    """由既有提及記錄重建所有彙總（結構升級時呼叫）"""
+    for resolution in RESOLUTIONS:
+        conn.execute(f'DELETE FROM {table_name(resolution)}')
+    cursor = conn.execute('''
+        SELECT user_id, user_name, group_id, message, message_id, mentioned_at
+        FROM mentioned_users
+        WHERE mentioned_at IS NOT NULL
+    ''')
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        record(conn, rows)
+
+
+def compact(conn, now=None):
+    """刪除超過保留期限的細粒度時間桶，回傳刪除筆數"""
+    now = timeutil.to_display(now) if now else timeutil.now()
+    deleted = 0
+    with conn:
+        for resolution in RESOLUTIONS:
+            cutoff = retention_cutoff(resolution, now)
+            if cutoff is None:
+                continue
+            deleted += conn.execute(
+                f'DELETE FROM {table_name(resolution)} WHERE bucket_start < ?', (to_epoch(cutoff),)
+            ).rowcount
+    return deleted
+
+
+def query(conn, resolution, start=None, end=None, group_id=None, user_id=None):
+    """查詢時間序列，回傳 [{'start': ISO 時間, 'count': 次數}]（無資料的時間桶補 0）
+
+    開始時間早於該解析度的保留期限時拋出 ValueError（細粒度時間桶已刪除，不回傳看似為 0 的結果）。
+    """
+    table = table_name(resolution)
+    # 時間桶以顯示時區計算，不含時區的參數視為顯示時區
+    start, end = [timeutil.to_display(moment) if moment else None for moment in (start, end)]
+    end = bucket_start(end or timeutil.now(), resolution)
+    start = bucket_start(start or end - DEFAULT_RANGE[resolution], resolution)
+    if start > end:
+        raise ValueError("start 不可晚於 end")
+    cutoff = retention_cutoff(resolution)
+    if cutoff is not None and start < cutoff:
+        coarser = RESOLUTIONS[RESOLUTIONS.index(resolution) + 1]
+        raise ValueError(f"{resolution} 時間桶只保留 {RETENTION[resolution].days} 天"
+                         f"（最早 {timeutil.isoformat(cutoff)}），請縮短範圍或改用 {coarser}")
+
+    buckets = []
+    moment = start
+    while moment <= end:
+        buckets.append(moment)
+        if len(buckets) > MAX_BUCKETS:
+            raise ValueError(f"時間範圍過大（最多 {MAX_BUCKETS} 個時間桶）")
+        moment = next_bucket_start(moment, resolution)
+
+    counts = dict(conn.execute(f'''
+        SELECT bucket_start, count FROM {table}
+        WHERE group_id = ? AND user_id = ? AND bucket_start BETWEEN ? AND ?
+    ''', (group_id or ALL, user_id or ALL, to_epoch(start), to_epoch(end))).fetchall())
+
+    return [{'start': timeutil.isoformat(moment), 'count': counts.get(to_epoch(moment), 0)} for moment in buckets]
+
+
+class RollupCompactor:
+    """背景定期刪除過期時間桶"""
+
+    def __init__(self, db_path, interval=3600):
+        self.db_path = db_path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None and self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name='rollup-compactor', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                conn = sqlite3.connect(self.db_path, timeout=5)
+                try:
+                    deleted = compact(conn)
+                finally:
+                    conn.close()
+                if deleted:
+                    logger.info(f"已刪除 {deleted} 個過期時間桶")
+            except Exception as e:
+                logger.error(f"整理時間序列彙總時發生錯誤: {e}")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='提及時間序列彙總維護')
+    parser.add_argument('command', choices=['backfill', 'compact'])
+    parser.add_argument('--db', default='line_data.db')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    try:
+        if args.command == 'backfill':
+            with conn:
+                backfill(conn)
+            print("✅ 已由提及記錄重建時間序列彙總")
+        else:
+            print(f"✅ 已刪除 {compact(conn)} 個過期時間桶")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+"""
+群組成員名冊與提及比對
+以群組成員的顯示名稱建立 Aho–Corasick 自動機，一次線性掃描訊息即可把
+「@顯示名稱」對應到真正的 LINE 使用者 ID：
+
+- 顯示名稱可以包含空白（`@Mary Chen`），名稱後面不需要分隔字元（`@王小明請看`）
+- 同一位置有多個名稱符合時取最長者（`@Mary Chen` 優先於 `@Mary`）
+- 名冊變動時只在字典樹插入新節點，失敗連結在下一次比對前重新計算；
+  移除的名稱只清除輸出，無用節點過多時才整棵重建
+- 轉移表為單一 dict（鍵為 節點編號 << 21 | 字元碼），失敗連結與深度為 array，
+  每個群組只佔用與名稱總長度成正比的記憶體
+
+名冊來源：
+- webhook 中 LINE 提供的 mentionees（index / length / userId），不需額外 API 呼叫
+- 選用（ROSTER_FETCH_MEMBERS=1）：背景以 LINE API 取得群組成員與發言者的顯示名稱
+  （成員 ID 列表 API 僅限認證或進階帳號）
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+CHAR_BITS = 21
+
+# 無用節點超過此比例時整棵重建
+COMPACT_RATIO = 0.5
+
+
+def _normalize_char(ch):
+    if ch.isspace():
+        return ' '
+    return unicodedata.normalize('NFKC', ch).casefold()
+
+
+def normalize(text):
+    """比對用的正規化：NFKC、不分大小寫、連續空白合併為一個空白"""
+    return normalize_with_positions(text)[0].strip()
+
+
+def normalize_with_positions(text):
+    """正規化並回傳每個正規化字元對應的原文位置"""
+    chars, positions = [], []
+    for index, ch in enumerate(text):
+        normalized = _normalize_char(ch)
+        if normalized == ' ' and chars and chars[-1] == ' ':
+            continue
+        for out in normalized:
+            chars.append(out)
+            positions.append(index)
+    return ''.join(chars), positions
+
+
+def _is_word_char(ch):
+    return ch.isascii() and ch.isalnum()
+
+
+class MentionMatcher:
+    """單一群組的「@顯示名稱」Aho–Corasick 自動機"""
+
+    __slots__ = ('_goto', '_fail', '_depth', '_output', '_users', '_dirty', '_dead', '_mentioned')
+
+    def __init__(self):
+        self._goto = {}
+        self._fail = array('I', [0])
+        self._depth = array('H', [0])
+        # 終端節點 → 使用者 ID（同名的多位成員為 tuple，無法判斷時不對應）
+        self._output = {}
+        # 使用者 ID → (顯示名稱, 終端節點)
+        self._users = {}
+        self._dirty = False
+        self._dead = 0
+        # 由 LINE 提供的 mentionees 學到的使用者，取代名冊時保留
+        self._mentioned = set()
+
+    def __len__(self):
+        return len(self._users)
+
+    @property
+    def node_count(self):
+        return len(self._depth)
+
+    def name_of(self, user_id):
+        entry = self._users.get(user_id)
+        return entry[0] if entry else None
+
+    def add(self, user_id, display_name, mentioned=False):
+        """加入或更新成員的顯示名稱，名冊有變動時回傳 True（mentioned 表示來自 LINE 的 mentionees）"""
+        pattern = '@' + normalize(display_name)
+        if len(pattern) < 2:
+            return False
+        if mentioned:
+            self._mentioned.add(user_id)
+        entry = self._users.get(user_id)
+        if entry is not None:
+            if entry[0] == display_name:
+                return False
+            self._detach(user_id, entry[1])
+
+        node = 0
+        for ch in pattern:
+            key = (node << CHAR_BITS) | ord(ch)
+            child = self._goto.get(key)
+            if child is None:
+                child = len(self._depth)
+                self._goto[key] = child
+                self._fail.append(0)
+                self._depth.append(min(self._depth[node] + 1, 0xFFFF))
+                self._dirty = True
+            node = child
+
+        owner = self._output.get(node)
+        if owner is None:
+            self._output[node] = user_id
+        else:
+            owners = owner if isinstance(owner, tuple) else (owner,)
+            self._output[node] = owners + (user_id,)
+        self._users[user_id] = (display_name, node)
+        return True
+
+    def remove(self, user_id):
+        self._mentioned.discard(user_id)
+        entry = self._users.pop(user_id, None)
+        if entry is None:
+            return False
+        self._detach(user_id, entry[1])
+        if self._dead > COMPACT_RATIO * self.node_count:
+            self._rebuild()
+        return True
+
+    def _detach(self, user_id, node):
+        owner = self._output.pop(node, None)
+        if isinstance(owner, tuple):
+            remaining = tuple(other for other in owner if other != user_id)
+            self._output[node] = remaining[0] if len(remaining) == 1 else remaining
+        else:
+            self._dead += self._depth[node]
+
+    def replace(self, members):
+        """以完整名冊 [(使用者 ID, 顯示名稱)] 取代目前的名冊
+
+        由 mentionees 學到的使用者即使不在名冊中也保留（LINE 已確認其 ID 與顯示名稱）。
+        """
+        current = dict(members)
+        for user_id in [user_id for user_id in self._users
+                        if user_id not in current and user_id not in self._mentioned]:
+            self.remove(user_id)
+        for user_id, name in current.items():
+            self.add(user_id, name)
+
+    def _rebuild(self):
+        users = [(user_id, name) for user_id, (name, _) in self._users.items()]
+        self._goto = {}
+        self._fail = array('I', [0])
+        self._depth = array('H', [0])
+        self._output = {}
+        self._users = {}
+        self._dirty = False
+        self._dead = 0
+        for user_id, name in users:
+            self.add(user_id, name)
+
+    def _link(self):
+        """以廣度優先順序重新計算失敗連結"""
+        edges = sorted(self._goto.items(), key=lambda item: self._depth[item[1]])
+        fail, goto = self._fail, self._goto
+        for key, child in edges:
+            parent, code = key >> CHAR_BITS, key & ((1 << CHAR_BITS) - 1)
+            if parent == 0:
+                fail[child] = 0
+                continue
+            node = fail[parent]
+            while True:
+                target = goto.get((node << CHAR_BITS) | code)
+                if target is not None:
+                    fail[child] = target
+                    break
+                if node == 0:
+                    fail[child] = 0
+                    break
+                node = fail[node]
+        self._dirty = False
+
+    def find(self, text):
+        """回傳訊息中提及的成員 [(原文起點, 原文終點, 使用者 ID, 顯示名稱)]
+
+        重疊的比對結果取最左、最長者；英數名稱後緊接英數字元時不視為提及。
+        """
+        if not self._users or '@' not in text:
+            return []
+        if self._dirty:
+            self._link()
+
+        normalized, positions = normalize_with_positions(text)
+        goto, fail, depth, output = self._goto, self._fail, self._depth, self._output
+        candidates = []
+        node = 0
+        for index, ch in enumerate(normalized):
+            code = ord(ch)
+            while True:
+                target = goto.get((node << CHAR_BITS) | code)
+                if target is not None:
+                    node = target
+                    break
+                if node == 0:
+                    break
+                node = fail[node]
+            # 沿失敗連結檢查所有以此字元結尾的名稱
+            match = node
+            while match:
+                owner = output.get(match)
+                if owner is not None and not isinstance(owner, tuple):
+                    start = index - depth[match] + 1
+                    following = normalized[index + 1:index + 2]
+                    if not (following and _is_word_char(following) and _is_word_char(ch)):
+                        candidates.append((start, index + 1, owner))
+                match = fail[match]
+
+        candidates.sort(key=lambda item: (item[0], item[0] - item[1]))
+        results, covered = [], 0
+        for start, end, user_id in candidates:
+            if start < covered:
+                continue
+            covered = end
+            results.append((positions[start], positions[end - 1] + 1, user_id, self._users[user_id][0]))
+        return results
+
+
+class RosterCache:
+    """各群組的成員名冊與比對自動機
+
+    群組數超過 max_groups 時淘汰最久未使用的群組；設定 fetch_members / fetch_member 時，
+    在背景執行緒以 LINE API 補齊名冊（每個群組每 ttl 秒最多完整取得一次）。
+    """
+
+    def __init__(self, fetch_members=None, fetch_member=None, max_groups=500, ttl=86400):
+        self.fetch_members = fetch_members
+        self.fetch_member = fetch_member
+        self.max_groups = max_groups
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._groups = OrderedDict()
+        # 群組 → (最近一次嘗試取得名冊的時間, 是否成功)；完整名冊的群組不採用未知的 @ 文字
+        self._fetched = {}
+        self._pending = set()
+        self._queue = None
+
+    @classmethod
+    def from_env(cls, fetch_members=None, fetch_member=None):
+        enabled = os.getenv('ROSTER_FETCH_MEMBERS') == '1'
+        return cls(fetch_members if enabled else None,
+                   fetch_member if enabled else None,
+                   max_groups=int(os.getenv('ROSTER_MAX_GROUPS', 500)),
+                   ttl=int(os.getenv('ROSTER_TTL', 86400)))
+
+    def _matcher(self, group_id, create=True):
+        matcher = self._groups.get(group_id)
+        if matcher is None:
+            if not create:
+                return None
+            matcher = self._groups[group_id] = MentionMatcher()
+            if len(self._groups) > self.max_groups:
+                evicted, _ = self._groups.popitem(last=False)
+                self._fetched.pop(evicted, None)
+        else:
+            self._groups.move_to_end(group_id)
+        return matcher
+
+    def learn(self, group_id, user_id, display_name, mentioned=False):
+        if not (group_id and user_id and display_name):
+            return False
+        with self._lock:
+            return self._matcher(group_id).add(user_id, display_name, mentioned)
+
+    def forget(self, group_id, user_id):
+        with self._lock:
+            matcher = self._matcher(group_id, create=False)
+            return matcher.remove(user_id) if matcher is not None else False
+
+    def learn_mentionees(self, group_id, text, mentionees):
+        """由 LINE 提供的提及位置學習名稱（mentionees 為 (index, length, user_id)）"""
+        encoded = text.encode('utf-16-le')
+        for index, length, user_id in mentionees:
+            # index 與 length 以 UTF-16 編碼單位計算（表情符號佔兩個單位）
+            name = encoded[index * 2:(index + length) * 2].decode('utf-16-le', errors='ignore')
+            if name.startswith('@'):
+                self.learn(group_id, user_id, name[1:].strip(), mentioned=True)
+
+    def _fetch_due(self, group_id):
+        fetched = self._fetched.get(group_id)
+        return fetched is None or time.time() - fetched[0] >= self.ttl
+
+    def is_complete(self, group_id):
+        fetched = self._fetched.get(group_id)
+        return fetched is not None and fetched[1] and time.time() - fetched[0] < self.ttl
+
+    def name_of(self, group_id, user_id):
+        """名冊中成員的顯示名稱，不在名冊中時回傳 None"""
+        with self._lock:
+            matcher = self._matcher(group_id, create=False)
+            return matcher.name_of(user_id) if matcher is not None else None
+
+    def find(self, group_id, text):
+        """比對訊息中的成員提及，沒有名冊時回傳空列表"""
+        with self._lock:
+            matcher = self._matcher(group_id, create=False)
+            return matcher.find(text) if matcher is not None else []
+
+    def observe(self, group_id, sender_id=None):
+        """收到群組訊息時呼叫：名冊過期或發言者未知時排入背景取得"""
+        if not group_id or (self.fetch_members is None and self.fetch_member is None):
+            return
+        with self._lock:
+            matcher = self._groups.get(group_id)
+            if self.fetch_members is not None and self._fetch_due(group_id):
+                self._schedule((group_id, None))
+            elif (self.fetch_member is not None and sender_id
+                  and (matcher is None or matcher.name_of(sender_id) is None)):
+                self._schedule((group_id, sender_id))
+
+    def _schedule(self, job):
+        if job in self._pending:
+            return
+        self._pending.add(job)
+        if self._queue is None:
+            self._queue = queue.Queue()
+            threading.Thread(target=self._run, name='roster-fetch', daemon=True).start()
+        self._queue.put(job)
+
+    def _run(self):
+        while True:
+            group_id, user_id = job = self._queue.get()
+            try:
+                if user_id is None:
+                    # fetch_members 只在取得完整名冊時回傳；任何一頁或成員資料失敗都拋出例外，
+                    # 由下方標記為不完整，不以部分名冊取代，@ 文字仍以正則表達式解析
+                    members = list(self.fetch_members(group_id))
+                    with self._lock:
+                        # 完整名冊取代原本的名冊（已離開群組的成員一併移除，mentionees 學到的保留）
+                        self._matcher(group_id).replace(members)
+                        self._fetched[group_id] = (time.time(), True)
+                else:
+                    name = self.fetch_member(group_id, user_id)
+                    if name:
+                        self.learn(group_id, user_id, name)
+            except Exception as e:
+                logger.error(f"取得群組成員名冊時發生錯誤: {e}")
+                if user_id is None:
+                    # 失敗（例如帳號無權限）時同樣等 ttl 後再重試，名冊維持不完整
+                    with self._lock:
+                        self._fetched[group_id] = (time.time(), False)
+            finally:
+                with self._lock:
+                    self._pending.discard(job)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'groups': len(self._groups),
+                'members': sum(len(matcher) for matcher in self._groups.values()),
+                'nodes': sum(matcher.node_count for matcher in self._groups.values()),
+                'complete_groups': sum(1 for group_id in self._groups if self.is_complete(group_id)),
+            }
@@ -0,0 +1,363 @@
+"""
+資料庫結構
+集中管理所有資料表的 DDL；以 PRAGMA user_version 記錄結構版本，
+版本已是最新時只讀取一次版本號，不再執行任何 DDL
+"""
+
+import logging
+import sqlite3
+import threading
+
+import hll
+import rollups
+import timeutil
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 10
+
+MESSAGES_TABLE = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY,
+        message_id TEXT,
+        group_id TEXT,
+        sender_id TEXT,
+        message TEXT,
+        created_at INTEGER NOT NULL
+    )
+'''
+
+# SQLite 內以 julianday 計算目前或指定時間（UTC）的 epoch 毫秒
+_EPOCH_MS_SQL = "CAST(ROUND((julianday({value}) - 2440587.5) * 86400000) AS INTEGER)"
+
+TABLES = [
+    # 訊息（每則訊息一列，訊息內容只存一次）；created_at 為 UTC epoch 毫秒
+    MESSAGES_TABLE.format(name='messages'),
+    'CREATE INDEX IF NOT EXISTS idx_messages_message_id ON messages (message_id)',
+    'CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages (created_at)',
+    # 提及記錄（每位被提及的使用者一列，參照所屬訊息）
+    '''
+    CREATE TABLE IF NOT EXISTS mentions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message_ref INTEGER NOT NULL REFERENCES messages (id),
+        user_id TEXT NOT NULL,
+        user_name TEXT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_mentions_message ON mentions (message_ref)',
+    # 群組資訊
+    '''
+    CREATE TABLE IF NOT EXISTS groups (
+        group_id TEXT PRIMARY KEY,
+        group_name TEXT,
+        member_count INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    # 使用者資訊（display_name 為最近一次被提及時的名稱，由寫入路徑更新）
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id TEXT PRIMARY KEY,
+        display_name TEXT,
+        picture_url TEXT,
+        status_message TEXT,
+        first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    # 每月 LINE 訊息用量（line_api.MessageQuota）
+    '''
+    CREATE TABLE IF NOT EXISTS line_message_usage (
+        month TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        sent INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (month, kind)
+    )
+    ''',
+    # 提及通知佇列（notifier）
+    '''
+    CREATE TABLE IF NOT EXISTS notifications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        group_id TEXT,
+        message_id TEXT,
+        dedup_key TEXT NOT NULL,
+        content TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        claimed_by TEXT,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        not_before REAL NOT NULL DEFAULT 0,
+        error TEXT,
+        mention_count INTEGER NOT NULL DEFAULT 1
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_notifications_status ON notifications (status, id)',
+    'CREATE INDEX IF NOT EXISTS idx_notifications_dedup ON notifications (user_id, dedup_key, created_at)',
+    # 已計入通知的訊息（合併的通知包含多則訊息），webhook 重送同一則訊息時不重複計入
+    '''
+    CREATE TABLE IF NOT EXISTS notification_messages (
+        user_id TEXT NOT NULL,
+        dedup_key TEXT NOT NULL,
+        message_id TEXT NOT NULL,
+        notification_id INTEGER NOT NULL,
+        PRIMARY KEY (user_id, dedup_key, message_id)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS notification_preferences (
+        user_id TEXT PRIMARY KEY,
+        enabled INTEGER NOT NULL DEFAULT 1,
+        quiet_start TEXT,
+        quiet_end TEXT,
+        timezone TEXT
+    )
+    ''',
+    # 定期提及摘要（digests）：群組的摘要設定、各期間的待送計數與待送摘要佇列；
+    # period_start、next_run 為 UTC epoch 毫秒，sender_id 為空字串表示未記錄發言者
+    '''
+    CREATE TABLE IF NOT EXISTS digest_schedules (
+        group_id TEXT PRIMARY KEY,
+        frequency TEXT NOT NULL,
+        send_at TEXT,
+        timezone TEXT NOT NULL,
+        period_start INTEGER NOT NULL,
+        next_run INTEGER NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_digest_schedules_next_run ON digest_schedules (next_run)',
+    '''
+    CREATE TABLE IF NOT EXISTS digest_pending (
+        group_id TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        sender_id TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (group_id, user_id, sender_id)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS digest_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        group_id TEXT NOT NULL,
+        timezone TEXT NOT NULL,
+        period_start INTEGER NOT NULL,
+        period_end INTEGER NOT NULL,
+        counts TEXT NOT NULL,
+        retry_key TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        claimed_by TEXT,
+        updated_at REAL NOT NULL,
+        not_before REAL NOT NULL DEFAULT 0,
+        error TEXT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_digest_outbox_status ON digest_outbox (status, id)',
+] + [
+    # 時間序列彙總（rollups），每個解析度一張表；'*' 代表全部群組或全部使用者
+    f'''
+    CREATE TABLE IF NOT EXISTS {rollups.table_name(resolution)} (
+        group_id TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        bucket_start INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (group_id, user_id, bucket_start)
+    ) WITHOUT ROWID
+    '''
+    for resolution in rollups.RESOLUTIONS
+] + [
+    # 相異計數摘要（hll）；bucket_start 為當日起點，hll.ALL_TIME 代表全部期間；registers 為稀疏或密集格式
+    '''
+    CREATE TABLE IF NOT EXISTS mention_hll (
+        kind TEXT NOT NULL,
+        group_id TEXT NOT NULL,
+        bucket_start INTEGER NOT NULL,
+        registers BLOB NOT NULL,
+        PRIMARY KEY (kind, group_id, bucket_start)
+    ) WITHOUT ROWID
+    ''',
+]
+
+# 以檢視表提供與舊版 mentioned_users 資料表相同的欄位，查詢程式不需要改寫；
+# 舊程式（run.py 的範例資料等）寫入檢視表時由觸發器拆分為訊息與提及記錄
+MENTION_VIEW = [
+    '''
+    CREATE VIEW IF NOT EXISTS mentioned_users AS
+    SELECT mentions.id AS id,
+           mentions.user_id AS user_id,
+           mentions.user_name AS user_name,
+           messages.group_id AS group_id,
+           messages.message AS message,
+           messages.created_at AS mentioned_at,
+           messages.message_id AS message_id,
+           messages.sender_id AS sender_id
+    FROM mentions JOIN messages ON messages.id = mentions.message_ref
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS mentioned_users_insert
+    INSTEAD OF INSERT ON mentioned_users
+    BEGIN
+        INSERT INTO messages (message_id, group_id, sender_id, message, created_at)
+        SELECT NEW.message_id, NEW.group_id, NEW.sender_id, NEW.message,
+               CASE WHEN NEW.mentioned_at IS NULL THEN {_EPOCH_MS_SQL.format(value="'now'")}
+                    WHEN typeof(NEW.mentioned_at) = 'integer' THEN NEW.mentioned_at
+                    ELSE {_EPOCH_MS_SQL.format(value='NEW.mentioned_at')} END
+        WHERE NEW.message_id IS NULL
+           OR NOT EXISTS (SELECT 1 FROM messages WHERE message_id = NEW.message_id);
+        INSERT INTO mentions (id, message_ref, user_id, user_name)
+        VALUES (
+            NEW.id,
+            CASE WHEN NEW.message_id IS NULL THEN last_insert_rowid()
+                 ELSE (SELECT MAX(id) FROM messages WHERE message_id = NEW.message_id) END,
+            NEW.user_id,
+            NEW.user_name
+        );
+    END
+    ''',
+]
+
+# 舊版資料庫可能缺少的欄位（app_simple 早期建立的 mentioned_users 沒有 sender_id；
+# v9 以前的 notifications 沒有合併次數 mention_count）
+ADDED_COLUMNS = [
+    ('mentioned_users', 'sender_id', 'TEXT'),
+    ('notifications', 'mention_count', 'INTEGER NOT NULL DEFAULT 1'),
+]
+
+
+
+def _object_type(conn, name):
+    row = conn.execute('SELECT type FROM sqlite_master WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else None
+
+
+def normalize_mentions(conn):
+    """將舊版 mentioned_users 資料表拆分為 messages 與 mentions，並改為檢視表
+
+    同一事件的資料列（訊息編號、群組、內容與時間相同）合併為一則訊息，
+    訊息 id 取其中最小的提及 id；提及記錄保留原本的 id。
+    """
+    if _object_type(conn, 'mentioned_users') == 'table':
+        conn.create_function('epoch_ms', 1, timeutil.parse_stored, deterministic=True)
+        conn.execute('''
+            INSERT INTO messages (id, message_id, group_id, sender_id, message, created_at)
+            SELECT MIN(id), message_id, group_id, sender_id, message, COALESCE(epoch_ms(mentioned_at), 0)
+            FROM mentioned_users
+            GROUP BY message_id, group_id, sender_id, message, mentioned_at
+        ''')
+        conn.execute('''
+            INSERT INTO mentions (id, message_ref, user_id, user_name)
+            SELECT id,
+                   MIN(id) OVER (PARTITION BY message_id, group_id, sender_id, message, mentioned_at),
+                   user_id, user_name
+            FROM mentioned_users
+        ''')
+        conn.execute('DROP TABLE mentioned_users')
+    for ddl in MENTION_VIEW:
+        conn.execute(ddl)
+
+
+def epoch_timestamps(conn):
+    """將訊息時間由 ISO 字串轉為 UTC epoch 毫秒，並以顯示時區重建時間桶與相異計數摘要
+
+    字串的解讀方式見 timeutil.parse_stored；已是毫秒的值維持不變。
+    """
+    conn.create_function('epoch_ms', 1, timeutil.parse_stored, deterministic=True)
+    # 重建資料表以套用新的欄位型別；先移除參照 messages 的檢視表與觸發器
+    conn.execute('DROP VIEW IF EXISTS mentioned_users')
+    conn.execute(MESSAGES_TABLE.format(name='messages_epoch'))
+    conn.execute('''
+        INSERT INTO messages_epoch (id, message_id, group_id, sender_id, message, created_at)
+        SELECT id, message_id, group_id, sender_id, message, COALESCE(epoch_ms(created_at), 0)
+        FROM messages
+    ''')
+    conn.execute('DROP TABLE messages')
+    conn.execute('ALTER TABLE messages_epoch RENAME TO messages')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_message_id ON messages (message_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages (created_at)')
+    for ddl in MENTION_VIEW:
+        conn.execute(ddl)
+    rollups.backfill(conn)
+    hll.backfill(conn)
+
+
+def user_names(conn):
+    """由既有提及記錄建立使用者 ID 與最新顯示名稱的對應"""
+    conn.execute('''
+        INSERT INTO users (user_id, display_name)
+        SELECT user_id, user_name FROM mentions
+        WHERE id IN (
+            SELECT MAX(id) FROM mentions
+            WHERE user_name IS NOT NULL AND user_name != user_id
+            GROUP BY user_id
+        )
+        ON CONFLICT(user_id) DO UPDATE SET display_name = excluded.display_name
+    ''')
+
+
+def notification_messages(conn):
+    """由既有通知建立已計入的訊息記錄（之前的版本只在通知上保存一則訊息編號）"""
+    conn.execute('''
+        INSERT OR IGNORE INTO notification_messages (user_id, dedup_key, message_id, notification_id)
+        SELECT user_id, dedup_key, message_id, id FROM notifications WHERE message_id IS NOT NULL
+    ''')
+
+
+# 各版本升級時需要執行的資料轉換（在資料表建立之後執行）
+DATA_MIGRATIONS = {
+    2: rollups.backfill,
+    3: hll.backfill,
+    4: normalize_mentions,
+    5: epoch_timestamps,
+    6: user_names,
+    8: hll.compact,
+    10: notification_messages,
+}
+
+_ready_paths = set()
+_lock = threading.Lock()
+
+
+def _column_names(conn, table):
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def migrate(conn, from_version=0):
+    """建立或升級資料庫結構至最新版本"""
+    with conn:
+        for ddl in TABLES:
+            conn.execute(ddl)
+        if _object_type(conn, 'mentioned_users') is None:
+            # 新資料庫直接建立檢視表，讓之前版本的資料轉換也能讀取
+            normalize_mentions(conn)
+        for table, column, column_type in ADDED_COLUMNS:
+            if _object_type(conn, table) == 'table' and column not in _column_names(conn, table):
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+        for version in sorted(DATA_MIGRATIONS):
+            if from_version < version:
+                logger.info(f"執行資料轉換 v{version}")
+                DATA_MIGRATIONS[version](conn)
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+
+def ensure_schema(db_path='line_data.db'):
+    """確保資料庫結構為最新版本；回傳是否實際執行了 DDL
+
+    同一程序內每個資料庫只檢查一次，之後的呼叫不會開啟連線。
+    """
+    if db_path in _ready_paths:
+        return False
+    with _lock:
+        if db_path in _ready_paths:
+            return False
+        conn = sqlite3.connect(db_path, timeout=5)
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            ran_ddl = version < SCHEMA_VERSION
+            if ran_ddl:
+                logger.info(f"升級資料庫結構 {db_path}: v{version} → v{SCHEMA_VERSION}")
+                migrate(conn, version)
+        finally:
+            conn.close()
+        _ready_paths.add(db_path)
+        return ran_ddl
@@ -6,7 +6,6 @@ LINE @ 提醒系統安裝腳本
 import os
 import sys
 import subprocess
-import sqlite3
 
 def install_requirements():
     """安裝 Python 依賴套件"""
@@ -43,21 +42,8 @@ def init_database():
     """初始化資料庫"""
     print("正在初始化資料庫...")
     try:
-        conn = sqlite3.connect('line_data.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS mentioned_users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                user_name TEXT,
-                group_id TEXT,
-                message TEXT,
-                mentioned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                message_id TEXT
-            )
-        ''')
-        conn.commit()
-        conn.close()
+        import schema
+        schema.ensure_schema('line_data.db')
         print("✅ 資料庫初始化完成")
     except Exception as e:
         print(f"❌ 資料庫初始化失敗: {e}")
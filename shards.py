@@ -0,0 +1,238 @@
+"""
+提及記錄分片
+依 group_id 的穩定雜湊（jump consistent hash）將提及記錄分散到多個 SQLite 檔案，
+每個分片有各自的寫入鎖與寫入執行緒；全域查詢以執行緒池並行查詢各分片後合併
+
+分片只存放提及記錄與其衍生資料（時間序列彙總、相異計數摘要），以及與提及記錄
+在同一交易中更新的定期摘要資料表；通知佇列、訊息用量等其他資料表仍在主資料庫。DB_SHARDS 未設定或為 1 時維持單一資料庫。
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import digests
+import mention_writer
+import rollups
+import schema
+
+logger = logging.getLogger(__name__)
+
+# 分片中屬於提及記錄的資料表（重新分片時搬移或清除）
+MENTION_TABLES = ['mentions', 'messages', 'mention_hll'] + [rollups.table_name(r) for r in rollups.RESOLUTIONS]
+
+# 依群組存放的摘要資料表（重新分片時在提及記錄之後搬移，避免搬移的提及被計入待送計數）
+GROUP_TABLES = list(digests.TABLES)
+
+
+def jump_hash(key, buckets):
+    """Jump consistent hash：分片數由 n 變為 n + 1 時只有約 1/(n + 1) 的鍵需要搬移"""
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def shard_index(group_id, count):
+    if count == 1:
+        return 0
+    digest = hashlib.blake2b((group_id or '').encode('utf-8'), digest_size=8).digest()
+    return jump_hash(int.from_bytes(digest, 'big'), count)
+
+
+def shard_paths(base_path, count):
+    """各分片的資料庫路徑；單一分片時即為主資料庫"""
+    if count == 1:
+        return [base_path]
+    root, ext = os.path.splitext(base_path)
+    return [f'{root}.{index}-of-{count}{ext}' for index in range(count)]
+
+
+class ShardSet:
+    """一組分片資料庫：寫入依群組路由，讀取並行查詢各分片"""
+
+    def __init__(self, base_path=mention_writer.DB_PATH, count=1, max_workers=None):
+        if count < 1:
+            raise ValueError("分片數必須至少為 1")
+        self.base_path = base_path
+        self.count = count
+        self.paths = shard_paths(base_path, count)
+        self._executor = None
+        self._max_workers = max_workers or count
+        # 設定 replicas（snapshots.ReplicaManager）後，map(..., replica=True) 改讀唯讀副本
+        self.replicas = None
+
+    @classmethod
+    def from_env(cls, base_path=mention_writer.DB_PATH):
+        return cls(base_path, int(os.getenv('DB_SHARDS', 1)))
+
+    def path_for(self, group_id):
+        return self.paths[shard_index(group_id, self.count)]
+
+    def ensure_schema(self):
+        """確保主資料庫與各分片的結構為最新版本；回傳是否實際執行了 DDL"""
+        return any([schema.ensure_schema(path) for path in dict.fromkeys([self.base_path] + self.paths)])
+
+    def submit_mention_batches(self, batches):
+        """依群組將各事件的資料列送往所屬分片，回傳每個事件是否寫入成功"""
+        by_path = {}
+        for index, rows in enumerate(batches):
+            # 同一事件的資料列屬於同一群組（第 3 欄為 group_id）
+            path = self.path_for(rows[0][2] if rows else None)
+            by_path.setdefault(path, []).append(index)
+        results = [False] * len(batches)
+        for path, indexes in by_path.items():
+            written = mention_writer.submit_mention_batches([batches[i] for i in indexes], path)
+            for index, ok in zip(indexes, written):
+                results[index] = ok
+        return results
+
+    def _query_shard(self, path, func, args, replica=False):
+        if replica and self.replicas is not None:
+            conn = self.replicas.connect(path, mention_writer.connect_reader)
+        else:
+            conn = mention_writer.connect_reader(path)
+        try:
+            return func(conn, *args)
+        finally:
+            conn.close()
+
+    def map(self, func, *args, group_id=None, replica=False):
+        """在各分片（指定 group_id 時只在其所屬分片）執行 func(conn, *args)，回傳結果列表
+
+        replica=True 時優先讀取唯讀副本（大量讀取的統計查詢，不與寫入競爭）。
+        """
+        paths = [self.path_for(group_id)] if group_id and group_id != rollups.ALL else self.paths
+        if len(paths) == 1:
+            return [self._query_shard(paths[0], func, args, replica)]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix='shard-query')
+        futures = [self._executor.submit(self._query_shard, path, func, args, replica) for path in paths]
+        return [future.result() for future in futures]
+
+
+def merge_buckets(results):
+    """合併各分片的時間序列（時間桶相同，次數相加）"""
+    merged = [dict(bucket) for bucket in results[0]]
+    for buckets in results[1:]:
+        for total, bucket in zip(merged, buckets):
+            total['count'] += bucket['count']
+    return merged
+
+
+def _clear_mentions(conn):
+    with conn:
+        for table in MENTION_TABLES + GROUP_TABLES:
+            conn.execute(f'DELETE FROM {table}')
+
+
+def rebalance(base_path, old_count, new_count, batch_size=10000, prune=False):
+    """離線重新分片：將提及記錄依新的分片數重新寫入（執行期間需停止服務）
+
+    分片檔名包含分片數，新舊分片不會是同一個檔案；目標分片的既有提及記錄會先清除。
+    prune=True 時搬移完成後刪除舊分片檔案（舊分片為主資料庫時只清除其中的提及記錄）。
+    回傳各新分片的筆數。
+    """
+    old_paths = shard_paths(base_path, old_count)
+    new_paths = shard_paths(base_path, new_count)
+    if old_count == new_count:
+        return {}
+
+    targets = {path: mention_writer.connect(path) for path in new_paths}
+    counts = dict.fromkeys(new_paths, 0)
+    try:
+        for conn in targets.values():
+            _clear_mentions(conn)
+        for old_path in old_paths:
+            if not os.path.exists(old_path):
+                continue
+            source = sqlite3.connect(old_path)
+            try:
+                cursor = source.execute('''
+                    SELECT user_id, user_name, group_id, message, message_id, mentioned_at, sender_id
+                    FROM mentioned_users ORDER BY id
+                ''')
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    by_path = {}
+                    for row in rows:
+                        by_path.setdefault(new_paths[shard_index(row[2], new_count)], []).append(row)
+                    # 寫入時同時更新目標分片的時間序列彙總與相異計數摘要
+                    for path, path_rows in by_path.items():
+                        mention_writer.write_rows(targets[path], path_rows)
+                        counts[path] += len(path_rows)
+            finally:
+                source.close()
+            logger.info(f"已搬移 {old_path}")
+        for old_path in old_paths:
+            if not os.path.exists(old_path):
+                continue
+            source = mention_writer.connect(old_path)
+            try:
+                digests.copy_rows(source, lambda group_id: targets[new_paths[shard_index(group_id, new_count)]])
+            finally:
+                source.close()
+        for conn in targets.values():
+            conn.commit()
+    finally:
+        for conn in targets.values():
+            conn.close()
+
+    if prune:
+        for path in old_paths:
+            if not os.path.exists(path):
+                continue
+            if path == base_path:
+                conn = sqlite3.connect(path)
+                try:
+                    _clear_mentions(conn)
+                finally:
+                    conn.close()
+            else:
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+    return counts
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='提及記錄分片維護')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    status = subparsers.add_parser('status', help='各分片的提及記錄筆數')
+    status.add_argument('--shards', type=int, default=int(os.getenv('DB_SHARDS', 1)))
+    move = subparsers.add_parser('rebalance', help='離線變更分片數（執行前請停止服務）')
+    move.add_argument('--from', dest='old_count', type=int, required=True)
+    move.add_argument('--to', dest='new_count', type=int, required=True)
+    move.add_argument('--prune', action='store_true', help='搬移後刪除舊分片')
+    for subparser in (status, move):
+        subparser.add_argument('--db', default=mention_writer.DB_PATH)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'status':
+        for path in shard_paths(args.db, args.shards):
+            if not os.path.exists(path):
+                print(f"{path}: 不存在")
+                continue
+            conn = sqlite3.connect(path)
+            try:
+                print(f"{path}: {conn.execute('SELECT COUNT(*) FROM mentioned_users').fetchone()[0]} 筆")
+            finally:
+                conn.close()
+    else:
+        counts = rebalance(args.db, args.old_count, args.new_count, prune=args.prune)
+        for path, count in counts.items():
+            print(f"{path}: {count} 筆")
+        print(f"✅ 已由 {args.old_count} 個分片重新分配為 {args.new_count} 個分片")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+資料庫快照與線上備份
+以 SQLite backup API 分段複製資料庫：每段複製固定頁數後暫停，避免影響線上寫入；
+複製期間在來源連線保持讀取交易，取得一致的時間點快照（WAL 模式下不阻擋寫入）
+
+- 唯讀副本：背景定期更新，供統計等大量讀取的查詢使用，與 webhook 寫入分開
+- 備份：產生可下載的時間點備份檔
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zipfile
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# 每段複製的頁數與段間暫停秒數
+DEFAULT_PAGES = 256
+DEFAULT_PAUSE = 0.005
+
+# 副本超過此時間未更新即視為過期，改讀主資料庫
+STALE_FACTOR = 3
+
+
+def replica_path(db_path):
+    root, ext = os.path.splitext(db_path)
+    return f'{root}.replica{ext}'
+
+
+def backup_database(source_path, target_path, pages=DEFAULT_PAGES, pause=DEFAULT_PAUSE):
+    """將資料庫一致地複製到 target_path（先寫入暫存檔再原子替換），回傳複製的頁數"""
+    # 多個 worker 可能同時更新同一副本，暫存檔名包含程序編號
+    temp_path = f'{target_path}.{os.getpid()}.tmp'
+
+    def pace(status, remaining, total):
+        if remaining and pause:
+            time.sleep(pause)
+
+    source = sqlite3.connect(source_path, timeout=5, isolation_level=None)
+    target = None
+    try:
+        target = sqlite3.connect(temp_path)
+        # 讀取交易讓每一段都讀同一個快照；否則複製期間有寫入時 backup 會從頭開始
+        source.execute('BEGIN')
+        total = source.execute('PRAGMA page_count').fetchone()[0]
+        source.backup(target, pages=pages, progress=pace)
+        source.execute('COMMIT')
+        # 副本為獨立檔案，不需要 WAL
+        target.execute('PRAGMA journal_mode=DELETE')
+    except BaseException:
+        if target is not None:
+            target.close()
+        source.close()
+        # 連線或 BEGIN 失敗時暫存檔可能尚未建立，不可蓋掉原本的例外
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    target.close()
+    source.close()
+    os.replace(temp_path, target_path)
+    return total
+
+
+class ReplicaManager:
+    """定期更新唯讀副本，並提供大量讀取查詢使用的連線
+
+    副本是否新鮮以檔案修改時間判斷：多個 worker 共用同一份副本，
+    其他 worker 剛更新過的副本不會重複複製。
+    """
+
+    def __init__(self, db_paths, interval=300, pages=DEFAULT_PAGES, pause=DEFAULT_PAUSE):
+        self.db_paths = list(db_paths)
+        self.interval = interval
+        self.pages = pages
+        self.pause = pause
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, db_paths):
+        return cls(db_paths,
+                   interval=int(os.getenv('SNAPSHOT_INTERVAL', 0)),
+                   pages=int(os.getenv('SNAPSHOT_PAGES', DEFAULT_PAGES)),
+                   pause=float(os.getenv('SNAPSHOT_PAUSE', DEFAULT_PAUSE)))
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def start(self):
+        if self._thread is None and self.enabled:
+            self._thread = threading.Thread(target=self._run, name='replica-refresh', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def refreshed_at(self, db_path):
+        try:
+            return os.path.getmtime(replica_path(db_path))
+        except OSError:
+            return None
+
+    def refresh(self, force=False):
+        """更新所有資料庫的副本（副本在半個週期內已更新過時略過，除非 force）"""
+        for db_path in self.db_paths:
+            if not os.path.exists(db_path):
+                continue
+            refreshed_at = self.refreshed_at(db_path)
+            if not force and refreshed_at is not None and time.time() - refreshed_at < self.interval / 2:
+                continue
+            started = time.perf_counter()
+            try:
+                page_count = backup_database(db_path, replica_path(db_path), self.pages, self.pause)
+            except sqlite3.Error as e:
+                logger.error(f"更新副本 {db_path} 時發生錯誤: {e}")
+                continue
+            logger.info(f"已更新副本 {replica_path(db_path)}（{page_count} 頁，"
+                        f"{time.perf_counter() - started:.2f} 秒）")
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.refresh()
+            self._stop.wait(self.interval)
+
+    def is_fresh(self, db_path):
+        refreshed_at = self.refreshed_at(db_path)
+        return refreshed_at is not None and time.time() - refreshed_at < self.interval * STALE_FACTOR
+
+    def connect(self, db_path, fallback):
+        """副本可用時回傳副本的唯讀連線，否則以 fallback(db_path) 連線主資料庫"""
+        if self.enabled and self.is_fresh(db_path):
+            try:
+                return sqlite3.connect(f'file:{replica_path(db_path)}?mode=ro', uri=True)
+            except sqlite3.Error as e:
+                logger.error(f"開啟副本時發生錯誤，改讀主資料庫: {e}")
+        return fallback(db_path)
+
+    def status(self):
+        replicas = {}
+        for db_path in self.db_paths:
+            refreshed_at = self.refreshed_at(db_path)
+            replicas[db_path] = {
+                'refreshed_at': datetime.fromtimestamp(refreshed_at).isoformat() if refreshed_at else None,
+                'fresh': self.is_fresh(db_path),
+            }
+        return {'enabled': self.enabled, 'interval': self.interval, 'replicas': replicas}
+
+
+def create_backup(db_paths, backup_dir='backups', keep=5, pages=DEFAULT_PAGES, pause=DEFAULT_PAUSE):
+    """產生時間點備份並回傳檔案路徑；多個資料庫（分片）時打包為 zip
+
+    只保留最近 keep 份備份。
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    db_paths = [path for path in db_paths if os.path.exists(path)]
+    if len(db_paths) == 1:
+        root, ext = os.path.splitext(os.path.basename(db_paths[0]))
+        path = os.path.join(backup_dir, f'{root}-{stamp}{ext}')
+        backup_database(db_paths[0], path, pages, pause)
+    else:
+        path = os.path.join(backup_dir, f'line_data-{stamp}.zip')
+        with zipfile.ZipFile(f'{path}.tmp', 'w', zipfile.ZIP_DEFLATED) as archive:
+            for db_path in db_paths:
+                copy_path = os.path.join(backup_dir, f'.{os.path.basename(db_path)}.copy')
+                try:
+                    backup_database(db_path, copy_path, pages, pause)
+                    archive.write(copy_path, os.path.basename(db_path))
+                finally:
+                    if os.path.exists(copy_path):
+                        os.remove(copy_path)
+        os.replace(f'{path}.tmp', path)
+
+    backups = sorted(
+        (os.path.join(backup_dir, name) for name in os.listdir(backup_dir)
+         if not name.startswith('.') and name.endswith(('.db', '.zip'))),
+        key=os.path.getmtime
+    )
+    for old in backups[:-keep] if keep else []:
+        os.remove(old)
+    return path
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='資料庫線上備份與唯讀副本')
+    parser.add_argument('command', choices=['backup', 'replica'])
+    parser.add_argument('--db', action='append', help='資料庫路徑（可重複指定），預設 line_data.db')
+    parser.add_argument('--out', default='backups', help='備份目錄')
+    parser.add_argument('--keep', type=int, default=5)
+    parser.add_argument('--pages', type=int, default=DEFAULT_PAGES)
+    parser.add_argument('--pause', type=float, default=DEFAULT_PAUSE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db_paths = args.db or ['line_data.db']
+    if args.command == 'backup':
+        print(f"✅ 已建立備份 {create_backup(db_paths, args.out, args.keep, args.pages, args.pause)}")
+    else:
+        ReplicaManager(db_paths, interval=1, pages=args.pages, pause=args.pause).refresh(force=True)
+        print(f"✅ 已更新副本: {', '.join(replica_path(path) for path in db_paths)}")
+
+
+if __name__ == "__main__":
+    main()
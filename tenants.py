@@ -0,0 +1,137 @@
+"""
+多頻道（多租戶）設定
+由 LINE_CHANNELS_FILE 載入多個 LINE 頻道，每個頻道使用獨立的資料庫檔案；
+webhook 依路徑 /webhook/<頻道名稱> 或請求內容的 destination 對應到頻道，
+各頻道的處理器與連線在第一次使用時建立並快取
+
+設定檔格式（JSON）：
+    {
+      "channels": {
+        "shop-a": {
+          "destination": "U0123...",
+          "access_token_env": "SHOP_A_ACCESS_TOKEN",
+          "channel_secret_env": "SHOP_A_CHANNEL_SECRET",
+          "db_path": "data/shop-a.db"
+        }
+      }
+    }
+
+金鑰可直接以 access_token / channel_secret 填入，或以 *_env 指定環境變數名稱。
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHANNEL = 'default'
+DEFAULT_DB_PATH = 'line_data.db'
+
+CHANNEL_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+class UnknownChannelError(LookupError):
+    """找不到對應的頻道"""
+
+
+class Channel:
+    """單一 LINE 頻道的設定"""
+
+    __slots__ = ('name', 'access_token', 'channel_secret', 'destination', 'db_path')
+
+    def __init__(self, name, access_token, channel_secret, destination=None, db_path=DEFAULT_DB_PATH):
+        self.name = name
+        self.access_token = access_token
+        self.channel_secret = channel_secret
+        self.destination = destination
+        self.db_path = db_path
+
+
+def _secret(settings, key):
+    if settings.get(f'{key}_env'):
+        return os.getenv(settings[f'{key}_env'])
+    return settings.get(key)
+
+
+def load_channels(path=None):
+    """載入頻道設定；未指定設定檔時以 LINE_CHANNEL_ACCESS_TOKEN / LINE_CHANNEL_SECRET 建立單一頻道"""
+    if not path:
+        return {DEFAULT_CHANNEL: Channel(
+            DEFAULT_CHANNEL,
+            os.getenv('LINE_CHANNEL_ACCESS_TOKEN'),
+            os.getenv('LINE_CHANNEL_SECRET'),
+        )}
+
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+
+    channels = {}
+    db_paths = set()
+    for name, settings in config.get('channels', {}).items():
+        if not CHANNEL_NAME_PATTERN.match(name):
+            raise ValueError(f"頻道名稱只能包含英數字、- 與 _: {name!r}")
+        db_path = settings.get('db_path') or os.path.join('data', f'{name}.db')
+        if db_path in db_paths:
+            raise ValueError(f"頻道 {name} 的資料庫與其他頻道重複: {db_path}")
+        db_paths.add(db_path)
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        channels[name] = Channel(
+            name,
+            _secret(settings, 'access_token'),
+            _secret(settings, 'channel_secret'),
+            settings.get('destination'),
+            db_path,
+        )
+    if not channels:
+        raise ValueError(f"設定檔沒有任何頻道: {path}")
+    logger.info(f"已載入 {len(channels)} 個頻道: {', '.join(channels)}")
+    return channels
+
+
+class ChannelRegistry:
+    """頻道查詢與各頻道資源（處理器、資料庫管理器等）的快取"""
+
+    def __init__(self, channels):
+        self.channels = channels
+        self._by_destination = {
+            channel.destination: channel for channel in channels.values() if channel.destination
+        }
+        self._resources = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(load_channels(os.getenv('LINE_CHANNELS_FILE')))
+
+    def resolve(self, name=None, destination=None):
+        """依頻道名稱或 destination 找出頻道
+
+        兩者皆未指定（或 destination 無對應）時，使用 default 頻道或唯一的頻道。
+        """
+        if name:
+            if name not in self.channels:
+                raise UnknownChannelError(f"未知的頻道: {name}")
+            return self.channels[name]
+        if destination and destination in self._by_destination:
+            return self._by_destination[destination]
+        if DEFAULT_CHANNEL in self.channels:
+            return self.channels[DEFAULT_CHANNEL]
+        if len(self.channels) == 1:
+            return next(iter(self.channels.values()))
+        raise UnknownChannelError("請指定頻道（/webhook/<頻道名稱> 或 channel 參數）")
+
+    def resource(self, kind, channel, factory):
+        """取得頻道的快取資源，不存在時以 factory(channel) 建立"""
+        key = (kind, channel.name)
+        resource = self._resources.get(key)
+        if resource is None:
+            with self._lock:
+                resource = self._resources.get(key)
+                if resource is None:
+                    resource = self._resources[key] = factory(channel)
+        return resource
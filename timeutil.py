@@ -0,0 +1,119 @@
+"""
+時間處理
+提及時間以 UTC epoch 毫秒（整數）儲存；顯示與日曆計算（今日、日時間桶）使用
+DISPLAY_TIMEZONE 指定的時區（預設 Asia/Taipei），與伺服器本身的時區無關
+
+API 回傳的時間維持與舊版相同的格式：顯示時區的本地時間、不含時區的 ISO 8601 字串；
+不含時區的查詢參數也視為顯示時區的時間。
+"""
+
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
+
+logger = logging.getLogger(__name__)
+
+
+def _load_timezone(name):
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        logger.warning(f"找不到時區 {name}（請安裝 tzdata），改用伺服器時區")
+        return datetime.now().astimezone().tzinfo
+
+
+DISPLAY_TIMEZONE_NAME = os.getenv('DISPLAY_TIMEZONE', 'Asia/Taipei')
+DISPLAY_TIMEZONE = _load_timezone(DISPLAY_TIMEZONE_NAME)
+
+
+@lru_cache(maxsize=1)
+def _timezone_names():
+    return {name.lower(): name for name in available_timezones()}
+
+
+def resolve_timezone(name):
+    """時區名稱（不分大小寫，例如 asia/tokyo）轉為標準名稱，無法辨識時拋出 ValueError"""
+    canonical = _timezone_names().get(name.lower())
+    if canonical is None:
+        try:
+            ZoneInfo(name)
+        except (ZoneInfoNotFoundError, ValueError):
+            raise ValueError(f"未知的時區: {name}")
+        canonical = name
+    return canonical
+
+
+def parse_time_of_day(value):
+    """HH:MM 或 H 轉為 'HH:MM'，格式錯誤時拋出 ValueError"""
+    hour, _, minute = value.partition(':')
+    hour, minute = int(hour), int(minute or 0)
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError(f"時間格式錯誤: {value}")
+    return f'{hour:02d}:{minute:02d}'
+
+
+def now_ms():
+    return time.time_ns() // 1_000_000
+
+
+def now():
+    """顯示時區的目前時間"""
+    return datetime.now(DISPLAY_TIMEZONE)
+
+
+def to_display(moment):
+    """轉為顯示時區的時間；不含時區的時間視為顯示時區"""
+    if moment.tzinfo is None:
+        return moment.replace(tzinfo=DISPLAY_TIMEZONE)
+    return moment.astimezone(DISPLAY_TIMEZONE)
+
+
+def to_ms(moment):
+    return int(to_display(moment).timestamp() * 1000)
+
+
+def from_ms(value):
+    return datetime.fromtimestamp(value / 1000, DISPLAY_TIMEZONE)
+
+
+def isoformat(value):
+    """API 格式：顯示時區、不含時區的 ISO 8601 字串（value 為毫秒或 datetime）"""
+    if value is None:
+        return None
+    moment = from_ms(value) if isinstance(value, int) else to_display(value)
+    return moment.replace(tzinfo=None).isoformat()
+
+
+def day_bounds(day):
+    """顯示時區某日的 [起點, 隔日起點) 毫秒範圍"""
+    following = day + timedelta(days=1)
+    return (to_ms(datetime(day.year, day.month, day.day)),
+            to_ms(datetime(following.year, following.month, following.day)))
+
+
+def today_bounds():
+    return day_bounds(now().date())
+
+
+def parse_stored(value):
+    """將資料庫中的時間轉為毫秒；相容舊版的字串格式
+
+    - 整數：已是毫秒
+    - 以 T 分隔（datetime.now().isoformat() 寫入）：不含時區時為伺服器本地時間
+    - 以空白分隔（SQLite CURRENT_TIMESTAMP 預設值）：不含時區時為 UTC
+    """
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(value)
+    text = str(value)
+    try:
+        moment = datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    if moment.tzinfo is None:
+        moment = moment.astimezone() if 'T' in text else moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp() * 1000)
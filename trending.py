@@ -0,0 +1,153 @@
+"""
+熱門提及偵測
+以 Space-Saving 演算法在滑動時間視窗（5 分鐘 / 1 小時 / 24 小時）內
+找出全域與各群組「現在」最常被提及的使用者；記憶體用量有固定上限，與使用者數量無關
+
+統計只存在於程序記憶體內，由本程序送出的提及記錄更新（mention_writer 監聽器）：
+只適用單一 worker 部署，多 worker 時每個 worker 只看得到自己處理的 webhook，重新啟動後從零開始。
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+# 視窗名稱 → (視窗秒數, 切分的時間槽數)；視窗以時間槽為單位滑動
+WINDOWS = {
+    '5m': (300, 10),
+    '1h': (3600, 12),
+    '24h': (86400, 24),
+}
+
+GLOBAL_SCOPE = '*'
+
+# 早於最長視窗的提及（例如補寫或重送的舊訊息）不計入
+MAX_WINDOW_SECONDS = max(seconds for seconds, _slots in WINDOWS.values())
+
+
+class SpaceSaving:
+    """Space-Saving 熱門項目摘要：最多保留 capacity 個計數器
+
+    計數為上界，真實次數介於 count - error 與 count 之間。
+    """
+
+    __slots__ = ('capacity', 'counters')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # key → [次數, 誤差, 顯示名稱]
+        self.counters = {}
+
+    def add(self, key, name, count=1):
+        entry = self.counters.get(key)
+        if entry is not None:
+            entry[0] += count
+            entry[2] = name
+            return
+        if len(self.counters) < self.capacity:
+            self.counters[key] = [count, 0, name]
+            return
+        # 取代次數最少的計數器，並繼承其次數作為誤差
+        min_key = min(self.counters, key=lambda k: self.counters[k][0])
+        min_count = self.counters.pop(min_key)[0]
+        self.counters[key] = [min_count + count, min_count, name]
+
+
+class SlidingTopK:
+    """以環狀時間槽實作的滑動視窗熱門項目"""
+
+    __slots__ = ('slot_seconds', 'capacity', 'slots')
+
+    def __init__(self, window_seconds, slot_count, capacity):
+        self.slot_seconds = window_seconds / slot_count
+        self.capacity = capacity
+        # 每個時間槽為 (時間槽編號, SpaceSaving)
+        self.slots = [None] * slot_count
+
+    def add(self, key, name, at):
+        index = int(at // self.slot_seconds)
+        position = index % len(self.slots)
+        slot = self.slots[position]
+        if slot is not None and slot[0] > index:
+            # 同一位置已是較新的時間槽：這筆提及已在視窗之外，不可覆蓋較新的計數
+            return
+        if slot is None or slot[0] != index:
+            slot = self.slots[position] = (index, SpaceSaving(self.capacity))
+        slot[1].add(key, name)
+
+    def top(self, limit, now):
+        current = int(now // self.slot_seconds)
+        merged = {}
+        for slot in self.slots:
+            if slot is None or current - slot[0] >= len(self.slots):
+                continue
+            for key, (count, error, name) in slot[1].counters.items():
+                entry = merged.setdefault(key, [0, 0, name])
+                entry[0] += count
+                entry[1] += error
+        ranked = sorted(merged.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+        return [
+            {'user_id': key, 'user_name': name, 'count': count, 'error': error}
+            for key, (count, error, name) in ranked
+        ]
+
+
+class TrendingTracker:
+    """全域與各群組的熱門提及追蹤
+
+    群組數超過 max_groups 時淘汰最久沒有提及的群組，確保記憶體上限。
+    """
+
+    def __init__(self, capacity=64, group_capacity=16, max_groups=500):
+        self.capacity = capacity
+        self.group_capacity = group_capacity
+        self.max_groups = max_groups
+        self._lock = threading.Lock()
+        self._global = self._new_scope(capacity)
+        self._groups = OrderedDict()
+
+    @staticmethod
+    def _new_scope(capacity):
+        return {name: SlidingTopK(seconds, slots, capacity) for name, (seconds, slots) in WINDOWS.items()}
+
+    def _group_scope(self, group_id):
+        scope = self._groups.get(group_id)
+        if scope is None:
+            scope = self._groups[group_id] = self._new_scope(self.group_capacity)
+            if len(self._groups) > self.max_groups:
+                self._groups.popitem(last=False)
+        else:
+            self._groups.move_to_end(group_id)
+        return scope
+
+    def record(self, group_id, user_id, user_name, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            scopes = [self._global]
+            if group_id:
+                scopes.append(self._group_scope(group_id))
+            for scope in scopes:
+                for window in scope.values():
+                    window.add(user_id, user_name, now)
+
+    def record_rows(self, rows, now=None):
+        """寫入路徑的監聽器：依資料列的提及時間更新熱門統計，早於最長視窗的資料列略過"""
+        now = time.time() if now is None else now
+        for user_id, user_name, group_id, _message, _message_id, mentioned_at_ms, *_ in rows:
+            # 提及時間晚於現在（時鐘誤差）時以現在計
+            mentioned_at = min(mentioned_at_ms / 1000, now)
+            if mentioned_at >= now - MAX_WINDOW_SECONDS:
+                self.record(group_id, user_id, user_name, mentioned_at)
+
+    def top(self, window='1h', group_id=None, limit=10, now=None):
+        """查詢視窗內最常被提及的使用者"""
+        if window not in WINDOWS:
+            raise ValueError(f"未知的時間視窗: {window}（可用: {', '.join(WINDOWS)}）")
+        now = time.time() if now is None else now
+        with self._lock:
+            if group_id and group_id != GLOBAL_SCOPE:
+                scope = self._groups.get(group_id)
+                if scope is None:
+                    return []
+            else:
+                scope = self._global
+            return scope[window].top(limit, now)